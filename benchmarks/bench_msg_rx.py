@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Microbenchmark for the receive path of XL30Serial
+#
+# Compares the host side overhead per received frame of the buffered
+# frame reader used by XL30Serial._msg_rx against the previous byte-at-a-time
+# implementation. The serial port is replaced by an in memory port so only
+# the host side cost is measured, not the 9600 baud wire time.
+#
+# Usage: python benchmarks/bench_msg_rx.py [frames]
+
+import os
+import sys
+import struct
+import logging
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from xl30serial.xl30serial import XL30Serial
+
+class MemoryPort:
+    # Minimal stand in for serial.Serial that serves reads from memory
+    def __init__(self):
+        self.timeout = 60
+        self._data = bytearray()
+        self._pos = 0
+
+    def feed(self, data):
+        self._data += data
+
+    @property
+    def in_waiting(self):
+        return len(self._data) - self._pos
+
+    def read(self, size = 1):
+        r = bytes(self._data[self._pos : self._pos + size])
+        self._pos = self._pos + len(r)
+        return r
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+def frame(opCode, payload):
+    msg = bytes([0x05, len(payload) + 5, opCode, 0x00]) + payload
+    return msg + bytes([sum(msg) & 0xFF])
+
+def legacy_rx(port):
+    # Previous framing in _msg_rx: header, then one read per byte
+    msg = port.read(2)
+    toRead = msg[1] - 2
+    while toRead > 0:
+        b = port.read(1)
+        toRead = toRead - 1
+        msg += b
+    chksum = 0
+    for i in range(len(msg) - 1):
+        chksum = (chksum + msg[i]) % 256
+    if chksum != msg[-1]:
+        raise ValueError("Invalid checksum")
+    return msg
+
+def run(label, frames, fn):
+    t0 = perf_counter()
+    for i in range(frames):
+        fn()
+    t1 = perf_counter()
+    print(f"{label:<32} {(t1 - t0) / frames * 1e6:8.2f} us/frame")
+
+def main():
+    frames = 20000
+    if len(sys.argv) > 1:
+        frames = int(sys.argv[1])
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.ERROR)
+
+    for name, resp in [
+        ( "float (get_magnification)", frame(12, struct.pack("<f", 1000.0)) ),
+        ( "5 floats (get_stage_position)", frame(190, struct.pack("<fffff", 1, 2, 3, 4, 5)) )
+    ]:
+        print(f"{name}, {len(resp)} bytes per frame")
+
+        port = MemoryPort()
+        port.feed(resp * frames)
+        run("  legacy byte-at-a-time", frames, lambda: legacy_rx(port))
+
+        port = MemoryPort()
+        port.feed(resp * frames)
+        xl = XL30Serial(None, logger)
+        xl._port = port
+        run("  buffered _rx_frame", frames, lambda: xl._rx_frame())
+        xl._port = None
+
+if __name__ == "__main__":
+    main()
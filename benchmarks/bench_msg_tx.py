@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Microbenchmark for the host side cost of a single XL30 command
+#
+# Runs query commands against a pyserial loopback port (loop://). The
+# loopback returns every request frame unchanged which is a valid (zero
+# valued) response for all fill=4 queries. The previous transmit and
+# receive path is measured by loading xl30serial.py of the baseline
+# revision (--baseline, default 33147e7) from git into a temporary module.
+#
+# Usage: python benchmarks/bench_msg_tx.py [--baseline REV] [commands]
+
+import argparse
+import os
+import sys
+import logging
+import subprocess
+import types
+
+from time import perf_counter
+
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from xl30serial.xl30serial import XL30Serial
+
+def load_baseline(revision):
+    # Returns the xl30serial module of the given revision or None if it
+    # cannot be read from git (no checkout, unknown revision)
+    try:
+        source = subprocess.run(
+            [ "git", "show", f"{revision}:src/xl30serial/xl30serial.py" ],
+            capture_output = True, text = True, check = True,
+            cwd = os.path.dirname(os.path.abspath(__file__))
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    module = types.ModuleType(f"xl30serial_{revision}")
+    module.__file__ = f"{revision}:src/xl30serial/xl30serial.py"
+    exec(compile(source, module.__file__, "exec"), module.__dict__)
+    return module
+
+def run(label, count, fn, baseline = None):
+    t0 = perf_counter()
+    for i in range(count):
+        fn()
+    t1 = perf_counter()
+    t = (t1 - t0) / count * 1e6
+    if baseline is None:
+        print(f"{label:<40} {t:8.2f} us/command")
+    else:
+        print(f"{label:<40} {t:8.2f} us/command, {t - baseline:8.2f} us host overhead")
+    return t
+
+def main():
+    parser = argparse.ArgumentParser(description = "Host side cost of a single XL30 command")
+    parser.add_argument("--baseline", default = "33147e7", help = "Git revision of the baseline transmit / receive path")
+    parser.add_argument("count", type = int, nargs = "?", default = 5000, help = "Commands per measurement")
+    args = parser.parse_args()
+    count = args.count
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.ERROR)
+
+    port = serial.serial_for_url("loop://", timeout = 1)
+
+    # Cost of the loopback port itself (write and read back one 9 byte frame)
+    frame = bytes([ 0x05, 9, 12, 0, 0, 0, 0, 0, 26 ])
+    base = run("loopback port only", count, lambda: (port.write(frame), port.read(9)))
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f"baseline {args.baseline} not available from git, skipped")
+    else:
+        legacy = baseline.XL30Serial(None, logger)
+        legacy._port = port
+        run(f"{args.baseline} _msg_tx / _msg_rx (op 12)", count, lambda: (legacy._msg_tx(12, fill = 4), legacy._msg_rx(fmt = "f")), base)
+        legacy._port = None
+
+    xl = XL30Serial(None, logger)
+    xl._port = port
+    run("_msg_tx / _msg_rx (op 12)", count, lambda: (xl._msg_tx(12, fill = 4), xl._msg_rx(fmt = "f")), base)
+    run("_command('get_magnification')", count, lambda: xl._command("get_magnification"), base)
+    run("_command('set_magnification', 1000)", count, lambda: xl._command("set_magnification", 1000.0), base)
+    xl._port = None
+
+    port.close()
+
+if __name__ == "__main__":
+    main()
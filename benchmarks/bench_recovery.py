@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Cost of recovering from transport faults
+#
+# Runs XL30Serial against the in process simulator through a fault injecting
+# port (xl30faults). For every fault type a fault is injected into the
+# response of a magnification query, the time till the query returned
+# (minus the fault free round trip), the number of retries and reconnects
+# and the number of lost commands (query raised) are reported. A spot size
+# query after each trial checks that the line is still in sync.
+#
+# Usage: python benchmarks/bench_recovery.py [trials] [retryDelay] [portTimeout] [fastReconnect]
+
+import os
+import sys
+import logging
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from xl30serial.xl30serial import XL30Serial
+from xl30serial.xl30simulator import XL30Simulator, XL30SimulatorPort
+from xl30serial.xl30faults import XL30FaultyPort, FAULTS
+
+def main():
+    trials = 5
+    retryDelay = 5
+    portTimeout = 2
+    fastReconnect = False
+    if len(sys.argv) > 1:
+        trials = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        retryDelay = float(sys.argv[2])
+    if len(sys.argv) > 3:
+        portTimeout = float(sys.argv[3])
+    if len(sys.argv) > 4:
+        fastReconnect = sys.argv[4].lower() in ( "1", "true", "yes" )
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.CRITICAL)
+
+    sim = XL30Simulator(seed = 1)
+    port = XL30FaultyPort(XL30SimulatorPort(sim, timeout = portTimeout), seed = 1, delay = portTimeout / 2)
+    xl = XL30Serial(port, logger, retryDelay = retryDelay, fastReconnect = fastReconnect)
+
+    t0 = perf_counter()
+    for i in range(100):
+        xl._get_magnification()
+    baseline = (perf_counter() - t0) / 100
+
+    print(f"retry delay {retryDelay} s, port timeout {portTimeout} s, fast reconnect {fastReconnect}, fault free query {baseline * 1e6:.1f} us")
+    print(f"{'fault':<10} {'recovery [s]':>14} {'max [s]':>9} {'retries':>8} {'reconnects':>11} {'lost':>5} {'desync':>7}")
+
+    for fault in FAULTS:
+        recovery = []
+        lost = 0
+        desync = 0
+        retries = xl._retryTotal
+        reconnects = xl._reconnectTotal
+        for i in range(trials):
+            port.arm(fault)
+            t0 = perf_counter()
+            try:
+                if xl._get_magnification() != sim._values['magnification'][0]:
+                    desync = desync + 1
+            except Exception:
+                lost = lost + 1
+            recovery.append(perf_counter() - t0 - baseline)
+            if xl._get_spotsize() != sim._values['spotsize'][0]:
+                desync = desync + 1
+        print(f"{fault:<10} {sum(recovery) / trials:14.3f} {max(recovery):9.3f} {(xl._retryTotal - retries) / trials:8.2f} {(xl._reconnectTotal - reconnects) / trials:11.2f} {lost:5} {desync:7}")
+
+if __name__ == "__main__":
+    main()
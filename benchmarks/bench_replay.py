@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# Replays a captured XL30 session (xl30capture) as fast as possible
+#
+#   rx      Feeds all received data through _msg_rx and decodes every frame
+#   session Runs the recorded requests again (same XL30Serial calls) against
+#           the replay port, responses are released after each write
+#
+# Without --capture a session is recorded against the simulator first.
+#
+# Usage: python benchmarks/bench_replay.py [--capture FILE] [--polls N] [--repeat N]
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from xl30serial.xl30serial import XL30Serial
+from xl30serial.xl30capture import XL30ReplayPort, read_capture, CAPTURE_TX, CAPTURE_RX
+from xl30serial.xl30simulator import XL30Simulator
+
+def session(xl, polls):
+    for i in range(polls):
+        xl._get_magnification()
+        xl._get_stage_position()
+        xl._get_hightension()
+        xl.get_state()
+
+def record(logger, path, polls):
+    sim = XL30Simulator(timeScale = 0, seed = 1, logger = logger)
+    xl = XL30Serial(sim.start(), logger, capture = path)
+    xl._connect()
+    session(xl, polls)
+    xl._close()
+    sim.stop()
+
+def bench_rx(logger, records, repeat):
+    rxBytes = sum([ len(data) for ts, direction, data in records if direction == CAPTURE_RX ])
+    best = None
+    for i in range(repeat):
+        xl = XL30Serial(None, logger)
+        xl._port = XL30ReplayPort(records, followWrites = False, timeout = 0)
+        frames = 0
+        t0 = perf_counter()
+        while (not xl._port.done) or (len(xl._rxBuffer) > 0):
+            if xl._msg_rx() is not None:
+                frames = frames + 1
+        elapsed = perf_counter() - t0
+        if (best is None) or (elapsed < best[0]):
+            best = ( elapsed, frames )
+    return { 'frames' : best[1], 'frames_per_s' : best[1] / best[0], 'bytes_per_s' : rxBytes / best[0] }
+
+def bench_session(logger, records, polls, repeat):
+    best = None
+    for i in range(repeat):
+        port = XL30ReplayPort(records, timeout = 0)
+        xl = XL30Serial(port, logger)
+        t0 = perf_counter()
+        xl._connect()
+        session(xl, polls)
+        elapsed = perf_counter() - t0
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    requests = len([ r for r in records if r[1] == CAPTURE_TX ])
+    return { 'requests' : requests, 'mismatches' : port.mismatches, 'requests_per_s' : requests / best }
+
+def main():
+    parser = argparse.ArgumentParser(description = "XL30 capture replay benchmark")
+    parser.add_argument("--capture", default = None, help = "Capture file to replay (recorded against the simulator if omitted)")
+    parser.add_argument("--polls", type = int, default = 200, help = "Polling cycles of the recorded session")
+    parser.add_argument("--repeat", type = int, default = 5, help = "Repetitions, the best run is reported")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.CRITICAL)
+
+    path = args.capture
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), "session.xl30cap")
+        record(logger, path, args.polls)
+    header, records = read_capture(path)
+    print(f"{len(records)} records from {path}")
+
+    res = bench_rx(logger, records, args.repeat)
+    print(f"rx       {res['frames']} frames, {res['frames_per_s']:.0f} frames/s, {res['bytes_per_s'] / 1e6:.2f} MB/s")
+    if args.capture is None:
+        res = bench_session(logger, records, args.polls, args.repeat)
+        print(f"session  {res['requests']} requests, {res['requests_per_s']:.0f} requests/s, {res['mismatches']} mismatches")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+# Benchmark suite for XL30Serial
+#
+# Measures against the simulator (xl30simulator, served on a pty with all
+# modelled durations scaled to zero) so results only depend on the host and
+# the driver:
+#
+#   encode_decode   Host side cost per command of _msg_tx (frame assembly and
+#                   write to a null port) and _msg_rx (framing and decoding
+#                   from an in memory port)
+#   roundtrip       End to end latency of every getter and setter
+#   throughput      Sustained queries per second for telemetry style polling
+#                   (sequential getters and pipelined get_state)
+#   startup         Time from constructing XL30Serial till the first command
+#                   returned, with and without detector autodetection
+#
+# Results are written as JSON (stdout or --output) together with the
+# environment. --compare prints the relative change of every metric against
+# a previous result file.
+#
+# Usage: python benchmarks/bench_suite.py [--repeat N] [--duration S] [--output FILE] [--compare FILE]
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+
+from time import perf_counter, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from xl30serial.xl30serial import XL30Serial
+from xl30serial.xl30commands import XL30_COMMANDS, build_frame
+from xl30serial.xl30simulator import XL30Simulator
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_ScanMode, ScanningElectronMicroscope_ImageFilterMode
+
+from bench_msg_rx import MemoryPort
+
+GETTERS = [
+    ( "_get_id", () ),
+    ( "_get_hightension", () ),
+    ( "_get_spotsize", () ),
+    ( "_get_magnification", () ),
+    ( "_get_stigmator", () ),
+    ( "_get_detector", () ),
+    ( "_get_linetime", () ),
+    ( "_get_linesperframe", () ),
+    ( "_get_scanmode", () ),
+    ( "_get_contrast", () ),
+    ( "_get_brightness", () ),
+    ( "_get_databar_text", () ),
+    ( "_get_stage_position", () ),
+    ( "_get_beamshift", () ),
+    ( "_get_scanrotation", () ),
+    ( "_get_area_or_dot_shift", () ),
+    ( "_get_selected_area_size", () ),
+    ( "_get_imagefilter_mode", () ),
+    ( "_get_specimen_current_detector_mode", () ),
+    ( "_get_specimen_current", () ),
+    ( "_is_beam_blanked", () ),
+    ( "_isOplocked", () ),
+    ( "get_state", () )
+]
+
+SETTERS = [
+    ( "_set_spotsize", ( 3.0, ) ),
+    ( "_set_magnification", ( 1000, ) ),
+    ( "_set_stigmator", ( 0.1, 0.1 ) ),
+    ( "_set_detector", ( 3, ) ),
+    ( "_set_linetime", ( 20.0, ) ),
+    ( "_set_linesperframe", ( 484, ) ),
+    ( "_set_scanmode", ( ScanningElectronMicroscope_ScanMode.FULL_FRAME, ) ),
+    ( "_set_contrast", ( 40, ) ),
+    ( "_set_brightness", ( 40, ) ),
+    ( "_set_databar_text", ( "benchmark", ) ),
+    ( "_set_stage_position", ( 1.0, 2.0 ) ),
+    ( "_set_beamshift", ( 0.1, 0.1 ) ),
+    ( "_set_scanrotation", ( 10.0, ) ),
+    ( "_set_area_or_dot_shift", ( 1.0, 1.0 ) ),
+    ( "_set_selected_area_size", ( 20.0, 20.0 ) ),
+    ( "_set_imagefilter_mode", ( ScanningElectronMicroscope_ImageFilterMode.LIVE, 1 ) ),
+    ( "_set_hightension", ( 10000, ) ),
+    ( "_blank", () ),
+    ( "_unblank", () ),
+    ( "_oplock", ( False, ) ),
+    ( "_make_photo", () ),
+    ( "_auto_focus", () )
+]
+
+def stats(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'n' : n,
+        'min_us' : samples[0] * 1e6,
+        'median_us' : samples[n // 2] * 1e6,
+        'p95_us' : samples[min(n - 1, int(n * 0.95))] * 1e6,
+        'mean_us' : sum(samples) / n * 1e6
+    }
+
+def timed(fn, repeat):
+    samples = []
+    for i in range(repeat):
+        t0 = perf_counter()
+        fn()
+        samples.append(perf_counter() - t0)
+    return samples
+
+class NullPort:
+    timeout = 1
+    in_waiting = 0
+    def write(self, data):
+        return len(data)
+    def read(self, size = 1):
+        return b''
+    def close(self):
+        pass
+
+def bench_encode_decode(logger, repeat):
+    results = { }
+    xl = XL30Serial(None, logger)
+    for name, cmd in XL30_COMMANDS.items():
+        if cmd.request is not None:
+            payload = bytes(cmd.request.size)
+        else:
+            payload = bytes(8)
+        response = build_frame(cmd.opcode, bytes(cmd.response.size if cmd.response is not None else 4))
+
+        xl._port = NullPort()
+        tx = timed(lambda: xl._msg_tx(cmd.opcode, payload), repeat)
+
+        port = MemoryPort()
+        port.feed(response * repeat)
+        xl._port = port
+        rx = timed(lambda: xl._msg_rx(cmd.response).data, repeat)
+
+        results[name] = {
+            'opcode' : cmd.opcode,
+            'encode_us' : stats(tx)['median_us'],
+            'decode_us' : stats(rx)['median_us']
+        }
+    xl._port = None
+    return results
+
+def bench_roundtrip(xl, repeat):
+    results = { }
+    for name, args in GETTERS + SETTERS:
+        fn = getattr(xl, name)
+        results[name] = stats(timed(lambda: fn(*args), repeat))
+    return results
+
+def bench_throughput(xl, duration):
+    results = { }
+
+    n = 0
+    t0 = perf_counter()
+    while perf_counter() - t0 < duration:
+        xl._get_magnification()
+        xl._get_stage_position()
+        xl._get_hightension()
+        n = n + 1
+    elapsed = perf_counter() - t0
+    results['sequential_queries_per_s'] = n * 3 / elapsed
+    results['sequential_polls_per_s'] = n / elapsed
+
+    n = 0
+    t0 = perf_counter()
+    while perf_counter() - t0 < duration:
+        xl.get_state()
+        n = n + 1
+    elapsed = perf_counter() - t0
+    results['get_state_per_s'] = n / elapsed
+    return results
+
+def bench_startup(logger, portName, repeat):
+    results = { }
+    for label, autodetect in [ ( 'time_to_first_command', False ), ( 'time_to_first_command_autodetect', True ) ]:
+        samples = []
+        for i in range(repeat):
+            t0 = perf_counter()
+            xl = XL30Serial(portName, logger, detectorsAutodetect = autodetect)
+            xl._connect()
+            xl._get_magnification()
+            samples.append(perf_counter() - t0)
+            xl._close()
+        results[label + '_s'] = stats(samples)['median_us'] / 1e6
+    return results
+
+def environment():
+    env = {
+        'timestamp' : time(),
+        'python' : platform.python_version(),
+        'implementation' : platform.python_implementation(),
+        'platform' : platform.platform(),
+        'machine' : platform.machine()
+    }
+    try:
+        env['revision'] = subprocess.run([ "git", "describe", "--always", "--dirty" ], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        env['revision'] = None
+    return env
+
+def flatten(d, prefix = ""):
+    r = { }
+    for k, v in d.items():
+        if isinstance(v, dict):
+            r.update(flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            r[f"{prefix}{k}"] = v
+    return r
+
+def compare(current, baseline):
+    cur = flatten({ k : v for k, v in current.items() if k != 'environment' })
+    base = flatten({ k : v for k, v in baseline.items() if k != 'environment' })
+    for key in sorted(cur):
+        if (key not in base) or (base[key] == 0) or key.endswith(".n") or key.endswith(".opcode"):
+            continue
+        print(f"{key:<70} {base[key]:14.2f} {cur[key]:14.2f} {(cur[key] / base[key] - 1) * 100:+8.1f} %")
+
+def main():
+    parser = argparse.ArgumentParser(description = "XL30Serial benchmark suite")
+    parser.add_argument("--repeat", type = int, default = 50, help = "Repetitions per measurement")
+    parser.add_argument("--duration", type = float, default = 2.0, help = "Duration of each throughput run in seconds")
+    parser.add_argument("--startup-repeat", type = int, default = 3, help = "Repetitions of the startup measurement")
+    parser.add_argument("--output", default = None, help = "Write results to this file instead of stdout")
+    parser.add_argument("--compare", default = None, help = "Print relative changes against a previous result file")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.CRITICAL)
+
+    sim = XL30Simulator(timeScale = 0, seed = 1, logger = logger)
+    portName = sim.start()
+
+    results = { 'environment' : environment() }
+    results['encode_decode'] = bench_encode_decode(logger, args.repeat)
+
+    xl = XL30Serial(portName, logger)
+    xl._connect()
+    results['roundtrip'] = bench_roundtrip(xl, args.repeat)
+    results['throughput'] = bench_throughput(xl, args.duration)
+    xl._close()
+
+    results['startup'] = bench_startup(logger, portName, args.startup_repeat)
+    sim.stop()
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 4)
+    else:
+        print(json.dumps(results, indent = 4))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from abc import abstractmethod
 from enum import Enum
+from types import MappingProxyType
 
 class ScanningElectronMicroscope_NotConnectedException(Exception):
     pass
@@ -25,6 +26,89 @@ class ScanningElectronMicroscope_SpecimenCurrentDetectorMode(Enum):
     IMAGING         = 1
     MEASURING       = 2
 
+class ScanningElectronMicroscope_State:
+    # Immutable snapshot of (a subset of) the microscope state as returned by
+    # get_state. Fields can be accessed as attributes (state.magnification) or
+    # by key (state['magnification']) - keys(), values() and items() behave
+    # like for a dictionary, mapping is the read-only mapping of all fields.
+    # timings contains the time in seconds after the start of the snapshot at
+    # which each field has been available, duration the total time the
+    # snapshot took.
+
+    FIELDS = (
+        'hightension',
+        'spotsize',
+        'magnification',
+        'detector',
+        'scanmode',
+        'contrast',
+        'brightness',
+        'stage',
+        'beamshift',
+        'imagefilter',
+        'linetime',
+        'linesperframe'
+    )
+
+    __slots__ = ( '_values', '_timings', '_timestamp', '_duration' )
+
+    def __init__(self, values, timings = None, timestamp = None, duration = None):
+        frozen = { }
+        for k in values:
+            if isinstance(values[k], dict):
+                frozen[k] = MappingProxyType(dict(values[k]))
+            else:
+                frozen[k] = values[k]
+        object.__setattr__(self, '_values', MappingProxyType(frozen))
+        object.__setattr__(self, '_timings', MappingProxyType(dict(timings) if timings is not None else {}))
+        object.__setattr__(self, '_timestamp', timestamp)
+        object.__setattr__(self, '_duration', duration)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Microscope state snapshots are immutable")
+    def __delattr__(self, name):
+        raise AttributeError("Microscope state snapshots are immutable")
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(f"Field {name} is not part of this snapshot")
+
+    def __getitem__(self, name):
+        return self._values[name]
+    def __contains__(self, name):
+        return name in self._values
+    def __iter__(self):
+        return iter(self._values)
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return self._values.keys()
+    def values(self):
+        return self._values.values()
+    def items(self):
+        return self._values.items()
+    def get(self, name, default = None):
+        return self._values.get(name, default)
+
+    @property
+    def mapping(self):
+        return self._values
+    @property
+    def timings(self):
+        return self._timings
+    @property
+    def timestamp(self):
+        return self._timestamp
+    @property
+    def duration(self):
+        return self._duration
+
+    def __repr__(self):
+        return f"ScanningElectronMicroscope_State({dict(self._values)})"
+
 class ScanningElectronMicroscope:
     def __init__(
             self,
@@ -91,6 +175,9 @@ class ScanningElectronMicroscope:
     def _get_id(self):
         raise NotImplementedError()
     @abstractmethod
+    def _get_state(self, fields = None):
+        raise NotImplementedError()
+    @abstractmethod
     def _get_hightension(self):
         raise NotImplementedError()
     @abstractmethod
@@ -234,6 +321,13 @@ class ScanningElectronMicroscope:
     def get_id(self):
         return self._get_id()
 
+    def get_state(self, fields = None):
+        if fields is not None:
+            for f in fields:
+                if f not in ScanningElectronMicroscope_State.FIELDS:
+                    raise ValueError(f"Unknown state field {f}, supported are {ScanningElectronMicroscope_State.FIELDS}")
+        return self._get_state(fields)
+
     def get_hightension(self):
         return self._get_hightension()
     def set_hightension(self, ht):
@@ -271,7 +365,7 @@ class ScanningElectronMicroscope:
         return self._get_detector()
     def set_detector(self, detectorId):
         # ToDo: Translate to generic detector type enum
-        return self._set_detector()
+        return self._set_detector(detectorId)
 
     def get_scanmode(self):
         return self._get_scanmode()
@@ -0,0 +1,873 @@
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_ScanMode, ScanningElectronMicroscope_ImageFilterMode
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_NotConnectedException, ScanningElectronMicroscope_CommunicationError
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_SpecimenCurrentDetectorMode, ScanningElectronMicroscope_State
+from xl30serial.xl30commands import XL30_COMMANDS, XL30_DETECTOR_TYPES, XL30_DETECTOR_IDS, build_frame
+from xl30serial.xl30serial import XL30Serial, XL30AcbMonitor
+from xl30serial.xl30errors import XL30TimeoutError, XL30ProtocolError, XL30RetryPolicy, RETRY_RETRY
+from xl30serial.xl30metrics import XL30Metrics
+
+import asyncio
+import serial
+import logging
+import math
+import copy
+
+from time import time, perf_counter, monotonic
+
+# asyncio driver for the XL30 serial console
+#
+# The serial port is opened non blocking and its file descriptor is watched
+# by the event loop (add_reader), so waiting for a response - i.e. for up to
+# 240 seconds during autofocus - does not block the loop or occupy a thread.
+# All commands of XL30Serial are available as coroutines. Every coroutine
+# accepts an optional timeout keyword (seconds) and can be cancelled. Only
+# one request/response transaction is on the wire at any time.
+#
+# Since add_reader is used this requires a selector based event loop on
+# POSIX systems (the default on Linux and the BSDs).
+
+class withtimeout:
+    # Adds an optional timeout keyword argument to a coroutine method
+    def __init__(self, *args, **kwargs):
+        pass
+    def __call__(self, func):
+        async def wrapper(*args, timeout = None, **kwargs):
+            if args[0]._port is None:
+                args[0]._logger.error(f"[XL30] Called {func.__name__} but microscope is not connected")
+                raise ScanningElectronMicroscope_NotConnectedException()
+            if timeout is None:
+                return await func(*args, **kwargs)
+            return await asyncio.wait_for(func(*args, **kwargs), timeout)
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+class AsyncXL30Serial:
+    def __init__(self, port, logger = None, loglevel = "ERROR", timeout = 60, retryCount = 3, retryDelay = 5, resyncLimit = 512, pipelineDepth = 4, retryPolicy = None, metrics = None):
+        loglvls = {
+            "DEBUG"     : logging.DEBUG,
+            "INFO"      : logging.INFO,
+            "WARNING"   : logging.WARNING,
+            "ERROR"     : logging.ERROR,
+            "CRITICAL"  : logging.CRITICAL
+        }
+        if loglevel not in loglvls:
+            raise ValueError(f"Unknown log level {loglevel}")
+
+        if logger is not None:
+            self._logger = logger
+        else:
+            self._logger = logging.getLogger()
+            self._logger.setLevel(loglvls[loglevel])
+
+        self._timeout = timeout
+        self._retryCount = retryCount
+        self._retryDelay = retryDelay
+        # Only the retry count and delays are used, there are no reconnects
+        if retryPolicy is None:
+            retryPolicy = XL30RetryPolicy(retryCount, 0, retryDelay)
+        self._retryPolicy = retryPolicy
+        # Wire level instrumentation (xl30metrics) as for XL30Serial. The
+        # shared _rx_response counts status errors and error responses, so
+        # the attribute has to exist even if disabled
+        if metrics is True:
+            metrics = XL30Metrics()
+        elif metrics is False:
+            metrics = None
+        self._metrics = metrics
+        self._resyncLimit = resyncLimit
+        self._pipelineDepth = pipelineDepth
+
+        # Auto contrast / brightness: last and longest confirmed run and the
+        # time values have to be stable (see XL30AcbMonitor)
+        self._acbExpected = None
+        self._acbMaximum = None
+        self._acbSettle = 1
+
+        self._detectorTypes = XL30_DETECTOR_TYPES
+        self._detectorIds = copy.deepcopy(XL30_DETECTOR_IDS)
+
+        self._rxBuffer = bytearray()
+        self._rxDroppedBytes = 0
+        self._rxWaiter = None
+        self._lock = None
+        self._loop = None
+        self._stale = False
+
+        self._machine_type = None
+        self._machine_serial = None
+
+        if isinstance(port, serial.Serial):
+            self._portName = None
+            self._portObject = port
+        else:
+            self._portName = port
+            self._portObject = None
+        self._port = None
+
+        self._stateFields = {
+            'hightension'   : ( ( "get_hightension_status", "get_hightension" ),  self._parse_hightension ),
+            'spotsize'      : ( ( "get_spotsize", ),                            self._parse_spotsize ),
+            'magnification' : ( ( "get_magnification", ),                       self._parse_magnification ),
+            'detector'      : ( ( "get_detector", ),                            self._parse_detector ),
+            'scanmode'      : ( ( "get_scanmode", ),                            self._parse_scanmode ),
+            'contrast'      : ( ( "get_contrast", ),                            self._parse_contrast ),
+            'brightness'    : ( ( "get_brightness", ),                          self._parse_brightness ),
+            'stage'         : ( ( "get_stage_position", ),                      self._parse_stage_position ),
+            'beamshift'     : ( ( "get_beamshift", ),                           self._parse_beamshift ),
+            'imagefilter'   : ( ( "get_imagefilter_mode", ),                    self._parse_imagefilter_mode ),
+            'linetime'      : ( ( "get_linetime", ),                            self._parse_linetime ),
+            'linesperframe' : ( ( "get_linesperframe", ),                       self._parse_linesperframe )
+        }
+
+    # Response decoding is shared with the blocking driver
+
+    _rx_response = XL30Serial._rx_response
+    _parse_hightension = XL30Serial._parse_hightension
+    _parse_spotsize = XL30Serial._parse_spotsize
+    _parse_magnification = XL30Serial._parse_magnification
+    _parse_detector = XL30Serial._parse_detector
+    _detector_info = XL30Serial._detector_info
+    _parse_linetime = XL30Serial._parse_linetime
+    _parse_linesperframe = XL30Serial._parse_linesperframe
+    _parse_scanmode = XL30Serial._parse_scanmode
+    _parse_contrast = XL30Serial._parse_contrast
+    _parse_brightness = XL30Serial._parse_brightness
+    _parse_stage_position = XL30Serial._parse_stage_position
+    _parse_beamshift = XL30Serial._parse_beamshift
+    _parse_imagefilter_mode = XL30Serial._parse_imagefilter_mode
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def connect(self):
+        if self._port is not None:
+            return True
+
+        self._loop = asyncio.get_running_loop()
+        self._lock = asyncio.Lock()
+
+        if self._portObject is not None:
+            self._port = self._portObject
+            self._port.timeout = 0
+        else:
+            self._logger.debug(f"[XL30] Connecting to XL30 on serial port {self._portName}")
+            self._port = serial.Serial(
+                    self._portName,
+                    baudrate = 9600,
+                    bytesize = serial.EIGHTBITS,
+                    parity = serial.PARITY_NONE,
+                    stopbits = serial.STOPBITS_ONE,
+                    timeout = 0
+            )
+        self._rxBuffer.clear()
+        self._port.reset_input_buffer()
+        self._loop.add_reader(self._port.fileno(), self._on_readable)
+
+        mid = await self.get_id()
+        self._machine_type = mid['type']
+        self._machine_serial = mid['serial']
+        return True
+
+    async def close(self):
+        if self._port is None:
+            return
+        self._logger.debug("[XL30] Closing serial port")
+        self._loop.remove_reader(self._port.fileno())
+        if self._portObject is None:
+            self._port.close()
+        self._port = None
+        self._rxBuffer.clear()
+        self._wake(ScanningElectronMicroscope_NotConnectedException())
+
+    def get_metrics(self):
+        # Snapshot of the wire metrics or None if instrumentation is disabled
+        if self._metrics is None:
+            return None
+        return self._metrics.stats()
+
+    # Receive path (called by the event loop)
+
+    def _on_readable(self):
+        try:
+            data = self._port.read(max(1, self._port.in_waiting))
+        except Exception as e:
+            self._logger.error(f"[XL30] Failed to read from serial port: {e}")
+            self._loop.remove_reader(self._port.fileno())
+            self._wake(ScanningElectronMicroscope_CommunicationError(f"Failed to read from serial port: {e}"))
+            return
+        if data:
+            self._rxBuffer += data
+            if self._metrics is not None:
+                self._metrics.inc('rx_bytes', len(data))
+            self._wake()
+
+    def _wake(self, exc = None):
+        if (self._rxWaiter is not None) and not self._rxWaiter.done():
+            if exc is not None:
+                self._rxWaiter.set_exception(exc)
+            else:
+                self._rxWaiter.set_result(None)
+
+    def _rx_parse(self):
+        # Extracts the next valid frame from the receive buffer (or returns
+        # None if there is no complete frame yet). Garbage before the frame
+        # start and frames with invalid length or checksum are skipped
+        buf = self._rxBuffer
+        dropped = 0
+        msg = None
+        while True:
+            idx = buf.find(0x05)
+            if idx < 0:
+                dropped = dropped + len(buf)
+                buf.clear()
+                break
+            if idx > 0:
+                dropped = dropped + idx
+                del buf[:idx]
+            if len(buf) < 2:
+                break
+            msgLen = buf[1]
+            if msgLen < 5:
+                dropped = dropped + 1
+                del buf[:1]
+                continue
+            if len(buf) < msgLen:
+                break
+            if (sum(buf[:msgLen - 1]) & 0xFF) != buf[msgLen - 1]:
+                dropped = dropped + 1
+                del buf[:1]
+                continue
+            msg = bytes(buf[:msgLen])
+            del buf[:msgLen]
+            break
+
+        if dropped > 0:
+            self._rxDroppedBytes = self._rxDroppedBytes + dropped
+            if self._metrics is not None:
+                self._metrics.inc('rx_dropped_bytes', dropped)
+            self._logger.warning(f"[XL30] Dropped {dropped} bytes while resynchronizing")
+            # A frame found behind the garbage means resynchronization worked
+            if (msg is None) and (dropped > self._resyncLimit):
+                raise XL30ProtocolError(f"Failed to resynchronize after {dropped} bytes")
+        return msg
+
+    async def _rx_frame(self):
+        while True:
+            msg = self._rx_parse()
+            if msg is not None:
+                return msg
+            self._rxWaiter = self._loop.create_future()
+            try:
+                await self._rxWaiter
+            finally:
+                self._rxWaiter = None
+
+    async def _rx_expect(self, opcode):
+        # Waits for the response with the given opcode. Late responses to
+        # cancelled or timed out requests are discarded
+        while True:
+            msg = await self._rx_frame()
+            if msg[2] == opcode:
+                return msg
+            self._logger.warning(f"[XL30] Discarding unexpected response with opcode {msg[2]}")
+
+    def _frame_tx(self, msg):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"[XL30] TX: {msg}")
+        self._port.write(msg)
+        if self._metrics is not None:
+            self._metrics.inc('tx_bytes', len(msg))
+
+    def _frame_for(self, cmd, args, payload):
+        if payload is not None:
+            return build_frame(cmd.opcode, payload)
+        if cmd.frame is not None:
+            return cmd.frame
+        return build_frame(cmd.opcode, cmd.encode(*args))
+
+    async def _command(self, name, *args, payload = None, timeout = None):
+        # Executes a single command from the command table. The transaction
+        # holds the port lock. On timeout idempotent commands are repeated as
+        # decided by the retry policy (reconnects are not supported)
+        if self._port is None:
+            raise ScanningElectronMicroscope_NotConnectedException()
+        cmd = XL30_COMMANDS[name]
+        frame = self._frame_for(cmd, args, payload)
+        if timeout is None:
+            timeout = cmd.timeout if cmd.timeout is not None else self._timeout
+
+        retries = 0
+        while True:
+            async with self._lock:
+                if self._stale:
+                    # A previous transaction has been abandoned, its response
+                    # may still be in the buffer
+                    self._rxBuffer.clear()
+                    self._stale = False
+                t0 = perf_counter()
+                self._frame_tx(frame)
+                try:
+                    msg = await asyncio.wait_for(self._rx_expect(cmd.opcode), timeout)
+                    if self._metrics is not None:
+                        self._metrics.observe(cmd.opcode, perf_counter() - t0)
+                except asyncio.TimeoutError:
+                    self._stale = True
+                    msg = None
+                except BaseException:
+                    self._stale = True
+                    raise
+            if msg is not None:
+                return self._rx_response(msg, cmd.response)
+
+            self._logger.error(f"[XL30] Timeout while waiting for response to {name}")
+            if self._metrics is not None:
+                self._metrics.timeout(cmd.opcode)
+            exc = XL30TimeoutError(f"Timeout while waiting for response to {name}")
+            action, delay = self._retryPolicy.decide(exc, retries, 0, cmd.idempotent)
+            if action != RETRY_RETRY:
+                raise exc
+            retries = retries + 1
+            if self._metrics is not None:
+                self._metrics.inc('retries')
+            self._logger.warning(f"[XL30] Retrying {name} in {delay:.2f} s")
+            await asyncio.sleep(delay)
+
+    async def _pipelined(self, names):
+        # Executes independent read-only commands. Up to pipelineDepth requests
+        # are sent back to back, responses are matched by opcode in order. If
+        # a response is missing the remaining requests are executed one by one
+        results = [ None ] * len(names)
+        pos = 0
+        while pos < len(names):
+            window = names[pos : pos + self._pipelineDepth]
+            cmds = [ XL30_COMMANDS[n] for n in window ]
+            for cmd in cmds:
+                if not cmd.readonly:
+                    raise ValueError(f"Command {cmd.name} cannot be pipelined")
+            received = 0
+            async with self._lock:
+                if self._stale:
+                    self._rxBuffer.clear()
+                    self._stale = False
+                self._frame_tx(b''.join([ cmd.frame for cmd in cmds ]))
+                try:
+                    for cmd in cmds:
+                        msg = await asyncio.wait_for(self._rx_frame(), self._timeout)
+                        if msg[2] != cmd.opcode:
+                            break
+                        results[pos + received] = self._rx_response(msg, cmd.response)
+                        received = received + 1
+                except asyncio.TimeoutError:
+                    pass
+                except BaseException:
+                    self._stale = True
+                    raise
+                if received < len(cmds):
+                    self._stale = True
+            pos = pos + received
+            if received < len(cmds):
+                self._logger.warning(f"[XL30] Pipeline received {received} of {len(cmds)} responses, continuing sequentially")
+                self._pipelineDepth = 1
+                results[pos] = await self._command(names[pos])
+                pos = pos + 1
+        return results
+
+    # Commands
+
+    @withtimeout()
+    async def get_id(self):
+        resp = await self._command("get_id")
+        knownTypes = {
+            2 : "XL20",
+            3 : "XL30",
+            4 : "XL40"
+        }
+        if resp['data'][0] not in knownTypes:
+            self._logger.error(f"[XL30] Unknown response to ID request: {resp}")
+            raise ScanningElectronMicroscope_CommunicationError(f"Unknown response to ID request: {resp}")
+        return {
+            'type' : knownTypes[resp['data'][0]],
+            'serial' : resp['data'][1]
+        }
+
+    @withtimeout()
+    async def get_state(self, fields = None):
+        if fields is None:
+            fields = ScanningElectronMicroscope_State.FIELDS
+        fields = list(dict.fromkeys(fields))
+
+        names = []
+        for f in fields:
+            if f not in self._stateFields:
+                raise ValueError(f"Unknown state field {f}")
+            names.extend(self._stateFields[f][0])
+
+        timestamp = time()
+        tStart = perf_counter()
+        resps = await self._pipelined(names)
+
+        values = { }
+        idx = 0
+        for f in fields:
+            cmds, parser = self._stateFields[f]
+            values[f] = parser(*resps[idx : idx + len(cmds)])
+            idx = idx + len(cmds)
+        return ScanningElectronMicroscope_State(values, None, timestamp = timestamp, duration = perf_counter() - tStart)
+
+    @withtimeout()
+    async def get_hightension(self):
+        resp = await self._command("get_hightension_status")
+        if resp['data'][0] == 0:
+            return self._parse_hightension(resp, None)
+        return self._parse_hightension(resp, await self._command("get_hightension"))
+
+    @withtimeout()
+    async def set_hightension(self, voltage):
+        if ((voltage < 200) or (voltage > 30000)) and (voltage != 0):
+            raise ValueError("High tension voltage has to be in range 200V-30kV")
+
+        if voltage == 0:
+            self._logger.info("[XL30] Disabling high tension")
+            resp = await self._command("set_hightension_status", 0)
+            if resp['error']:
+                self._logger.error(f"[XL30] Failed to disable high tension. Error code {resp['errorcode']}")
+                return False
+            return True
+
+        self._logger.info("[XL30] Enabling high tension")
+        resp = await self._command("set_hightension_status", 1)
+        if resp['error']:
+            self._logger.error(f"[XL30] Enabling high tension failed. Error code {resp['errorcode']}")
+            return False
+
+        self._logger.info(f"[XL30] Setting high tension to {voltage}")
+        resp = await self._command("set_hightension", float(voltage))
+        if resp['error']:
+            self._logger.error(f"[XL30] Setting high tension failed. Error code {resp['errorcode']}")
+            await self.set_hightension(0)
+            return False
+
+        # Wait till ramp up (without blocking the event loop). As for
+        # XL30HighTensionRamp high tension is known to be enabled so only the
+        # voltage is polled, with a growing interval
+        async def reached():
+            resp = await self._command("get_hightension")
+            if resp['error']:
+                self._logger.error(f"[XL30] Failed to query high tension. Error code {resp['errorcode']}")
+                return False
+            ht = resp['data'][0]
+            if abs(ht - voltage) < 100:
+                return True
+            self._logger.info(f"[XL30] Waiting for high tension to reach {voltage}V, currently at {ht}")
+            return False
+
+        if await self.wait_until(reached, timeout = 90, interval = 0.5, maxInterval = 2, backoff = 1.2):
+            return True
+
+        self._logger.error("[XL30] Failed to set high tension in 90 seconds")
+        raise XL30TimeoutError("Failed to set high tension in 90 seconds")
+
+    async def wait_until(self, predicate, timeout = None, expected = None, interval = 0.5, maxInterval = 5, backoff = 1.5, onDone = None, onTimeout = None):
+        # Coroutine version of XL30Serial.wait_until, predicate is awaited.
+        # Returns its value once true or False after the timeout in seconds
+        tStart = monotonic()
+        while True:
+            value = await predicate()
+            elapsed = monotonic() - tStart
+            if value:
+                self._logger.debug(f"[XL30] Wait condition met after {elapsed:.2f} s")
+                if onDone is not None:
+                    onDone(value, elapsed)
+                return value
+            if (timeout is not None) and (elapsed >= timeout):
+                self._logger.warning(f"[XL30] Wait condition not met within {timeout} s")
+                if onTimeout is not None:
+                    onTimeout(elapsed)
+                return False
+
+            if (expected is not None) and (elapsed < expected):
+                delay = max(interval, (expected - elapsed) / 2)
+            else:
+                delay = interval
+                interval = min(interval * backoff, maxInterval)
+            if timeout is not None:
+                delay = min(delay, timeout - elapsed)
+            await asyncio.sleep(delay)
+
+    async def _simple(self, name, *args, errmsg = None):
+        resp = await self._command(name, *args)
+        if resp['error']:
+            self._logger.error(f"[XL30] {errmsg} (error code {resp['errorcode']})")
+            return False
+        return True
+
+    @withtimeout()
+    async def vent(self, stop = False):
+        if stop:
+            return await self._simple("set_vacuum", 2, errmsg = "Failed to stop venting")
+        return await self._simple("set_vacuum", 1, errmsg = "Failed to execute venting command")
+
+    @withtimeout()
+    async def pump(self):
+        return await self._simple("set_vacuum", 0, errmsg = "Failed to start pumping")
+
+    @withtimeout()
+    async def get_spotsize(self):
+        return self._parse_spotsize(await self._command("get_spotsize"))
+
+    @withtimeout()
+    async def set_spotsize(self, spotsize):
+        if (spotsize < 1.0) or (spotsize > 10.0):
+            raise ValueError("Valid spotsizes (probe currents) in the range of 1.0 to 10.0")
+        return await self._simple("set_spotsize", float(spotsize), errmsg = f"Failed to set spotsize to {spotsize}")
+
+    @withtimeout()
+    async def get_magnification(self):
+        return self._parse_magnification(await self._command("get_magnification"))
+
+    @withtimeout()
+    async def set_magnification(self, magnification):
+        if (magnification < 20) or (magnification > 4e5):
+            raise ValueError("Valid magnification values range from 20 to 400000")
+        return await self._simple("set_magnification", float(magnification), errmsg = "Failed to set magnification")
+
+    @withtimeout()
+    async def get_stigmator(self):
+        resp = await self._command("get_stigmator")
+        if resp['error']:
+            self._logger.error("[XL30] Failed to read stigmator setting")
+            return None, None
+        return (resp['data'][0], resp['data'][1])
+
+    @withtimeout()
+    async def set_stigmator(self, x = None, y = None):
+        if (x is None) and (y is None):
+            return True
+        if (x is None) or (y is None):
+            oldx, oldy = await self.get_stigmator()
+            if oldx is None:
+                return False
+            if x is None:
+                x = oldx
+            if y is None:
+                y = oldy
+        return await self._simple("set_stigmator", x, y, errmsg = f"Failed to set stigmator setting to {x} and {y}")
+
+    @withtimeout()
+    async def get_detector(self):
+        return self._parse_detector(await self._command("get_detector"))
+
+    @withtimeout()
+    async def set_detector(self, detectorId):
+        if detectorId not in self._detectorIds:
+            raise ValueError(f"Unknown detector {detectorId}")
+        return await self._simple("set_detector", detectorId, self._detectorIds[detectorId]['type'], errmsg = f"Failed to set detector to {detectorId}")
+
+    @withtimeout()
+    async def get_linetime(self):
+        return self._parse_linetime(await self._command("get_linetime"))
+
+    @withtimeout()
+    async def set_linetime(self, lt):
+        supportedLts = { 1.25 : 0, 1.87 : 1, 3.43 : 2, 6.86 : 3, 20.0 : 4, 40.0 : 5, 60.0 : 6, 120.0 : 7, 240.0 : 8, 360.0 : 9, 1020.0 : 10, "TV" : 100 }
+        if lt not in supportedLts:
+            raise ValueError(f"Unsupported line time {lt} ms, only supporting {list(supportedLts)}")
+        return await self._simple("set_linetime", supportedLts[lt], errmsg = f"Failed to set line time {lt} ms")
+
+    @withtimeout()
+    async def get_linesperframe(self):
+        return self._parse_linesperframe(await self._command("get_linesperframe"))
+
+    @withtimeout()
+    async def set_linesperframe(self, lines):
+        supportedLines = { 121 : 0, 242 : 1, 484 : 2, 968 : 3, 1452 : 4, 1936 : 5, 2420 : 6, 2904 : 7, 3388 : 8, 3872 : 9, 180 : 10, 360 : 11, 720 : 12, "TV" : 100 }
+        if lines not in supportedLines:
+            raise ValueError(f"Unsupported number of lines {lines}, supporting only {list(supportedLines)}")
+        return await self._simple("set_linesperframe", supportedLines[lines], errmsg = f"Failed to set number of lines to {lines}")
+
+    @withtimeout()
+    async def get_scanmode(self):
+        return self._parse_scanmode(await self._command("get_scanmode"))
+
+    @withtimeout()
+    async def set_scanmode(self, mode):
+        if not isinstance(mode, ScanningElectronMicroscope_ScanMode):
+            raise ValueError("Scan mode has to be a ScanningElectronMicroscope_ScanMode")
+        return await self._simple("set_scanmode", mode.value, errmsg = f"Failed to set scan mode to {mode}")
+
+    @withtimeout()
+    async def make_photo(self):
+        return await self._simple("make_photo", errmsg = "Failed to make photo")
+
+    @withtimeout()
+    async def write_tiff_image(self, fname, printmagnification = False, graphicsbitplane = False, databar = True, overwrite = False):
+        fnamebin = fname.encode('ascii') + bytes([0])
+        while len(fnamebin) % 4 != 0:
+            fnamebin = fnamebin + bytes([0])
+
+        flagbyteL = 0
+        flagbyteH = 0
+        if printmagnification:
+            flagbyteH = flagbyteH | 0x80
+        if graphicsbitplane:
+            flagbyteH = flagbyteH | 0x40
+        if databar:
+            flagbyteH = flagbyteH | 0x20
+        if overwrite:
+            flagbyteL = flagbyteL | 0x10
+
+        return await self._command("write_tiff_image", payload = bytes([flagbyteL, flagbyteH, 0, 0]) + fnamebin)
+
+    @withtimeout()
+    async def get_contrast(self):
+        return self._parse_contrast(await self._command("get_contrast"))
+
+    @withtimeout()
+    async def set_contrast(self, contrast):
+        if (contrast < 0) or (contrast > 100):
+            raise ValueError("Contrast has to be in range 0 to 100")
+        return await self._simple("set_contrast", contrast, errmsg = "Failed to set contrast")
+
+    @withtimeout()
+    async def get_brightness(self):
+        return self._parse_brightness(await self._command("get_brightness"))
+
+    @withtimeout()
+    async def set_brightness(self, brightness):
+        if (brightness < 0) or (brightness > 100):
+            raise ValueError("Brightness has to be in range 0 to 100")
+        return await self._simple("set_brightness", brightness, errmsg = "Failed to set brightness")
+
+    @withtimeout()
+    async def auto_contrastbrightness(self):
+        if not await self._simple("auto_contrastbrightness", errmsg = "Auto contrast and brightness did not execute"):
+            return False
+        # ACB runs on the console after the acknowledge, completion is
+        # detected as for XL30Serial. 30 seconds are the worst case
+        monitor = XL30AcbMonitor(self._acbSettle, self._acbMaximum)
+        async def acbSettled():
+            resps = await self._pipelined([ "get_contrast", "get_brightness" ])
+            return monitor.update(( self._parse_contrast(resps[0]), self._parse_brightness(resps[1]) ))
+        def acbDone(value, elapsed):
+            if monitor.changed:
+                self._acbExpected = monitor.duration
+                self._acbMaximum = max(monitor.duration, self._acbMaximum or 0)
+
+        await self.wait_until(acbSettled, timeout = 30, expected = self._acbExpected, interval = 0.5, maxInterval = 2, onDone = acbDone)
+        return True
+
+    @withtimeout()
+    async def auto_focus(self):
+        return await self._simple("auto_focus", errmsg = "Auto focus did not execute")
+
+    @withtimeout()
+    async def get_databar_text(self):
+        resp = await self._command("get_databar_text")
+        return (resp['payload'][4:]).decode('ascii')
+
+    @withtimeout()
+    async def set_databar_text(self, newtext):
+        if len(newtext) > 39:
+            raise ValueError("Can only show up to 40 characters in data bar")
+        txtbin = bytes([0,0,0,0]) + newtext.encode('ascii') + bytes([0])
+        while len(txtbin) % 4 != 0:
+            txtbin += bytes([0])
+        resp = await self._command("set_databar_text", payload = txtbin)
+        if resp['error']:
+            self._logger.error("[XL30] Failed to set databar text")
+            return False
+        return True
+
+    @withtimeout()
+    async def stage_home(self):
+        return await self._simple("stage_home", errmsg = "Homing failed")
+
+    @withtimeout()
+    async def get_stage_position(self):
+        return self._parse_stage_position(await self._command("get_stage_position"))
+
+    @withtimeout()
+    async def set_stage_position(self, x = None, y = None, z = None, tilt = None, rot = None):
+        if (x is not None) or (y is not None):
+            if (x is None) or (y is None):
+                currentPosition = await self.get_stage_position()
+                if currentPosition is None:
+                    return False
+                if x is None:
+                    x = currentPosition['x']
+                if y is None:
+                    y = currentPosition['y']
+            if not await self._simple("set_stage_xy", x, y, errmsg = f"Failed moving to x:{x}mm, y:{y}mm"):
+                return False
+        if rot is not None:
+            if not await self._simple("set_stage_rotation", rot, errmsg = f"Failed to rotate to {rot} deg"):
+                return False
+        if z is not None:
+            if not await self._simple("set_stage_z", z, errmsg = f"Failed to set z position to {z} mm"):
+                return False
+        if tilt is not None:
+            if not await self._simple("set_stage_tilt", tilt, errmsg = f"Failed to set tilt position to {tilt} deg"):
+                return False
+        return True
+
+    @withtimeout()
+    async def get_beamshift(self):
+        return self._parse_beamshift(await self._command("get_beamshift"))
+
+    @withtimeout()
+    async def set_beamshift(self, x = None, y = None):
+        if (x is None) and (y is None):
+            return True
+        if (x is None) or (y is None):
+            currentPos = await self.get_beamshift()
+            if currentPos is None:
+                return False
+            if x is None:
+                x = currentPos['x']
+            if y is None:
+                y = currentPos['y']
+        return await self._simple("set_beamshift", x, y, errmsg = "Failed to set beamshift")
+
+    @withtimeout()
+    async def get_scanrotation(self):
+        resp = await self._command("get_scanrotation")
+        if resp['error']:
+            self._logger.error("[XL30] Failed to query scan rotation")
+            return None
+        return resp['data'][0]
+
+    @withtimeout()
+    async def set_scanrotation(self, rot):
+        rot = float(rot)
+        if (rot < -90) or (rot > 90):
+            raise ValueError("Scan rotation has to be in range +- 90 deg")
+        return await self._simple("set_scanrotation", rot, errmsg = "Failed to set scan rotation")
+
+    @withtimeout()
+    async def get_area_or_dot_shift(self):
+        resps = await self._pipelined([ "get_area_or_dot_shift_x", "get_area_or_dot_shift_y" ])
+        if resps[0]['error'] or resps[1]['error']:
+            self._logger.error("[XL30] Failed to query SA/dot shift")
+            return None
+        return (resps[0]['data'][0], resps[1]['data'][0])
+
+    @withtimeout()
+    async def set_area_or_dot_shift(self, xshift = None, yshift = None):
+        if isinstance(xshift, (list, tuple)):
+            if (len(xshift) != 2) or (yshift is not None):
+                raise ValueError("xshift and yshift have to be specied as float or first argument has to be a 2-tuple or 2-list")
+            xshift, yshift = xshift
+        for v in (xshift, yshift):
+            if (v is not None) and ((float(v) < -100) or (float(v) > 100)):
+                raise ValueError("Shift has to be in range [-100...100%]")
+        if xshift is not None:
+            if not await self._simple("set_area_or_dot_shift_x", float(xshift), errmsg = "Failed to set X shift"):
+                return False
+        if yshift is not None:
+            if not await self._simple("set_area_or_dot_shift_y", float(yshift), errmsg = "Failed to set Y shift"):
+                return False
+        return True
+
+    @withtimeout()
+    async def get_selected_area_size(self):
+        resps = await self._pipelined([ "get_selected_area_size_x", "get_selected_area_size_y" ])
+        if resps[0]['error'] or resps[1]['error']:
+            self._logger.error("[XL30] Failed to query selected area size")
+            return None
+        return (resps[0]['data'][0], resps[1]['data'][0])
+
+    @withtimeout()
+    async def set_selected_area_size(self, sizex = None, sizey = None):
+        if isinstance(sizex, (list, tuple)):
+            if len(sizex) != 2:
+                raise ValueError("Either supply two floats or a 2-list or 2-tuple as first argument")
+            sizex, sizey = sizex
+        for v in (sizex, sizey):
+            if (v is not None) and ((float(v) < 0) or (float(v) > 100)):
+                raise ValueError(f"Size is out of range from [0...100%] (requested {v})")
+        if sizex is not None:
+            if not await self._simple("set_selected_area_size_x", float(sizex), errmsg = "Failed to set selected area X"):
+                return False
+        if sizey is not None:
+            if not await self._simple("set_selected_area_size_y", float(sizey), errmsg = "Failed to set selected area Y"):
+                return False
+        return True
+
+    @withtimeout()
+    async def get_imagefilter_mode(self):
+        return self._parse_imagefilter_mode(await self._command("get_imagefilter_mode"))
+
+    @withtimeout()
+    async def set_imagefilter_mode(self, filtermode, frames):
+        if frames < 1:
+            raise ValueError("At least one frame has to be gathered")
+        if math.ceil(math.log2(frames)) != math.floor(math.log2(frames)):
+            raise ValueError("Frame count has to be a power of two")
+        if int(math.log2(frames)) > 255:
+            raise ValueError("Frame count exceedes 2**255")
+        if not isinstance(filtermode, ScanningElectronMicroscope_ImageFilterMode):
+            raise ValueError("Filter mode has to be a ScanningElectronMicroscope_ImageFilterMode instance")
+        return await self._simple("set_imagefilter_mode", filtermode.value, int(math.log2(frames)), errmsg = f"Failed to set filter mode {filtermode} with {frames} frames")
+
+    @withtimeout()
+    async def get_specimen_current_detector_mode(self):
+        resp = await self._command("get_specimen_current_detector_mode")
+        if resp['error']:
+            self._logger.error("[XL30] Failed to query specimen current detector mode")
+            return None
+        try:
+            return [ ScanningElectronMicroscope_SpecimenCurrentDetectorMode.TOUCH_ALARM, ScanningElectronMicroscope_SpecimenCurrentDetectorMode.IMAGING, ScanningElectronMicroscope_SpecimenCurrentDetectorMode.MEASURING ][resp['data'][0]]
+        except IndexError:
+            self._logger.error(f"[XL30] Received unknown specimen current detector mode {resp['data'][0]}")
+            return None
+
+    @withtimeout()
+    async def set_specimen_current_detector_mode(self, mode):
+        knownModes = {
+            ScanningElectronMicroscope_SpecimenCurrentDetectorMode.TOUCH_ALARM : 0,
+            ScanningElectronMicroscope_SpecimenCurrentDetectorMode.IMAGING : 1,
+            ScanningElectronMicroscope_SpecimenCurrentDetectorMode.MEASURING : 2
+        }
+        if mode not in knownModes:
+            raise ValueError(f"Mode has to be a ScanningElectronMicroscope_SpecimenCurrentDetectorMode, is {mode}")
+        return await self._simple("set_specimen_current_detector_mode", knownModes[mode], errmsg = "Failed to set specimen current detector mode")
+
+    @withtimeout()
+    async def get_specimen_current(self):
+        resp = await self._command("get_specimen_current")
+        if resp['error']:
+            self._logger.error(f"[XL30] Failed to query specimen current (errorcode: {resp['errorcode']})")
+            return None
+        return resp['data'][0]
+
+    @withtimeout()
+    async def is_beam_blanked(self):
+        resp = await self._command("is_beam_blanked")
+        if resp['error']:
+            self._logger.error("[XL30] Failed to query beam blanking")
+            return None
+        return resp['data'][0] != 0
+
+    @withtimeout()
+    async def blank(self):
+        return await self._simple("set_beam_blanked", 1, errmsg = "Failed to blank beam")
+
+    @withtimeout()
+    async def unblank(self):
+        return await self._simple("set_beam_blanked", 0, errmsg = "Failed to unblank beam")
+
+    @withtimeout()
+    async def oplock(self, lock = True):
+        return await self._simple("set_oplock", 1 if lock else 0, errmsg = "Failed to lock/unlock the system")
+
+    @withtimeout()
+    async def is_oplocked(self):
+        resp = await self._command("is_oplocked")
+        if resp['error']:
+            self._logger.error("[XL30] Failed to query lock state")
+            return None
+        return resp['data'][0] != 0
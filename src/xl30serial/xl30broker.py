@@ -0,0 +1,417 @@
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope, ScanningElectronMicroscope_State
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_ScanMode, ScanningElectronMicroscope_ImageFilterMode, ScanningElectronMicroscope_SpecimenCurrentDetectorMode
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_NotConnectedException, ScanningElectronMicroscope_CommunicationError
+from xl30serial.xl30errors import XL30TimeoutError, XL30ChecksumError, XL30ProtocolError, XL30PortError, XL30DeviceError, XL30UnsupportedCommandError
+
+import argparse
+import collections
+import inspect
+import itertools
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+
+from enum import Enum
+from time import monotonic
+from types import MappingProxyType
+
+# Broker daemon sharing a single XL30Serial connection between processes
+#
+# The broker owns the (connected) XL30Serial instance and serves clients on a
+# Unix domain socket. Messages are length prefixed ('<I') UTF-8 JSON:
+#
+#   request     { "id" : n, "m" : method, "a" : [ args ], "k" : { kwargs } }
+#   response    { "id" : n, "r" : result } or { "id" : n, "e" : [ type, message ] }
+#
+# Methods are the ones of the ScanningElectronMicroscope interface (public
+# get_* / set_* ... as well as the underscore variants). Enums, tuples, state
+# snapshots and dictionaries with non string keys are tagged so they survive
+# the round trip.
+#
+# Every client has its own queue. A single worker executes the requests round
+# robin over all clients so a busy acquisition script cannot starve a
+# dashboard. Identical read-only requests (get_* / is_*) that are waiting at
+# the head of other queues are answered with the same result, and results of
+# read-only requests are served from a cache for cacheTimeout seconds. Every
+# other request invalidates the cache.
+#
+# Run as python -m xl30serial.xl30broker --port /dev/ttyU0 to start a broker.
+# By default the socket is created in $XDG_RUNTIME_DIR or, if that is not set,
+# in a private (0700) per user directory below the temporary directory.
+
+XL30_BROKER_SOCKET = "xl30broker.sock"
+
+def xl30_broker_socket(create = False):
+    runtimeDir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtimeDir:
+        return os.path.join(runtimeDir, XL30_BROKER_SOCKET)
+
+    privateDir = os.path.join(tempfile.gettempdir(), f"xl30broker-{os.getuid()}")
+    if create:
+        try:
+            os.mkdir(privateDir, 0o700)
+        except FileExistsError:
+            pass
+    if os.path.exists(privateDir):
+        # Never use a directory somebody else could have prepared
+        st = os.lstat(privateDir)
+        if (not stat.S_ISDIR(st.st_mode)) or (st.st_uid != os.getuid()) or (stat.S_IMODE(st.st_mode) & 0o077):
+            raise ValueError(f"Insecure broker socket directory {privateDir}")
+    return os.path.join(privateDir, XL30_BROKER_SOCKET)
+
+_brokerLength = struct.Struct("<I")
+_brokerMaxMessage = 1024 * 1024
+
+_brokerEnums = {
+    e.__name__ : e for e in ( ScanningElectronMicroscope_ScanMode, ScanningElectronMicroscope_ImageFilterMode, ScanningElectronMicroscope_SpecimenCurrentDetectorMode )
+}
+
+_brokerExceptions = {
+    e.__name__ : e for e in (
+        ValueError, TypeError, ScanningElectronMicroscope_NotConnectedException, ScanningElectronMicroscope_CommunicationError,
+        XL30TimeoutError, XL30ChecksumError, XL30ProtocolError, XL30PortError, XL30DeviceError, XL30UnsupportedCommandError
+    )
+}
+
+# Methods of the microscope interface that may be called through the broker
+XL30_BROKER_METHODS = frozenset([
+    name for name, fn in inspect.getmembers(ScanningElectronMicroscope, inspect.isfunction)
+    if (not name.startswith("__")) and (name not in ( "_connect", "_disconnect", "_close" ))
+])
+
+def _readonly(method):
+    return method.lstrip("_").startswith(( "get_", "is_" ))
+
+def _encode(value):
+    if isinstance(value, Enum):
+        return { "__enum__" : type(value).__name__, "value" : value.value }
+    if isinstance(value, ScanningElectronMicroscope_State):
+        return { "__state__" : _encode(dict(value.mapping)), "timings" : dict(value.timings), "timestamp" : value.timestamp, "duration" : value.duration }
+    if isinstance(value, tuple):
+        return { "__tuple__" : [ _encode(v) for v in value ] }
+    if isinstance(value, list):
+        return [ _encode(v) for v in value ]
+    if isinstance(value, (dict, MappingProxyType)):
+        if all([ isinstance(k, str) for k in value ]):
+            return { k : _encode(v) for k, v in value.items() }
+        return { "__dict__" : [ [ _encode(k), _encode(v) ] for k, v in value.items() ] }
+    return value
+
+def _decode(value):
+    if isinstance(value, list):
+        return [ _decode(v) for v in value ]
+    if not isinstance(value, dict):
+        return value
+    if "__enum__" in value:
+        return _brokerEnums[value["__enum__"]](value["value"])
+    if "__state__" in value:
+        return ScanningElectronMicroscope_State(_decode(value["__state__"]), value["timings"], value["timestamp"], value["duration"])
+    if "__tuple__" in value:
+        return tuple([ _decode(v) for v in value["__tuple__"] ])
+    if "__dict__" in value:
+        return { _decode(k) : _decode(v) for k, v in value["__dict__"] }
+    return { k : _decode(v) for k, v in value.items() }
+
+def _send(sock, msg):
+    data = json.dumps(msg, separators = ( ",", ":" )).encode("utf-8")
+    sock.sendall(_brokerLength.pack(len(data)) + data)
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+def _recv(sock):
+    hdr = _recv_exact(sock, _brokerLength.size)
+    if hdr is None:
+        return None
+    n = _brokerLength.unpack(hdr)[0]
+    if n > _brokerMaxMessage:
+        raise ValueError(f"Broker message of {n} bytes exceeds limit")
+    data = _recv_exact(sock, n)
+    if data is None:
+        return None
+    return json.loads(data.decode("utf-8"))
+
+class _BrokerClientConnection:
+    def __init__(self, sock, cid):
+        self.sock = sock
+        self.cid = cid
+        self.pending = collections.deque()
+        self.sendLock = threading.Lock()
+        self.closed = False
+
+    def reply(self, msg):
+        try:
+            with self.sendLock:
+                _send(self.sock, msg)
+        except OSError:
+            self.closed = True
+
+class XL30Broker:
+    def __init__(self, xl, path = None, cacheTimeout = 1, mode = 0o660):
+        self._xl = xl
+        self._logger = xl._logger
+        self._path = path if path is not None else xl30_broker_socket(create = True)
+        self._mode = mode
+        self._cacheTimeout = cacheTimeout
+
+        # Response cache for read-only requests (key -> ( response, timestamp ))
+        self._cache = { }
+
+        self._clients = [ ]
+        self._next = 0
+        self._cids = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._sock = None
+        self._threads = [ ]
+
+        self.requests = 0
+        self.executed = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if os.path.exists(self._path):
+            # Remove stale sockets but refuse to hijack a running broker
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self._path)
+                probe.close()
+                raise ValueError(f"Broker already running on {self._path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self._path)
+            finally:
+                probe.close()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Restrictive umask so the socket is never accessible with wider
+        # permissions than requested, not even between bind and chmod
+        umask = os.umask(0o777 & ~self._mode)
+        try:
+            self._sock.bind(self._path)
+        finally:
+            os.umask(umask)
+        os.chmod(self._path, self._mode)
+        self._sock.listen(16)
+
+        for target, name in [ ( self._accept, "XL30BrokerAccept" ), ( self._worker, "XL30BrokerWorker" ) ]:
+            t = threading.Thread(target = target, name = name, daemon = True)
+            t.start()
+            self._threads.append(t)
+        self._logger.info(f"[XL30] Broker listening on {self._path}")
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self._threads[1].join()
+        finally:
+            self.close()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        try:
+            # Wakes up the blocking accept
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+        for c in list(self._clients):
+            self._drop(c)
+        if threading.current_thread() not in self._threads:
+            for t in self._threads:
+                t.join()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                sock, addr = self._sock.accept()
+            except OSError:
+                return
+            c = _BrokerClientConnection(sock, next(self._cids))
+            with self._cond:
+                self._clients.append(c)
+            self._logger.debug(f"[XL30] Broker client {c.cid} connected")
+            threading.Thread(target = self._reader, args = ( c, ), name = f"XL30BrokerClient{c.cid}", daemon = True).start()
+
+    def _drop(self, c):
+        with self._cond:
+            if c in self._clients:
+                self._clients.remove(c)
+            c.pending.clear()
+        c.closed = True
+        try:
+            c.sock.close()
+        except OSError:
+            pass
+
+    def _reader(self, c):
+        try:
+            while not c.closed:
+                msg = _recv(c.sock)
+                if msg is None:
+                    break
+                rid = msg.get("id")
+                method = msg.get("m")
+                if method not in XL30_BROKER_METHODS:
+                    c.reply({ "id" : rid, "e" : [ "ValueError", f"Unsupported method {method}" ] })
+                    continue
+                key = json.dumps([ method, msg.get("a", [ ]), msg.get("k", { }) ], sort_keys = True)
+                with self._cond:
+                    c.pending.append(( rid, method, msg.get("a", [ ]), msg.get("k", { }), key ))
+                    self.requests = self.requests + 1
+                    self._cond.notify()
+        except (OSError, ValueError) as e:
+            self._logger.warning(f"[XL30] Broker client {c.cid} failed: {e}")
+        self._logger.debug(f"[XL30] Broker client {c.cid} disconnected")
+        self._drop(c)
+
+    def _pick(self):
+        # Round robin over all clients with pending requests. Identical read-only
+        # requests at the head of other queues are taken along
+        n = len(self._clients)
+        for i in range(n):
+            c = self._clients[(self._next + i) % n]
+            if len(c.pending) > 0:
+                self._next = (self._next + i + 1) % n
+                req = c.pending.popleft()
+                waiters = [ ( c, req[0] ) ]
+                if _readonly(req[1]):
+                    for other in self._clients:
+                        if (other is not c) and (len(other.pending) > 0) and (other.pending[0][4] == req[4]):
+                            waiters.append(( other, other.pending.popleft()[0] ))
+                return req, waiters
+        return None, None
+
+    def _execute(self, method, args, kwargs, key):
+        readonly = _readonly(method)
+        if readonly and (self._cacheTimeout is not None):
+            entry = self._cache.get(key)
+            if (entry is not None) and ((monotonic() - entry[1]) <= self._cacheTimeout):
+                return entry[0]
+        if not readonly:
+            self._cache.clear()
+
+        try:
+            self.executed = self.executed + 1
+            result = getattr(self._xl, method)(*_decode(args), **_decode(kwargs))
+            resp = { "r" : _encode(result) }
+        except Exception as e:
+            self._logger.error(f"[XL30] Broker call {method} failed: {e}")
+            return { "e" : [ type(e).__name__, str(e) ] }
+
+        if readonly and (self._cacheTimeout is not None):
+            self._cache[key] = ( resp, monotonic() )
+        return resp
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    req, waiters = self._pick()
+                    if req is not None:
+                        break
+                    self._cond.wait()
+            rid, method, args, kwargs, key = req
+            resp = self._execute(method, args, kwargs, key)
+            for c, wid in waiters:
+                msg = dict(resp)
+                msg["id"] = wid
+                c.reply(msg)
+
+class XL30BrokerClient:
+    # Exposes the microscope interface of a broker. Calls block till the
+    # response has been received and can be issued from multiple threads
+    def __init__(self, path = None, timeout = None):
+        if path is None:
+            path = xl30_broker_socket()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._sock.close()
+
+    def call(self, method, *args, **kwargs):
+        with self._lock:
+            rid = next(self._ids)
+            try:
+                _send(self._sock, { "id" : rid, "m" : method, "a" : _encode(list(args)), "k" : _encode(kwargs) })
+                while True:
+                    resp = _recv(self._sock)
+                    if resp is None:
+                        raise ScanningElectronMicroscope_NotConnectedException("Broker closed the connection")
+                    if resp.get("id") == rid:
+                        break
+            except OSError as e:
+                raise ScanningElectronMicroscope_CommunicationError(f"Broker communication failed: {e}")
+        if "e" in resp:
+            etype, message = resp["e"]
+            if etype in _brokerExceptions:
+                raise _brokerExceptions[etype](message)
+            raise ScanningElectronMicroscope_CommunicationError(f"{etype}: {message}")
+        return _decode(resp["r"])
+
+    def __getattr__(self, name):
+        if name not in XL30_BROKER_METHODS:
+            raise AttributeError(name)
+        def proxy(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+        return proxy
+
+def main():
+    from xl30serial.xl30serial import XL30Serial
+
+    parser = argparse.ArgumentParser(description = "Share an XL30 serial connection over a Unix socket")
+    parser.add_argument("--port", required = True, help = "Serial port of the XL30")
+    parser.add_argument("--socket", default = None, help = "Path of the Unix socket (default $XDG_RUNTIME_DIR/xl30broker.sock)")
+    parser.add_argument("--cache-timeout", type = float, default = 1.0, help = "Seconds read-only results are served from the cache")
+    parser.add_argument("--detectors-autodetect", action = "store_true", help = "Autodetect supported detectors on connect")
+    parser.add_argument("--loglevel", default = "INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = args.loglevel)
+    logger = logging.getLogger("xl30broker")
+    with XL30Serial(args.port, logger, detectorsAutodetect = args.detectors_autodetect) as xl:
+        broker = XL30Broker(xl, args.socket, cacheTimeout = args.cache_timeout)
+        try:
+            broker.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
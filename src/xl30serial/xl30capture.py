@@ -0,0 +1,238 @@
+import argparse
+import struct
+import threading
+
+from time import sleep, time, monotonic
+
+# Binary capture of the serial traffic of XL30Serial and a replay transport
+#
+# Capture files start with a header (magic, wall clock time and monotonic
+# time at the start of the capture) followed by one record per transmitted
+# frame (or pipelined window) and per chunk of received data:
+#
+#   <d   monotonic timestamp in seconds
+#   B    direction (CAPTURE_TX or CAPTURE_RX)
+#   H    length of the data
+#        raw data as written to / read from the port
+#
+# Received data is recorded as read from the port, including garbage that is
+# dropped by the receive path, so a replay exercises resynchronization too.
+#
+# XL30ReplayPort behaves like a serial.Serial and delivers the received data
+# of a capture. With followWrites every write consumes the next transmitted
+# record and releases the data received after it (offset as in the capture,
+# divided by speed), else all received data is delivered on its own time line
+# starting with the first read. speed = None delivers everything as fast as
+# possible. Reads never block for data that will not arrive - timeouts of the
+# captured session return immediately.
+#
+# Run as python -m xl30serial.xl30capture FILE to dump a capture.
+
+CAPTURE_TX = 0
+CAPTURE_RX = 1
+
+_captureMagic = b"XL30CAP1"
+_captureHeader = struct.Struct("<8sdd")
+_captureRecord = struct.Struct("<dBH")
+
+class XL30Capture:
+    def __init__(self, file):
+        # file is a path (truncated) or a binary file object opened for writing
+        if isinstance(file, str):
+            self._file = open(file, "wb")
+            self._owned = True
+        else:
+            self._file = file
+            self._owned = False
+        self._lock = threading.Lock()
+        self._file.write(_captureHeader.pack(_captureMagic, time(), monotonic()))
+        self.records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, direction, data):
+        ts = monotonic()
+        with self._lock:
+            if self._file is None:
+                return
+            for i in range(0, len(data), 0xFFFF):
+                chunk = data[i:i + 0xFFFF]
+                self._file.write(_captureRecord.pack(ts, direction, len(chunk)))
+                self._file.write(chunk)
+                self.records = self.records + 1
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            if self._owned:
+                self._file.close()
+            else:
+                self._file.flush()
+            self._file = None
+
+def read_capture(file):
+    # Returns the header as dictionary and the list of records as tuples
+    # (monotonic timestamp, direction, data)
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            return read_capture(f)
+
+    hdr = file.read(_captureHeader.size)
+    if len(hdr) < _captureHeader.size:
+        raise ValueError("Truncated capture header")
+    magic, wallclock, start = _captureHeader.unpack(hdr)
+    if magic != _captureMagic:
+        raise ValueError(f"Not an XL30 capture (magic {magic})")
+
+    records = [ ]
+    while True:
+        rec = file.read(_captureRecord.size)
+        if len(rec) < _captureRecord.size:
+            break
+        ts, direction, n = _captureRecord.unpack(rec)
+        data = file.read(n)
+        if len(data) < n:
+            # Capture has been interrupted while writing the last record
+            break
+        records.append(( ts, direction, data ))
+    return { 'time' : wallclock, 'monotonic' : start }, records
+
+class XL30ReplayPort:
+    def __init__(self, capture, speed = None, followWrites = True, timeout = 60):
+        # capture is a path, a file object or a list of records
+        if isinstance(capture, list):
+            self._records = capture
+        else:
+            self._records = read_capture(capture)[1]
+        self._speed = speed
+        self._followWrites = followWrites
+        self.timeout = timeout
+        self.baudrate = 9600
+
+        self._cursor = 0
+        self._started = False
+        # Received data as [ release time, bytes ]
+        self._out = [ ]
+
+        self.written = 0
+        self.mismatches = 0
+
+    def _release_at(self, anchor, anchorTs, ts):
+        if self._speed is None:
+            return anchor
+        return anchor + (ts - anchorTs) / self._speed
+
+    def _schedule(self, anchor, anchorTs):
+        # Queues the received records following the cursor up to the next
+        # transmitted one (or all of them when not following writes)
+        while self._cursor < len(self._records):
+            ts, direction, data = self._records[self._cursor]
+            if direction == CAPTURE_TX:
+                if self._followWrites:
+                    return
+            else:
+                self._out.append([ self._release_at(anchor, anchorTs, ts), data ])
+            self._cursor = self._cursor + 1
+
+    def _start(self):
+        if self._started:
+            return
+        self._started = True
+        # When following writes this only queues data that has been received
+        # before the first request (i.e. stale bytes)
+        if len(self._records) > 0:
+            self._schedule(monotonic(), self._records[0][0])
+
+    @property
+    def done(self):
+        # True as soon as everything has been delivered
+        self._start()
+        return (self._cursor >= len(self._records)) and (len(self._out) == 0)
+
+    def write(self, data):
+        self._start()
+        self.written = self.written + 1
+        if not self._followWrites:
+            return len(data)
+        if (self._cursor < len(self._records)) and (self._records[self._cursor][1] == CAPTURE_TX):
+            ts, direction, recorded = self._records[self._cursor]
+            if bytes(data) != recorded:
+                self.mismatches = self.mismatches + 1
+            self._cursor = self._cursor + 1
+            self._schedule(monotonic(), ts)
+        else:
+            self.mismatches = self.mismatches + 1
+        return len(data)
+
+    def _available(self, now):
+        n = 0
+        for release, chunk in self._out:
+            if release > now:
+                break
+            n = n + len(chunk)
+        return n
+
+    @property
+    def in_waiting(self):
+        self._start()
+        return self._available(monotonic())
+
+    def read(self, size = 1):
+        self._start()
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        while True:
+            now = monotonic()
+            if self._available(now) >= size:
+                break
+            pending = [ release for release, chunk in self._out if release > now ]
+            if len(pending) == 0:
+                # Nothing more will arrive before the next write
+                break
+            if (deadline is not None) and (now >= deadline):
+                break
+            wait = min(pending) - now
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            sleep(max(0, wait))
+
+        out = bytearray()
+        now = monotonic()
+        while (len(self._out) > 0) and (self._out[0][0] <= now) and (len(out) < size):
+            chunk = self._out[0][1]
+            take = size - len(out)
+            out += chunk[:take]
+            if take >= len(chunk):
+                self._out.pop(0)
+            else:
+                self._out[0][1] = chunk[take:]
+        return bytes(out)
+
+    def reset_input_buffer(self):
+        now = monotonic()
+        self._out = [ entry for entry in self._out if entry[0] > now ]
+
+    def close(self):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description = "Dump an XL30 serial capture")
+    parser.add_argument("file", help = "Capture file")
+    args = parser.parse_args()
+
+    header, records = read_capture(args.file)
+    print(f"# Captured at {header['time']}, {len(records)} records")
+    for ts, direction, data in records:
+        print(f"{ts - header['monotonic']:12.6f} {'TX' if direction == CAPTURE_TX else 'RX'} {' '.join([ f'{b:02x}' for b in data ])}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+import struct
+
+# Declarative description of the XL30 serial console commands
+#
+# Each command has a name (used by the XL30Serial bindings), an opcode, the
+# layout of the request payload and the layout of the (successful) response
+# payload as struct format strings (little endian, without byte order
+# character). Layouts are compiled only once into struct.Struct instances.
+#
+#   request     Layout of the request payload. None means the payload is
+#               supplied as raw bytes by the caller (variable length)
+#   response    Layout of the response payload. None means the payload is
+#               not decoded
+#   timeout     Port timeout in seconds while waiting for the response. None
+#               keeps the current port timeout
+#   idempotent  Command can safely be resent (i.e. after a lost response)
+#   readonly    Command does not change the state of the microscope
+#   cacheable   Result only changes by our own commands and may be cached
+#   param       Name of the parameter read or written by the command
+#   invalidates Parameters that are changed as side effect of the command
+#               ("*" for all parameters)
+
+def build_frame(opCode, payload = None):
+    # Assembles a request frame: ID 0x05, total length, opcode, status,
+    # payload and the 8 bit sum over all previous bytes as checksum
+    if payload is None:
+        payload = b''
+    msg = bytearray((0x05, len(payload) + 5, opCode, 0x00))
+    msg += payload
+    msg.append(sum(msg) & 0xFF)
+    return bytes(msg)
+
+class XL30Command:
+    __slots__ = ( 'name', 'opcode', 'request', 'response', 'timeout', 'idempotent', 'readonly', 'cacheable', 'param', 'invalidates', 'frame' )
+
+    def __init__(
+        self,
+        name,
+        opcode,
+        request = "4x",
+        response = None,
+        timeout = None,
+        idempotent = True,
+        readonly = False,
+        cacheable = False,
+        param = None,
+        invalidates = None
+    ):
+        if (opcode < 0) or (opcode > 255):
+            raise ValueError(f"OpCode {opcode} of command {name} out of range 0-255")
+
+        self.name = name
+        self.opcode = opcode
+        self.request = struct.Struct("<" + request) if request is not None else None
+        self.response = struct.Struct("<" + response) if response is not None else None
+        self.timeout = timeout
+        self.idempotent = idempotent
+        self.readonly = readonly
+        self.cacheable = cacheable
+        self.param = param
+        self.invalidates = invalidates
+
+        # Requests without arguments (i.e. all queries) are precomputed
+        self.frame = None
+        if (self.request is not None) and (self.request.format.strip("<0123456789x") == ""):
+            self.frame = build_frame(opcode, self.request.pack())
+
+    def encode(self, *args):
+        if self.request is None:
+            raise ValueError(f"Command {self.name} requires a raw payload")
+        return self.request.pack(*args)
+
+    def __repr__(self):
+        return f"XL30Command({self.name}, opcode {self.opcode})"
+
+def _query(name, opcode, response, fill = 4, **kwargs):
+    return XL30Command(name, opcode, request = f"{fill}x", response = response, readonly = True, **kwargs)
+
+_commandList = [
+    # Identification and high tension
+    _query("get_id",                            0,   "HH"),
+    _query("get_hightension_status",            4,   "HH"),
+    _query("get_hightension",                   2,   "f"),
+    XL30Command("set_hightension",              3,   "f"),
+    XL30Command("set_hightension_status",       5,   "B3x"),
+
+    # Vacuum system (0: Pump, 1: Vent, 2: Stop venting)
+    XL30Command("set_vacuum",                   113, "B3x"),
+
+    # Beam and detectors
+    _query("get_spotsize",                      6,   "f",       cacheable = True, param = "spotsize"),
+    XL30Command("set_spotsize",                 7,   "f",       "f",        param = "spotsize"),
+    _query("get_magnification",                 12,  "f",       cacheable = True, param = "magnification"),
+    XL30Command("set_magnification",            13,  "f",       "f",        param = "magnification"),
+    _query("get_stigmator",                     70,  "ff",      fill = 8,   cacheable = True, param = "stigmator"),
+    XL30Command("set_stigmator",                71,  "ff",      "ff",       param = "stigmator"),
+    _query("get_detector",                      14,  "HH",      cacheable = True, param = "detector"),
+    XL30Command("set_detector",                 15,  "BB2x",                timeout = 60, param = "detector", invalidates = ( "contrast", "brightness" )),
+
+    # Scanning
+    _query("get_linetime",                      21,  "HH",      cacheable = True, param = "linetime"),
+    XL30Command("set_linetime",                 21,  "B3x",     "HH",       param = "linetime"),
+    _query("get_linesperframe",                 18,  "HH",      cacheable = True, param = "linesperframe"),
+    XL30Command("set_linesperframe",            19,  "B3x",     "HH",       param = "linesperframe"),
+    _query("get_scanmode",                      16,  "HH",      cacheable = True, param = "scanmode"),
+    XL30Command("set_scanmode",                 17,  "B3x",     "HH",       param = "scanmode"),
+    _query("get_scanrotation",                  98,  "f",       cacheable = True, param = "scanrotation"),
+    XL30Command("set_scanrotation",             99,  "f",       "f",        param = "scanrotation"),
+    _query("get_area_or_dot_shift_x",           26,  "f",       cacheable = True, param = "areashift_x"),
+    XL30Command("set_area_or_dot_shift_x",      27,  "f",       "HH",       param = "areashift_x"),
+    _query("get_area_or_dot_shift_y",           28,  "f",       cacheable = True, param = "areashift_y"),
+    XL30Command("set_area_or_dot_shift_y",      29,  "f",       "HH",       param = "areashift_y"),
+    _query("get_selected_area_size_x",          22,  "f",       cacheable = True, param = "areasize_x"),
+    XL30Command("set_selected_area_size_x",     23,  "f",       "HH",       param = "areasize_x"),
+    _query("get_selected_area_size_y",          24,  "f",       cacheable = True, param = "areasize_y"),
+    XL30Command("set_selected_area_size_y",     25,  "f",       "HH",       param = "areasize_y"),
+
+    # Imaging
+    XL30Command("make_photo",                   37,  "",                    timeout = 60, idempotent = False),
+    XL30Command("write_tiff_image",             84,  None,                  timeout = 60, idempotent = False),
+    _query("get_imagefilter_mode",              74,  "HH",      param = "imagefilter"),
+    XL30Command("set_imagefilter_mode",         75,  "BB2x",    "HH",       param = "imagefilter"),
+    _query("get_contrast",                      48,  "f",       cacheable = True, param = "contrast"),
+    XL30Command("set_contrast",                 49,  "f",       "f",        param = "contrast"),
+    _query("get_brightness",                    50,  "f",       cacheable = True, param = "brightness"),
+    XL30Command("set_brightness",               51,  "f",       "f",        param = "brightness"),
+    XL30Command("auto_contrastbrightness",      53,  "4x",                  timeout = 60, idempotent = False, invalidates = ( "contrast", "brightness" )),
+    XL30Command("auto_focus",                   111, "4x",                  timeout = 240, idempotent = False, invalidates = "*"),
+    _query("get_databar_text",                  100, None,      fill = 44,  cacheable = True, param = "databar"),
+    XL30Command("set_databar_text",             101, None,                  param = "databar"),
+
+    # Stage
+    XL30Command("stage_home",                   175, "4x",                  timeout = 2*60 + 30 + 15, idempotent = False, invalidates = ( "stage", )),
+    _query("get_stage_position",                190, "fffff",   fill = 20,  param = "stage"),
+    XL30Command("set_stage_xy",                 177, "ff",      "ff",       timeout = 60, param = "stage"),
+    XL30Command("set_stage_rotation",           179, "f",       "f",        timeout = 60, param = "stage"),
+    XL30Command("set_stage_z",                  187, "f",       "f",        timeout = 60, param = "stage"),
+    XL30Command("set_stage_tilt",               189, "f",       "f",        timeout = 60, param = "stage"),
+    _query("get_beamshift",                     80,  "ff",      fill = 8,   cacheable = True, param = "beamshift"),
+    XL30Command("set_beamshift",                81,  "ff",      "ff",       param = "beamshift"),
+
+    # Specimen current detector
+    _query("get_specimen_current_detector_mode", 58, "HH",      cacheable = True, param = "scdmode"),
+    XL30Command("set_specimen_current_detector_mode", 59, "B3x", "HH",      param = "scdmode"),
+    _query("get_specimen_current",              60,  "f"),
+
+    # Beam blanking and operator lock
+    _query("is_beam_blanked",                   62,  "HH",      cacheable = True, param = "blanked"),
+    XL30Command("set_beam_blanked",             63,  "B3x",     "HH",       param = "blanked"),
+    _query("is_oplocked",                       38,  "HH",      param = "oplock"),
+    XL30Command("set_oplock",                   39,  "B3x",     "HH",       param = "oplock"),
+]
+
+XL30_COMMANDS = { cmd.name : cmd for cmd in _commandList }
+
+# Line times (ms) and lines per frame by the value used on the wire
+
+XL30_LINETIMES = {
+    0 : 1.25,
+    1 : 1.87,
+    2 : 3.43,
+    3 : 6.86,
+    4 : 20.0,
+    5 : 40.0,
+    6 : 60.0,
+    7 : 120.0,
+    8 : 240.0,
+    9 : 360.0,
+    10 : 1020.0,
+    100 : "TV"
+}
+
+XL30_LINESPERFRAME = {
+    0 : 121,
+    1 : 242,
+    2 : 484,
+    3 : 968,
+    4 : 1452,
+    5 : 1936,
+    6 : 2420,
+    7 : 2904,
+    8 : 3388,
+    9 : 3872,
+    10 : 180,
+    11 : 360,
+    12 : 720,
+    100 : "TV"
+}
+
+# Detector types and detector IDs as reported by get_detector / accepted by
+# set_detector. The supported flag is filled by detector autodetection
+
+XL30_DETECTOR_TYPES = {
+    0 : { 'short' : 'SSD', 'long' : 'Solid State Detector' },
+    1 : { 'short' : 'PMT', 'long' : 'Photo Multiplier' },
+    2 : { 'short' : 'SED', 'long' : 'Photo Multiplier, grid, 10 kV' },
+    3 : { 'short' : 'XAIB', 'long' : 'eXternal Analog Interface Board' },
+    4 : { 'short' : 'MULTIPLE', 'long' : 'Multiple, mixed detector id' }
+}
+
+XL30_DETECTOR_IDS = {
+    0 : { 'name' : 'No detector connected',         'type' : None,  'shortname' : None, 'supported' : False },
+    1 : { 'name' : 'Specimen current detector',     'type' : 0,     'shortname' : 'SC', 'supported' : False },
+    2 : { 'name' : 'Cathode Luminescence',          'type' : 1,     'shortname' : 'CL', 'supported' : False },
+    3 : { 'name' : 'Secondary Electron 1',          'type' : 2,     'shortname' : 'SE', 'supported' : False },
+    4 : { 'name' : 'Backscatter Electron',          'type' : 0,     'shortname' : 'BSE', 'supported' : False },
+    5 : { 'name' : 'Robinson Detector',             'type' : 1,     'shortname' : 'RBS', 'supported' : False },
+    6 : { 'name' : 'Secondary Electron 2',          'type' : 2,     'shortname' : 'SE2', 'supported' : False },
+    7 : { 'name' : 'Auxiliary 1',                   'type' : None,  'shortname' : None,  'supported' : False },
+    8 : { 'name' : 'CCD',                           'type' : 0,     'shortname' : 'CCD', 'supported' : False },
+    9 : { 'name' : 'EDX Standard',                  'type' : 3,     'shortname' : 'EDX', 'supported' : False },
+    10 : { 'name' : 'WDX',                          'type' : 3,     'shortname' : 'WDX', 'supported' : False },
+    11 : { 'name' : 'External video',               'type' : 3,     'shortname' : 'EXT', 'supported' : False },
+    12 : { 'name' : 'Phax PV9900',                  'type' : 3,     'shortname' : 'HAX', 'supported' : False },
+    13 : { 'name' : 'EDX Imaging',                  'type' : 3,     'shortname' : 'IMG', 'supported' : False },
+    14 : { 'name' : 'GW Backscatter Electron 1',    'type' : 0,     'shortname' : 'BS1', 'supported' : False },
+    15 : { 'name' : 'GW Backscatter Electron 2',    'type' : 0,     'shortname' : 'BS2', 'supported' : False },
+    16 : { 'name' : 'GW Backscatter Electron 3',    'type' : 0,     'shortname' : 'BS3', 'supported' : False },
+    17 : { 'name' : 'GW Backscatter Electron 4',    'type' : 0,     'shortname' : 'BS4', 'supported' : False },
+    18 : { 'name' : 'Econ 3',                       'type' : 3,     'shortname' : 'EDX', 'supported' : False },
+    19 : { 'name' : 'Econ 4',                       'type' : 3,     'shortname' : 'EDX', 'supported' : False },
+    20 : { 'name' : 'EDX Free',                     'type' : 3,     'shortname' : 'EDX', 'supported' : False },
+    21 : { 'name' : 'MCP_1',                        'type' : 2,     'shortname' : 'MCP', 'supported' : False },
+    22 : { 'name' : 'MCP_2',                        'type' : 2,     'shortname' : 'MCP_1', 'supported' : False },
+    23 : { 'name' : 'Channel Electron Det CED',     'type' : 2,     'shortname' : 'CED', 'supported' : False },
+    24 : { 'name' : 'Electron BackScatter Pattern', 'type' : 2,     'shortname' : 'EBSP', 'supported' : False },
+    25 : { 'name' : 'Gaseous Secondary Electron',   'type' : 2,     'shortname' : 'GSE', 'supported' : False },
+    26 : { 'name' : 'Centaurus',                    'type' : 1,     'shortname' : 'CEN', 'supported' : False },
+    27 : { 'name' : 'STEM Transmission Electron',   'type' : 0,     'shortname' : 'TED', 'supported' : False },
+    28 : { 'name' : 'TLD (SFEG)',                   'type' : 0,     'shortname' : 'TLD', 'supported' : False },
+    29 : { 'name' : 'GBSD (gaseous backscatter)',   'type' : 0,     'shortname' : 'GSE', 'supported' : False },
+    256 : { 'name' : 'Mixed',                       'type' : 4,     'shortname' : 'MIX', 'supported' : False }
+}
+
+# Legacy format strings as accepted by XL30Serial._msg_rx:
+#   b   Sequence of 4 bytes
+#   i   Two 16 bit integer values
+#   f   Single 32 bit float
+
+_formatCodes = { "b" : "4s", "i" : "HH", "f" : "f" }
+_formatCache = { }
+
+def compile_format(fmt):
+    # Translates a legacy format string into a (cached) struct.Struct
+    s = _formatCache.get(fmt)
+    if s is None:
+        try:
+            s = struct.Struct("<" + "".join([ _formatCodes[c] for c in fmt ]))
+        except KeyError:
+            raise ValueError(f"Unknown format specification {fmt}")
+        _formatCache[fmt] = s
+    return s
+
+# Response frame as returned by XL30Serial._msg_rx
+#
+# The record only keeps a reference to the received frame and the response
+# layout. Fields are decoded on access with struct.unpack_from directly on
+# the frame. For compatibility the record can be accessed like the dictionary
+# previously returned by _msg_rx (id, lengthTotal, lengthPayload, op, status,
+# error, errorcode, payload and - in case a layout has been requested - data)
+
+_errorCode = struct.Struct("<I")
+
+class XL30Response:
+    __slots__ = ( '_frame', '_layout', '_data' )
+
+    _keys = ( 'id', 'lengthTotal', 'lengthPayload', 'op', 'status', 'error', 'errorcode', 'payload' )
+
+    def __init__(self, frame, layout = None):
+        self._frame = frame
+        self._layout = layout
+        self._data = None
+
+    @property
+    def id(self):
+        return self._frame[0]
+    @property
+    def lengthTotal(self):
+        return self._frame[1]
+    @property
+    def lengthPayload(self):
+        return self._frame[1] - 5
+    @property
+    def op(self):
+        return self._frame[2]
+    @property
+    def status(self):
+        return self._frame[3]
+    @property
+    def error(self):
+        return (self._frame[3] & 0x80) != 0
+    @property
+    def errorcode(self):
+        if not self.error:
+            return None
+        return _errorCode.unpack_from(self._frame, 4)[0]
+    @property
+    def payload(self):
+        if self._frame[1] <= 5:
+            return None
+        return self._frame[4 : -1]
+    @property
+    def frame(self):
+        return self._frame
+    @property
+    def data(self):
+        if self._layout is None:
+            return None
+        if self.error:
+            return []
+        if self._data is None:
+            layout = self._layout
+            if not isinstance(layout, struct.Struct):
+                layout = compile_format(layout)
+            self._data = layout.unpack_from(self._frame, 4)
+        return list(self._data)
+
+    # Dictionary style access
+
+    def keys(self):
+        if self._layout is None:
+            return list(self._keys)
+        return list(self._keys) + [ 'data' ]
+
+    def __contains__(self, key):
+        return (key in self._keys) or ((key == 'data') and (self._layout is not None))
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default = None):
+        if key not in self:
+            return default
+        return getattr(self, key)
+
+    def items(self):
+        return [ (k, getattr(self, k)) for k in self.keys() ]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, XL30Response):
+            return (self._frame == other._frame) and (self._layout == other._layout)
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(dict(self.items()))
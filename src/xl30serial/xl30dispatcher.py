@@ -0,0 +1,115 @@
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_NotConnectedException
+
+import itertools
+import queue
+import threading
+
+from concurrent.futures import Future
+
+# Thread safe front end for XL30Serial
+#
+# A single worker thread owns the XL30Serial instance and executes all calls.
+# Callers from any thread submit a method name (or a callable that receives
+# the XL30Serial instance) and get a concurrent.futures.Future back. Pending
+# calls are executed in order of their priority (lower value first) and in
+# submission order for equal priority. Each call runs to completion before
+# the next one is started, so every request/response pair (and every multi
+# command operation such as a stage move) is atomic on the wire. A running
+# call is never preempted - an urgent blank has to wait till an ongoing
+# autofocus has finished, but it overtakes every queued telemetry read.
+
+PRIORITY_URGENT = 0
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 50
+PRIORITY_LOW = 100
+
+class XL30Dispatcher:
+    def __init__(self, xl, name = "XL30Dispatcher"):
+        self._xl = xl
+        self._logger = xl._logger
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._closed = False
+        self._closeLock = threading.Lock()
+
+        self._thread = threading.Thread(target = self._worker, name = name, daemon = True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, method, *args, priority = PRIORITY_NORMAL, **kwargs):
+        # Queues a call and returns its future. method is either the name of
+        # a method of XL30Serial (i.e. "_get_magnification") or a callable
+        # that is called with the XL30Serial instance as first argument
+        if isinstance(method, str):
+            if not callable(getattr(self._xl, method, None)):
+                raise ValueError(f"Unknown XL30Serial method {method}")
+            fn = getattr(type(self._xl), method)
+        elif callable(method):
+            fn = method
+        else:
+            raise ValueError("Method has to be a method name or callable")
+
+        fut = Future()
+        with self._closeLock:
+            if self._closed:
+                raise ScanningElectronMicroscope_NotConnectedException("Dispatcher has been closed")
+            self._queue.put(( priority, next(self._seq), fut, fn, args, kwargs ))
+        return fut
+
+    def call(self, method, *args, priority = PRIORITY_NORMAL, timeout = None, **kwargs):
+        # Blocking convenience wrapper around submit
+        return self.submit(method, *args, priority = priority, **kwargs).result(timeout)
+
+    def urgent(self, method, *args, **kwargs):
+        return self.submit(method, *args, priority = PRIORITY_URGENT, **kwargs)
+
+    def blank(self):
+        return self.urgent("_blank")
+
+    def stop_vent(self):
+        return self.urgent("_vent", stop = True)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def close(self, cancelPending = False):
+        # Stops accepting new calls. Pending calls are executed (or cancelled
+        # if requested) before the worker terminates
+        with self._closeLock:
+            if self._closed:
+                return
+            self._closed = True
+            if cancelPending:
+                self._cancel_pending()
+            # Sentinel sorts after every regular call
+            self._queue.put(( float("inf"), next(self._seq), None, None, None, None ))
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _cancel_pending(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item[2] is not None:
+                item[2].cancel()
+
+    def _worker(self):
+        while True:
+            priority, seq, fut, fn, args, kwargs = self._queue.get()
+            if fut is None:
+                self._logger.debug("[XL30] Dispatcher terminated")
+                return
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn(self._xl, *args, **kwargs))
+            except BaseException as e:
+                self._logger.error(f"[XL30] Dispatched call {getattr(fn, '__name__', fn)} failed: {e}")
+                fut.set_exception(e)
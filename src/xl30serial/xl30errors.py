@@ -0,0 +1,104 @@
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_NotConnectedException, ScanningElectronMicroscope_CommunicationError
+
+import random
+
+# Error taxonomy and retry policy of XL30Serial
+#
+# All errors on the wire are subclasses of ScanningElectronMicroscope_CommunicationError
+# (so existing handlers keep working) and are classified by classify() as
+#
+#   argument    ValueError / TypeError raised by the range checks of a method
+#   device      The console answered with an error code
+#   unsupported Command is known to be unsupported (xl30profile)
+#   checksum    Corrupted response frame
+#   timeout     No response in time
+#   protocol    Invalid framing or status bits, failed resynchronization
+#   port        The port is gone (closed, unplugged adapter, not connected)
+#
+# XL30RetryPolicy decides for every error caught by retrylooped whether the
+# call is repeated (after which delay), a reconnect is done or the error is
+# raised to the caller. Pass a subclass (overriding decide or delay) as
+# retryPolicy to XL30Serial to change the behaviour.
+
+class XL30TimeoutError(ScanningElectronMicroscope_CommunicationError):
+    pass
+
+class XL30ChecksumError(ScanningElectronMicroscope_CommunicationError):
+    pass
+
+class XL30ProtocolError(ScanningElectronMicroscope_CommunicationError):
+    pass
+
+class XL30PortError(ScanningElectronMicroscope_CommunicationError):
+    pass
+
+class XL30DeviceError(ScanningElectronMicroscope_CommunicationError):
+    def __init__(self, message, errorCode = None):
+        super().__init__(message)
+        self.errorCode = errorCode
+
+class XL30UnsupportedCommandError(XL30DeviceError):
+    pass
+
+RETRY_RAISE = "raise"
+RETRY_RETRY = "retry"
+RETRY_RECONNECT = "reconnect"
+
+def classify(exc):
+    if isinstance(exc, XL30UnsupportedCommandError):
+        return "unsupported"
+    if isinstance(exc, XL30DeviceError):
+        return "device"
+    if isinstance(exc, XL30ChecksumError):
+        return "checksum"
+    if isinstance(exc, XL30TimeoutError):
+        return "timeout"
+    if isinstance(exc, (XL30PortError, ScanningElectronMicroscope_NotConnectedException, OSError)):
+        # serial.SerialException is an OSError
+        return "port"
+    if isinstance(exc, ScanningElectronMicroscope_CommunicationError):
+        return "protocol"
+    if isinstance(exc, (ValueError, TypeError)):
+        return "argument"
+    return "unknown"
+
+class XL30RetryPolicy:
+    # Non transient errors (argument, device, unsupported and unknown ones)
+    # are raised immediately. Checksum errors are retried without delay,
+    # timeouts and protocol errors after an exponentially growing delay
+    # (retryDelay * backoff**n, at most maxDelay) with +- jitter. Lost ports
+    # are reconnected right away. After retryCount retries a reconnect is
+    # done, after reconnectCount reconnects the error is raised. Commands
+    # that are not idempotent are never resent after the request may have
+    # reached the microscope
+    def __init__(self, retryCount = 3, reconnectCount = 3, retryDelay = 5, backoff = 2, maxDelay = 60, jitter = 0.25, seed = None):
+        self.retryCount = retryCount
+        self.reconnectCount = reconnectCount
+        self.retryDelay = retryDelay
+        self.backoff = backoff
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+        self._random = random.Random(seed)
+
+    def delay(self, kind, retry):
+        # Delay in seconds before the given retry (0 for the first one)
+        if kind == "checksum":
+            return 0
+        d = min(self.maxDelay, self.retryDelay * (self.backoff ** retry))
+        if self.jitter > 0:
+            d = d * (1 + self.jitter * (2 * self._random.random() - 1))
+        return max(0, d)
+
+    def decide(self, exc, retries, reconnects, idempotent = True):
+        # Returns ( action, delay ) for the error after retries retries and
+        # reconnects reconnects of the current call
+        kind = classify(exc)
+        if kind in ( "argument", "device", "unsupported", "unknown" ):
+            return RETRY_RAISE, 0
+        if not idempotent:
+            return RETRY_RAISE, 0
+        if (kind != "port") and (retries < self.retryCount):
+            return RETRY_RETRY, self.delay(kind, retries)
+        if reconnects < self.reconnectCount:
+            return RETRY_RECONNECT, 0
+        return RETRY_RAISE, 0
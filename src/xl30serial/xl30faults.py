@@ -0,0 +1,189 @@
+import random
+
+from time import sleep, monotonic
+
+# Fault injecting transport for XL30Serial
+#
+# XL30FaultyPort sits between XL30Serial and the real (or simulated) port and
+# manipulates the response frames received from the console. Every complete
+# frame is subject to at most one fault, chosen with the configured
+# probabilities from a seeded random generator (so runs are reproducible) or
+# armed explicitly for the next frame with arm():
+#
+#   bitflip     Flips a single random bit (invalid checksum or length)
+#   truncate    Drops the tail of the frame
+#   delay       Stalls in the middle of the frame for delay seconds
+#   duplicate   Delivers the frame twice
+#   silence     Drops the frame (the request seems to be lost)
+#   status      Sets invalid status bits (with valid checksum)
+#
+# The requests sent to the console are passed through unchanged. Injected
+# faults are recorded in injected as tuples (monotonic time, fault, opcode).
+
+FAULTS = ( "bitflip", "truncate", "delay", "duplicate", "silence", "status" )
+
+class XL30FaultyPort:
+    def __init__(self, port, faults = None, seed = None, delay = 2.0):
+        for f in (faults or { }):
+            if f not in FAULTS:
+                raise ValueError(f"Unknown fault {f}, supported are {FAULTS}")
+        self._port = port
+        self._faults = dict(faults or { })
+        self._random = random.Random(seed)
+        self._delay = delay
+        self._armed = [ ]
+
+        self._raw = bytearray()
+        # Outgoing chunks as [ release time, bytes ]
+        self._out = [ ]
+
+        self.injected = [ ]
+        self.frames = 0
+
+    # Passed through port attributes
+
+    @property
+    def timeout(self):
+        return self._port.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._port.timeout = value
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def write(self, data):
+        return self._port.write(data)
+
+    def close(self):
+        self._port.close()
+
+    def reset_input_buffer(self):
+        self._raw.clear()
+        self._out = [ ]
+        if hasattr(self._port, "reset_input_buffer"):
+            self._port.reset_input_buffer()
+
+    # Fault selection
+
+    def arm(self, fault):
+        # Injects the given fault into the next response frame
+        if fault not in FAULTS:
+            raise ValueError(f"Unknown fault {fault}, supported are {FAULTS}")
+        self._armed.append(fault)
+
+    def _choose(self):
+        if len(self._armed) > 0:
+            return self._armed.pop(0)
+        for fault, probability in self._faults.items():
+            if self._random.random() < probability:
+                return fault
+        return None
+
+    def _inject(self, frame):
+        self.frames = self.frames + 1
+        now = monotonic()
+        fault = self._choose()
+        if fault is None:
+            self._out.append([ now, frame ])
+            return
+        self.injected.append(( now, fault, frame[2] ))
+
+        if fault == "bitflip":
+            frame = bytearray(frame)
+            bit = self._random.randrange(len(frame) * 8)
+            frame[bit // 8] = frame[bit // 8] ^ (1 << (bit % 8))
+            self._out.append([ now, bytes(frame) ])
+        elif fault == "truncate":
+            self._out.append([ now, frame[:self._random.randrange(1, len(frame))] ])
+        elif fault == "delay":
+            split = self._random.randrange(1, len(frame))
+            self._out.append([ now, frame[:split] ])
+            self._out.append([ now + self._delay, frame[split:] ])
+        elif fault == "duplicate":
+            self._out.append([ now, frame + frame ])
+        elif fault == "silence":
+            pass
+        elif fault == "status":
+            frame = bytearray(frame)
+            frame[3] = frame[3] | 0x01
+            frame[-1] = sum(frame[:-1]) & 0xFF
+            self._out.append([ now, bytes(frame) ])
+
+    def _pump(self):
+        # Moves everything the port has received into the outgoing queue,
+        # complete frames pass the fault injection
+        waiting = self._port.in_waiting
+        if waiting > 0:
+            self._raw += self._port.read(waiting)
+        buf = self._raw
+        while len(buf) > 0:
+            if buf[0] != 0x05:
+                idx = buf.find(0x05)
+                n = len(buf) if idx < 0 else idx
+                self._out.append([ monotonic(), bytes(buf[:n]) ])
+                del buf[:n]
+                continue
+            if (len(buf) < 2) or (len(buf) < max(buf[1], 1)):
+                break
+            n = max(buf[1], 1)
+            frame = bytes(buf[:n])
+            del buf[:n]
+            self._inject(frame)
+
+    def _available(self, now):
+        n = 0
+        for release, chunk in self._out:
+            if release > now:
+                break
+            n = n + len(chunk)
+        return n
+
+    @property
+    def in_waiting(self):
+        self._pump()
+        return self._available(monotonic())
+
+    def read(self, size = 1):
+        # Blocks till size bytes are available or the timeout elapsed like
+        # serial.Serial.read
+        timeout = self._port.timeout
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            self._pump()
+            now = monotonic()
+            if self._available(now) >= size:
+                break
+            if (deadline is not None) and (now >= deadline):
+                break
+            # Wait for the next delayed chunk or more data from the port
+            wait = 0.01
+            pending = [ release for release, chunk in self._out if release > now ]
+            if len(pending) > 0:
+                wait = max(0, min(pending) - now)
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            if (len(pending) == 0) and (self._port.in_waiting == 0):
+                # Let the port block for new data (up to the remaining time)
+                oldTimeout = self._port.timeout
+                self._port.timeout = wait if deadline is not None else None
+                try:
+                    data = self._port.read(1)
+                finally:
+                    self._port.timeout = oldTimeout
+                self._raw += data
+                continue
+            sleep(wait)
+
+        out = bytearray()
+        now = monotonic()
+        while (len(self._out) > 0) and (self._out[0][0] <= now) and (len(out) < size):
+            chunk = self._out[0][1]
+            take = size - len(out)
+            out += chunk[:take]
+            if take >= len(chunk):
+                self._out.pop(0)
+            else:
+                self._out[0][1] = chunk[take:]
+        return bytes(out)
@@ -0,0 +1,176 @@
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Wire level instrumentation for XL30Serial
+#
+# An XL30Metrics instance is passed to XL30Serial (metrics = XL30Metrics() or
+# simply metrics = True) and is updated from the transmit / receive path and
+# the retry decorator:
+#
+#   latency         Histogram of the time from transmitting a request till
+#                   its response frame has been received, per opcode
+#   bytes           Bytes written to and read from the port, bytes dropped
+#                   while resynchronizing the receive stream
+#   timeouts        Requests that did not receive a response, per opcode
+#   checksum        Received frames with invalid checksum
+#   status          Responses with invalid status bits set
+#   errors          Responses with the error flag set (command rejected)
+#   retries         Retries and reconnects issued by retrylooped
+#
+# Without an instance attached the driver only performs a single None check
+# per hook. stats() returns a snapshot as dictionary, prometheus() renders the
+# Prometheus text exposition format. The text can be written to a file for the
+# textfile collector of the node exporter (write_textfile) or served over HTTP
+# (serve) for a local scraper.
+
+XL30_METRICS_BUCKETS = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120 )
+
+class XL30Metrics:
+    def __init__(self, buckets = XL30_METRICS_BUCKETS, labels = None):
+        self._buckets = tuple(sorted(buckets))
+        self._labels = dict(labels or { })
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # Per opcode [ bucket counts ..., +Inf count, sum ]
+            self._latency = { }
+            self._timeouts = { }
+            self._counters = {
+                'tx_bytes'          : 0,
+                'rx_bytes'          : 0,
+                'rx_dropped_bytes'  : 0,
+                'checksum_failures' : 0,
+                'status_errors'     : 0,
+                'error_responses'   : 0,
+                'retries'           : 0,
+                'reconnects'        : 0
+            }
+
+    # Hooks called by XL30Serial
+
+    def observe(self, opcode, seconds):
+        with self._lock:
+            h = self._latency.get(opcode)
+            if h is None:
+                h = [ 0 ] * (len(self._buckets) + 2)
+                self._latency[opcode] = h
+            for i, le in enumerate(self._buckets):
+                if seconds <= le:
+                    h[i] = h[i] + 1
+                    break
+            else:
+                h[-2] = h[-2] + 1
+            h[-1] = h[-1] + seconds
+
+    def timeout(self, opcode):
+        with self._lock:
+            self._timeouts[opcode] = self._timeouts.get(opcode, 0) + 1
+
+    def inc(self, counter, n = 1):
+        with self._lock:
+            self._counters[counter] = self._counters[counter] + n
+
+    # Readout
+
+    def stats(self):
+        # Snapshot of all metrics. Latency entries contain the number of
+        # samples, their sum and the cumulative bucket counts keyed by the
+        # upper bound
+        with self._lock:
+            latency = { }
+            for opcode, h in sorted(self._latency.items()):
+                count = sum(h[:-1])
+                cumulative = { }
+                acc = 0
+                for le, n in zip(self._buckets, h):
+                    acc = acc + n
+                    cumulative[le] = acc
+                latency[opcode] = {
+                    'count' : count,
+                    'sum' : h[-1],
+                    'mean' : h[-1] / count if count > 0 else None,
+                    'buckets' : cumulative
+                }
+            res = dict(self._counters)
+            res['timeouts'] = dict(sorted(self._timeouts.items()))
+            res['timeouts_total'] = sum(self._timeouts.values())
+            res['latency'] = latency
+            return res
+
+    def _labelstr(self, extra = None):
+        labels = dict(self._labels)
+        if extra is not None:
+            labels.update(extra)
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join([ f'{k}="{v}"' for k, v in labels.items() ]) + "}"
+
+    def prometheus(self):
+        st = self.stats()
+        lines = [ ]
+
+        counters = [
+            ( 'tx_bytes', "xl30_tx_bytes_total", "Bytes written to the serial port" ),
+            ( 'rx_bytes', "xl30_rx_bytes_total", "Bytes read from the serial port" ),
+            ( 'rx_dropped_bytes', "xl30_rx_dropped_bytes_total", "Bytes discarded while resynchronizing the receive stream" ),
+            ( 'checksum_failures', "xl30_checksum_failures_total", "Received frames with invalid checksum" ),
+            ( 'status_errors', "xl30_status_errors_total", "Responses with invalid status bits" ),
+            ( 'error_responses', "xl30_error_responses_total", "Responses with the error flag set" ),
+            ( 'retries', "xl30_retries_total", "Retries issued after communication errors" ),
+            ( 'reconnects', "xl30_reconnects_total", "Reconnects issued after exhausted retries" )
+        ]
+        for key, name, helptext in counters:
+            lines.append(f"# HELP {name} {helptext}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._labelstr()} {st[key]}")
+
+        lines.append("# HELP xl30_timeouts_total Requests without response")
+        lines.append("# TYPE xl30_timeouts_total counter")
+        for opcode, n in st['timeouts'].items():
+            lines.append(f"xl30_timeouts_total{self._labelstr({ 'opcode' : opcode })} {n}")
+
+        lines.append("# HELP xl30_request_duration_seconds Time from request till response")
+        lines.append("# TYPE xl30_request_duration_seconds histogram")
+        for opcode, h in st['latency'].items():
+            for le, n in h['buckets'].items():
+                lines.append(f"xl30_request_duration_seconds_bucket{self._labelstr({ 'opcode' : opcode, 'le' : le })} {n}")
+            lines.append(f"xl30_request_duration_seconds_bucket{self._labelstr({ 'opcode' : opcode, 'le' : '+Inf' })} {h['count']}")
+            lines.append(f"xl30_request_duration_seconds_sum{self._labelstr({ 'opcode' : opcode })} {h['sum']}")
+            lines.append(f"xl30_request_duration_seconds_count{self._labelstr({ 'opcode' : opcode })} {h['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        # Atomically replaces path (i.e. for the node exporter textfile collector)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def serve(self, port = 9630, address = "127.0.0.1"):
+        # Serves the text format on http://address:port/metrics from a daemon
+        # thread. Returns the server, shutdown() stops it
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ( "/", "/metrics" ):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(( address, port ), Handler)
+        threading.Thread(target = server.serve_forever, name = "XL30Metrics", daemon = True).start()
+        return server
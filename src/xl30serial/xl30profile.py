@@ -0,0 +1,121 @@
+from xl30serial.xl30errors import XL30UnsupportedCommandError
+
+import json
+import os
+
+# Persistent capability profile of a single microscope
+#
+# Profiles are keyed by machine type and serial number and stored as JSON in
+# a directory (by default ~/.config/xl30serial/<type>-<serial>.json). They
+# contain
+#
+#   detectors   Detector ID -> supported (as found by detector autodetection)
+#   unsupported Names of commands (xl30commands) that timed out repeatedly
+#               (in separate incidents) while the console answered other
+#               commands in between
+#   timings     Per command [ count, mean, max ] of the round trip time in
+#               seconds
+#   durations   Per long running operation that continues on the console
+#               after the response (auto contrast / brightness) [ count,
+#               mean, max ] of the duration in seconds
+#
+# XL30Serial loads the profile after the ID request. Known detectors replace
+# the autodetection, unsupported commands fail immediately with
+# XL30UnsupportedCommandError instead of running through retries and
+# reconnects.
+
+XL30_PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".config", "xl30serial")
+
+class XL30Profile:
+    def __init__(self, machineType, machineSerial, directory = XL30_PROFILE_DIR):
+        self.machineType = machineType
+        self.machineSerial = machineSerial
+        self.directory = directory
+
+        self.detectors = None
+        self.unsupported = set()
+        self.timings = { }
+        self.durations = { }
+
+        # Commands that timed out since their last response as
+        # [ incidents, waiting for a response of another command ]
+        self._suspects = { }
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"{self.machineType}-{self.machineSerial}.json")
+
+    @staticmethod
+    def load(machineType, machineSerial, directory = XL30_PROFILE_DIR, logger = None):
+        # Returns the stored profile or an empty one if none (or no readable
+        # one) exists
+        profile = XL30Profile(machineType, machineSerial, directory)
+        try:
+            with open(profile.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return profile
+        except (OSError, ValueError) as e:
+            if logger is not None:
+                logger.warning(f"[XL30] Ignoring unreadable profile {profile.path}: {e}")
+            return profile
+
+        if data.get('detectors') is not None:
+            profile.detectors = { int(k) : bool(v) for k, v in data['detectors'].items() }
+        profile.unsupported = set(data.get('unsupported', [ ]))
+        profile.timings = { k : list(v) for k, v in data.get('timings', { }).items() }
+        profile.durations = { k : list(v) for k, v in data.get('durations', { }).items() }
+        return profile
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok = True)
+        data = {
+            'type' : self.machineType,
+            'serial' : self.machineSerial,
+            'detectors' : { str(k) : v for k, v in self.detectors.items() } if self.detectors is not None else None,
+            'unsupported' : sorted(self.unsupported),
+            'timings' : self.timings,
+            'durations' : self.durations
+        }
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent = 4)
+        os.replace(tmp, self.path)
+
+    def record_timing(self, name, seconds):
+        self._record(self.timings, name, seconds)
+
+    def record_duration(self, name, seconds):
+        self._record(self.durations, name, seconds)
+
+    def _record(self, table, name, seconds):
+        t = table.get(name)
+        if t is None:
+            table[name] = [ 1, seconds, seconds ]
+            return
+        t[0] = t[0] + 1
+        t[1] = t[1] + (seconds - t[1]) / t[0]
+        t[2] = max(t[2], seconds)
+
+    def record_timeout(self, name):
+        # Timeouts of a command only count once till the console answered
+        # another command (so a burst of retries during a link outage is a
+        # single incident)
+        entry = self._suspects.setdefault(name, [ 0, False ])
+        if not entry[1]:
+            entry[0] = entry[0] + 1
+            entry[1] = True
+
+    def record_response(self, name, threshold):
+        # A response proves the link is working. Commands that timed out in
+        # threshold separate incidents without ever succeeding are marked
+        # unsupported. Returns the list of newly marked commands
+        self._suspects.pop(name, None)
+        marked = [ ]
+        for suspect, entry in list(self._suspects.items()):
+            entry[1] = False
+            if entry[0] >= threshold:
+                self.unsupported.add(suspect)
+                del self._suspects[suspect]
+                marked.append(suspect)
+        return marked
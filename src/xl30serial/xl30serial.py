@@ -1,7 +1,14 @@
 from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope
 from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_ScanMode, ScanningElectronMicroscope_ImageFilterMode
 from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_NotConnectedException, ScanningElectronMicroscope_CommunicationError
-from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_SpecimenCurrentDetectorMode
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_SpecimenCurrentDetectorMode, ScanningElectronMicroscope_State
+from xl30serial.xl30commands import XL30_COMMANDS, XL30Response, XL30_DETECTOR_TYPES, XL30_DETECTOR_IDS, XL30_LINETIMES, XL30_LINESPERFRAME, build_frame, compile_format
+from xl30serial.xl30metrics import XL30Metrics
+from xl30serial.xl30capture import XL30Capture, CAPTURE_TX, CAPTURE_RX
+from xl30serial.xl30profile import XL30Profile, XL30_PROFILE_DIR
+from xl30serial.xl30errors import XL30TimeoutError, XL30ChecksumError, XL30ProtocolError, XL30DeviceError, XL30UnsupportedCommandError
+from xl30serial.xl30errors import XL30RetryPolicy, RETRY_RAISE, RETRY_RETRY, classify
+from xl30serial.xl30timeouts import XL30AdaptiveTimeouts
 
 import atexit
 import serial
@@ -9,10 +16,26 @@ import logging
 import struct
 import math
 import signal
+import threading
+import inspect
+import copy
+import os
 
-from time import sleep
+from time import sleep, time, perf_counter, monotonic
 
 
+def _f32(value):
+    # Rounds a value to single precision as transmitted on the wire
+    return struct.unpack("<f", struct.pack("<f", float(value)))[0]
+
+def _detach(value):
+    # Cached dictionaries (detector, stage, beam shift, ...) are never handed
+    # out by reference so callers cannot modify the cache. Values inside are
+    # scalars, enums or tuples
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
 # Decorators used in this file
 
 class onlyconnected:
@@ -27,51 +50,428 @@ class onlyconnected:
         return wrapper
 
 class retrylooped:
+    # Repeats the call after communication errors as decided by the retry
+    # policy (xl30errors) of the instance: retry (after a delay), reconnect
+    # or raise. Argument and device errors are raised immediately
     def __init__(self, *args, **kwargs):
         pass
     def __call__(self, func):
         def wrapper(*args, **kwargs):
-            retryCountState = args[0]._retryCount
-            reconnectCountState = args[0]._reconnectCount
+            retries = 0
+            reconnects = 0
 
             while True:
+                args[0]._txState.command = None
                 try:
                     retValue = func(*args, **kwargs)
                     return retValue
                 except Exception as e:
-                    # We have encountered an exception - if we retry we ignore it
-                    args[0]._logger.error(f"[XL30] Encountered communication error:\n{e}")
-                    if retryCountState > 0:
-                        args[0]._logger.warning(f"[XL30] Retrying request (retry {args[0]._retryCount - retryCountState + 1}/{args[0]._retryCount})")
-                        # We can simply retry ...
-                        retryCountState = retryCountState - 1
-                        sleep(args[0]._retryDelay)
+                    # Non idempotent commands may only be repeated if the
+                    # request never left the host
+                    cmd = args[0]._txState.command
+                    idempotent = (cmd is None) or cmd.idempotent or (not args[0]._txState.sent)
+                    action, delay = args[0]._retryPolicy.decide(e, retries, reconnects, idempotent)
+                    if action == RETRY_RAISE:
+                        if classify(e) != "argument":
+                            args[0]._logger.error(f"[XL30] Giving up after {classify(e)} error (retries: {retries}, reconnects: {reconnects}): {e}")
+                        raise
+
+                    args[0]._logger.error(f"[XL30] Encountered communication error ({classify(e)}):\n{e}")
+                    if action == RETRY_RETRY:
+                        retries = retries + 1
+                        args[0]._retryTotal = args[0]._retryTotal + 1
+                        if args[0]._metrics is not None:
+                            args[0]._metrics.inc('retries')
+                        args[0]._logger.warning(f"[XL30] Retrying request (retry {retries}/{args[0]._retryPolicy.retryCount}) in {delay:.2f} s")
+                        if delay > 0:
+                            sleep(delay)
                         continue
-                    else:
-                        # We have to reconnect if we have reconnections available
-                        if reconnectCountState > 0:
-                            args[0]._logger.warning(f"[XL30] Reconnect to XL30 (attempt {args[0]._reconnectCount - reconnectCountState + 1}/{args[0]._reconnectCount})")
-                            args[0]._reconnect()
-                            reconnectCountState = reconnectCountState - 1
-                        else:
-                            args[0]._logger.error(f"[XL30] {args[0]._reconnectCount} reconnection attempts with {args[0]._retryCount} retries each exceeded")
-                            raise
+
+                    reconnects = reconnects + 1
+                    args[0]._logger.warning(f"[XL30] Reconnect to XL30 (attempt {reconnects}/{args[0]._retryPolicy.reconnectCount})")
+                    args[0]._reconnectTotal = args[0]._reconnectTotal + 1
+                    if args[0]._metrics is not None:
+                        args[0]._metrics.inc('reconnects')
+                    args[0]._reconnect()
+        return wrapper
+
+class cachedquery:
+    # Serves a getter from the parameter cache of XL30Serial as long as the
+    # cached value is younger than the staleness window and stores fresh
+    # results in the cache. Does nothing when caching is disabled
+    def __init__(self, param, *args, **kwargs):
+        self._param = param
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            entry = args[0]._cache_get(self._param)
+            if entry is not None:
+                return _detach(entry[0])
+            retValue = func(*args, **kwargs)
+            if (retValue is None) or (retValue is False):
+                return retValue
+            if isinstance(retValue, tuple) and (None in retValue):
+                return retValue
+            args[0]._cache_store(self._param, retValue)
+            return retValue
         return wrapper
 
+# Argument checks of deferrable setters. They run when a call is recorded in
+# a batch so an invalid value fails at the call site instead of half way
+# through the flush (the setters check again when executed)
+
+def _check_range(what, lo, hi):
+    def check(xl, value):
+        if (value < lo) or (value > hi):
+            raise ValueError(f"{what} has to be in range {lo} to {hi}")
+    return check
+
+def _check_detector(xl, detectorId):
+    if detectorId not in xl._detectorIds:
+        raise ValueError(f"Unknown detector {detectorId}")
+
+def _check_linetime(xl, lt):
+    if lt not in XL30_LINETIMES.values():
+        raise ValueError(f"Unsupported line time {lt} ms, only supporting {list(XL30_LINETIMES.values())}")
+
+def _check_linesperframe(xl, lines):
+    if lines not in XL30_LINESPERFRAME.values():
+        raise ValueError(f"Unsupported number of lines {lines}, supporting only {list(XL30_LINESPERFRAME.values())}")
+
+def _check_scanmode(xl, mode):
+    if not isinstance(mode, ScanningElectronMicroscope_ScanMode):
+        raise ValueError("Scan mode has to be a ScanningElectronMicroscope_ScanMode")
+
+def _check_stigmator(xl, x = None, y = None, stigmatorindex = 0):
+    if stigmatorindex != 0:
+        raise ValueError("This device only offers a single stigmator")
+
+class deferrable:
+    # Records the setter call instead of executing it while a batch() is
+    # active. Only the last call per parameter is kept. For merged setters
+    # (partial updates like stage positions or beam shift) the non-None
+    # arguments of all calls are combined into a single call. The optional
+    # check validates the arguments before they are recorded. Outside of a
+    # batch successful calls are recorded as desired state (if enabled) in
+    # the same format
+    def __init__(self, param, order, merge = False, check = None, *args, **kwargs):
+        self._param = param
+        self._order = order
+        self._merge = merge
+        self._check = check
+    def _record(self, entries, sig, name, args, kwargs):
+        if self._merge:
+            bound = sig.bind(*args, **kwargs).arguments
+            merged = { }
+            if self._param in entries:
+                merged = dict(entries[self._param][3])
+            for k in bound:
+                if (k != "self") and (bound[k] is not None):
+                    merged[k] = bound[k]
+            entries[self._param] = ( self._order, name, (), merged )
+        else:
+            entries.pop(self._param, None)
+            entries[self._param] = ( self._order, name, args[1:], kwargs )
+    def __call__(self, func):
+        sig = inspect.signature(func)
+        def wrapper(*args, **kwargs):
+            batch = args[0]._batches.get(threading.get_ident())
+            if batch is None:
+                retValue = func(*args, **kwargs)
+                if retValue and (args[0]._desiredState is not None):
+                    self._record(args[0]._desiredState, sig, func.__name__, args, kwargs)
+                return retValue
+            if self._check is not None:
+                self._check(*args, **kwargs)
+            self._record(batch, sig, func.__name__, args, kwargs)
+            args[0]._logger.debug(f"[XL30] Deferred {func.__name__} in batch")
+            return True
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+class XL30Batch:
+    # Context manager returned by XL30Serial.batch(). Batches are per thread,
+    # nested batches join the outermost one. If the block raises the
+    # collected calls are dropped
+    def __init__(self, xl):
+        self._xl = xl
+        self._owner = False
+        self.results = None
+
+    def __enter__(self):
+        if threading.get_ident() not in self._xl._batches:
+            self._xl._batches[threading.get_ident()] = { }
+            self._owner = True
+        return self
+
+    def __exit__(self, type, value, exc):
+        if not self._owner:
+            return
+        entries = self._xl._batches.pop(threading.get_ident())
+        self._owner = False
+        if type is not None:
+            self._xl._logger.warning(f"[XL30] Dropping {len(entries)} deferred settings due to exception")
+            return
+        with self._xl._lock:
+            self.results = self._xl._batch_flush(entries)
+
+class XL30HighTensionRamp:
+    # Handle for a high tension ramp started by XL30Serial._ramp_hightension.
+    # High tension is known to be enabled so only the voltage (opcode 2) is
+    # polled till it is within the tolerance of the target. progress (0 to 1)
+    # and eta (seconds, None while unknown) are estimated from the first and
+    # the latest sample
+    def __init__(self, xl, target, tolerance, timeout, onDone = None):
+        self._xl = xl
+        self.target = target
+        self.tolerance = tolerance
+        self._timeout = timeout
+        self._onDone = onDone
+        self._samples = []
+        self._done = threading.Event()
+        self._cancelled = False
+        self._result = None
+        self._error = None
+        self._thread = None
+
+    @property
+    def current(self):
+        if len(self._samples) == 0:
+            return None
+        return self._samples[-1][1]
+
+    @property
+    def progress(self):
+        if self._result:
+            return 1.0
+        if len(self._samples) == 0:
+            return 0.0
+        v0 = self._samples[0][1]
+        if self.target == v0:
+            return 1.0
+        return min(1.0, max(0.0, (self._samples[-1][1] - v0) / (self.target - v0)))
+
+    @property
+    def eta(self):
+        if self._done.is_set():
+            return 0
+        if len(self._samples) < 2:
+            return None
+        (t0, v0), (t1, v1) = self._samples[0], self._samples[-1]
+        if (t1 <= t0) or (v1 == v0):
+            return None
+        rate = (v1 - v0) / (t1 - t0)
+        remaining = (self.target - v1) / rate
+        if remaining < 0:
+            return None
+        return remaining
+
+    @property
+    def result(self):
+        return self._result
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout = None):
+        # Blocks till the ramp finished. Returns True if the target has been
+        # reached, False on timeout (of the ramp or of this wait, done() tells
+        # them apart) or cancellation. Errors of the polling are raised
+        if not self._done.wait(timeout):
+            return False
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def cancel(self):
+        # Stops polling (the microscope keeps ramping)
+        self._cancelled = True
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run_background, name = "XL30HighTensionRamp", daemon = True)
+        self._thread.start()
+        return self
+
+    def _run_background(self):
+        # Errors are kept for wait()
+        try:
+            self.run()
+        except Exception:
+            pass
+
+    def run(self):
+        # Polls till the ramp finished. Returns True if the target has been
+        # reached, False on timeout or cancellation. Errors of the polling
+        # (i.e. communication errors) are kept and raised
+        try:
+            self._result = self._xl.wait_until(self._reached, timeout = self._timeout, interval = 0.5, maxInterval = 2, backoff = 1.2) is True
+            if self._cancelled:
+                self._result = False
+        except Exception as e:
+            self._xl._logger.error(f"[XL30] High tension ramp failed: {e}")
+            self._error = e
+            self._result = False
+            raise
+        finally:
+            self._done.set()
+            if self._onDone is not None:
+                self._onDone(self)
+        return self._result
+
+    def _reached(self):
+        if self._cancelled:
+            return "cancelled"
+        resp = self._xl._command("get_hightension")
+        if resp['error']:
+            self._xl._logger.error(f"[XL30] Failed to query high tension. Error code {resp['errorcode']}")
+            return False
+        v = resp['data'][0]
+        self._samples.append(( monotonic(), v ))
+        if abs(v - self.target) < self.tolerance:
+            return True
+        self._xl._logger.info(f"[XL30] Waiting for high tension to reach {self.target}V, currently at {v} (ETA {self.eta})")
+        return False
+
+class XL30AcbMonitor:
+    # Completion detection for auto contrast / brightness, shared with the
+    # asyncio driver. The console acknowledges the command immediately and
+    # adjusts contrast and brightness in steps afterwards, so equal readings
+    # alone prove nothing. A run is finished once a change has been seen and
+    # the values stayed the same for settle seconds. Without any change (ACB
+    # did not start yet or keeps the values) stable readings are accepted
+    # only after minimum seconds - the longest confirmed run so far. Without
+    # such a measurement the timeout of the caller applies
+    def __init__(self, settle = 1, minimum = None):
+        self.settle = settle
+        self.minimum = minimum
+        self.changed = False
+        self.current = None
+        self._since = None
+        self._start = monotonic()
+
+    def update(self, current):
+        now = monotonic()
+        if None in current:
+            return False
+        if current != self.current:
+            if self.current is not None:
+                self.changed = True
+            self.current = current
+            self._since = now
+            return False
+        if now - self._since < self.settle:
+            return False
+        if self.changed:
+            return True
+        return (self.minimum is not None) and (now - self._start >= self.minimum)
+
+    @property
+    def duration(self):
+        # Time from the start till the last observed change (None if nothing
+        # changed)
+        if not self.changed:
+            return None
+        return self._since - self._start
+
+class XL30Heartbeat:
+    # Supervises the link while it is idle. Whenever nothing has been sent for
+    # interval seconds a single ID request (with the given timeout) is issued
+    # - unless another thread is in the middle of a transaction. A missing
+    # response marks the link as dead, calls onDead and (optionally)
+    # reconnects
+    def __init__(self, xl, interval = 5, timeout = 1, onDead = None, reconnect = True):
+        self._xl = xl
+        self.interval = interval
+        self.timeout = timeout
+        self._onDead = onDead
+        self._reconnect = reconnect
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.alive = True
+        self.lastRtt = None
+        self.failures = 0
+
+    def start(self):
+        self._thread = threading.Thread(target = self.run, name = "XL30Heartbeat", daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if (self._thread is not None) and (threading.current_thread() is not self._thread):
+            self._thread.join()
+
+    def run(self):
+        while not self._stop.is_set():
+            idle = monotonic() - self._xl._lastActivity
+            if idle < self.interval:
+                self._stop.wait(self.interval - idle)
+                continue
+            self.beat()
+            self._stop.wait(self.interval)
+
+    def beat(self):
+        # Single supervision cycle. Returns the round trip time or None
+        if not self._xl._lock.acquire(blocking = False):
+            # A transaction is running, the link is obviously in use
+            return None
+        try:
+            if self._xl._port is None:
+                return None
+            tout = self._xl._probeTimeout
+            self._xl._probeTimeout = self.timeout
+            try:
+                rtt = self._xl._probe_id()
+            finally:
+                self._xl._probeTimeout = tout
+        finally:
+            self._xl._lock.release()
+
+        if rtt is not None:
+            self.alive = True
+            self.lastRtt = rtt
+            return rtt
+
+        self.failures = self.failures + 1
+        self._xl._logger.error(f"[XL30] Heartbeat: no response within {self.timeout} s")
+        if self.alive and (self._onDead is not None):
+            self._onDead(self)
+        self.alive = False
+        if self._reconnect and not self._stop.is_set():
+            if self._xl._reconnect():
+                self.alive = True
+        return None
+
 class PreventKeyboardInterrupt:
+    # Defers SIGINT till the end of the guarded block so a request/response
+    # transaction is never interrupted half way. Nested guards (i.e. _msg_tx
+    # inside of a transaction) do not touch the signal handler again. Signal
+    # handlers can only be installed from the main thread, on other threads
+    # the guard does nothing
+    _depth = 0
+
     def __init__(self):
         self._received_signal = None
         self._old_handler = None
+        self._installed = False
 
     def _wrap_handler(self, sig, ctx):
         self._received_signal = (sig, ctx)
 
     def __enter__(self):
+        if (PreventKeyboardInterrupt._depth > 0) or (threading.current_thread() is not threading.main_thread()):
+            return
+        PreventKeyboardInterrupt._depth = 1
+        self._installed = True
         self._received_signal = None
         self._old_handler = signal.signal(signal.SIGINT, self._wrap_handler)
 
     def __exit__(self, type, value, exc):
+        if not self._installed:
+            return
+        self._installed = False
         signal.signal(signal.SIGINT, self._old_handler)
+        PreventKeyboardInterrupt._depth = 0
         if self._received_signal is not None:
             self._old_handler(*self._received_signal)
 
@@ -124,7 +524,7 @@ class XL30(ScanningElectronMicroscope):
         pass
 
 class XL30Serial(XL30):
-    def __init__(self, port, logger = None, debug = False, loglevel = "ERROR", detectorsAutodetect = False, retryCount = 3, reconnectCount = 3, retryDelay = 5, reconnectDelay = 5):
+    def __init__(self, port, logger = None, debug = False, loglevel = "ERROR", detectorsAutodetect = False, retryCount = 3, reconnectCount = 3, retryDelay = 5, reconnectDelay = 5, resyncLimit = 512, pipelineDepth = 4, pipelineTimeout = 1, cacheTimeout = None, baudrate = 9600, exclusive = None, lowLatency = None, latencyTimer = None, interByteTimeout = None, probeTimeout = 2, metrics = None, capture = None, fastReconnect = False, profile = None, unsupportedThreshold = 3, retryPolicy = None, adaptiveTimeouts = None, heartbeat = None, restoreState = False, restoreStage = False):
         super().__init__()
 
         self._retryCount = retryCount
@@ -136,6 +536,54 @@ class XL30Serial(XL30):
         self._retryDelay = retryDelay
         self._reconnectDelay = reconnectDelay
 
+        # Decides on retries, reconnects or failing for errors in retrylooped
+        if retryPolicy is None:
+            retryPolicy = XL30RetryPolicy(retryCount, reconnectCount, retryDelay)
+        self._retryPolicy = retryPolicy
+
+        # Per opcode timeouts learned from the observed latency (xl30timeouts),
+        # None uses the static timeouts of the command table
+        if adaptiveTimeouts is True:
+            adaptiveTimeouts = XL30AdaptiveTimeouts()
+        elif adaptiveTimeouts is False:
+            adaptiveTimeouts = None
+        self._timeouts = adaptiveTimeouts
+
+        # Idle link supervision, started after connecting if an interval in
+        # seconds is passed
+        self._heartbeatInterval = heartbeat
+        self._heartbeat = None
+        self._lastActivity = monotonic()
+
+        # Last command started by _command on the current thread (command)
+        # and if its request has been sent (sent)
+        self._txState = threading.local()
+
+        # Fast reconnects reopen the port immediately and only verify the
+        # cached machine identity instead of running the full initialization
+        self._fastReconnect = fastReconnect
+
+        # Capability profile (xl30profile) stored in the given directory (or
+        # the default directory for True). Loaded after the ID request
+        if profile is True:
+            profile = XL30_PROFILE_DIR
+        self._profileDir = profile
+        self._profile = None
+        self._unsupportedThreshold = unsupportedThreshold
+
+        # Total number of retries and reconnects (since instantiation)
+        self._retryTotal = 0
+        self._reconnectTotal = 0
+
+        # Serial link settings. baudrate may be a list of candidates that are
+        # probed (with a single ID request each) in the given order
+        self._baudrates = list(baudrate) if isinstance(baudrate, (list, tuple)) else [ baudrate ]
+        self._exclusive = exclusive
+        self._lowLatency = lowLatency
+        self._latencyTimer = latencyTimer
+        self._interByteTimeout = interByteTimeout
+        self._probeTimeout = probeTimeout
+
         loglvls = {
             "DEBUG"     : logging.DEBUG,
             "INFO"      : logging.INFO,
@@ -144,57 +592,85 @@ class XL30Serial(XL30):
             "CRITICAL"  : logging.CRITICAL
         }
         self._detectorsAuto = detectorsAutodetect
-        self._detectorTypes = {
-            0 : { 'short' : 'SSD', 'long' : 'Solid State Detector' },
-            1 : { 'short' : 'PMT', 'long' : 'Photo Multiplier' },
-            2 : { 'short' : 'SED', 'long' : 'Photo Multiplier, grid, 10 kV' },
-            3 : { 'short' : 'XAIB', 'long' : 'eXternal Analog Interface Board' },
-            4 : { 'short' : 'MULTIPLE', 'long' : 'Multiple, mixed detector id' }
-        }
-        self._detectorIds = {
-                0 : { 'name' : 'No detector connected',         'type' : None,  'shortname' : None, 'supported' : False },
-                1 : { 'name' : 'Specimen current detector',     'type' : 0,     'shortname' : 'SC', 'supported' : False },
-                2 : { 'name' : 'Cathode Luminescence',          'type' : 1,     'shortname' : 'CL', 'supported' : False },
-                3 : { 'name' : 'Secondary Electron 1',          'type' : 2,     'shortname' : 'SE', 'supported' : False },
-                4 : { 'name' : 'Backscatter Electron',          'type' : 0,     'shortname' : 'BSE', 'supported' : False },
-                5 : { 'name' : 'Robinson Detector',             'type' : 1,     'shortname' : 'RBS', 'supported' : False },
-                6 : { 'name' : 'Secondary Electron 2',          'type' : 2,     'shortname' : 'SE2', 'supported' : False },
-                7 : { 'name' : 'Auxiliary 1',                   'type' : None,  'shortname' : None,  'supported' : False },
-                8 : { 'name' : 'CCD',                           'type' : 0,     'shortname' : 'CCD', 'supported' : False },
-                9 : { 'name' : 'EDX Standard',                  'type' : 3,     'shortname' : 'EDX', 'supported' : False },
-                10 : { 'name' : 'WDX',                          'type' : 3,     'shortname' : 'WDX', 'supported' : False },
-                11 : { 'name' : 'External video',               'type' : 3,     'shortname' : 'EXT', 'supported' : False },
-                12 : { 'name' : 'Phax PV9900',                  'type' : 3,     'shortname' : 'HAX', 'supported' : False },
-                13 : { 'name' : 'EDX Imaging',                  'type' : 3,     'shortname' : 'IMG', 'supported' : False },
-                14 : { 'name' : 'GW Backscatter Electron 1',    'type' : 0,     'shortname' : 'BS1', 'supported' : False },
-                15 : { 'name' : 'GW Backscatter Electron 2',    'type' : 0,     'shortname' : 'BS2', 'supported' : False },
-                16 : { 'name' : 'GW Backscatter Electron 3',    'type' : 0,     'shortname' : 'BS3', 'supported' : False },
-                17 : { 'name' : 'GW Backscatter Electron 4',    'type' : 0,     'shortname' : 'BS4', 'supported' : False },
-                18 : { 'name' : 'Econ 3',                       'type' : 3,     'shortname' : 'EDX', 'supported' : False },
-                19 : { 'name' : 'Econ 4',                       'type' : 3,     'shortname' : 'EDX', 'supported' : False },
-                20 : { 'name' : 'EDX Free',                     'type' : 3,     'shortname' : 'EDX', 'supported' : False },
-                21 : { 'name' : 'MCP_1',                        'type' : 2,     'shortname' : 'MCP', 'supported' : False },
-                22 : { 'name' : 'MCP_2',                        'type' : 2,     'shortname' : 'MCP_1', 'supported' : False },
-                23 : { 'name' : 'Channel Electron Det CED',     'type' : 2,     'shortname' : 'CED', 'supported' : False },
-                24 : { 'name' : 'Electron BackScatter Pattern', 'type' : 2,     'shortname' : 'EBSP', 'supported' : False },
-                25 : { 'name' : 'Gaseous Secondary Electron',   'type' : 2,     'shortname' : 'GSE', 'supported' : False },
-                26 : { 'name' : 'Centaurus',                    'type' : 1,     'shortname' : 'CEN', 'supported' : False },
-                27 : { 'name' : 'STEM Transmission Electron',   'type' : 0,     'shortname' : 'TED', 'supported' : False },
-                28 : { 'name' : 'TLD (SFEG)',                   'type' : 0,     'shortname' : 'TLD', 'supported' : False },
-                29 : { 'name' : 'GBSD (gaseous backscatter)',   'type' : 0,     'shortname' : 'GSE', 'supported' : False },
-                256 : { 'name' : 'Mixed',                       'type' : 4,     'shortname' : 'MIX', 'supported' : False }
-        }
+        self._detectorTypes = XL30_DETECTOR_TYPES
+        self._detectorIds = copy.deepcopy(XL30_DETECTOR_IDS)
 
         if loglevel not in loglvls:
             raise ValueError(f"Unknown log level {loglevel}")
 
-        if isinstance(port, serial.Serial):
-            self._port = port
-            self._portName = None
-            self._initialRequests()
-        else:
-            self._port = None
-            self._portName = port
+        self._rxBuffer = bytearray()
+        self._resyncLimit = resyncLimit
+        self._rxDroppedBytes = 0
+        self._rxLastDropped = 0
+
+        self._pipelineDepth = pipelineDepth
+        self._pipelineTimeout = pipelineTimeout
+
+        # Parameter cache (disabled if cacheTimeout is None). Maps the parameter
+        # name to a tuple of the value (in the format returned by the getter)
+        # and the monotonic timestamp at which it has been stored
+        self._cacheTimeout = cacheTimeout
+        self._cache = { }
+        # Thread that flushes a batch - the cache is used for it even if
+        # caching is disabled
+        self._cachePrimed = None
+
+        # Deferred setter calls while inside of a batch() context (per thread)
+        self._batches = { }
+
+        # Desired state as recorded from successful setters (same format as
+        # batches), re-applied after reconnects. None if disabled
+        self._desiredState = { } if restoreState else None
+        self._restoring = False
+        # Parameters that are recorded but only restored on request. The
+        # stage may have been moved at the console in the meantime, moving
+        # it back silently is not safe
+        self._restoreExcluded = ( ) if restoreStage else ( "stage", )
+
+        # Auto contrast / brightness: duration of the last and the longest
+        # confirmed run (wait hint and minimum, see XL30AcbMonitor, seeded
+        # from the capability profile) and the time values have to be stable
+        self._acbExpected = None
+        self._acbMaximum = None
+        self._acbSettle = 1
+
+        # Serializes transactions on the port when the instance is shared
+        # between threads
+        self._lock = threading.RLock()
+
+        # Wire level instrumentation (xl30metrics). None disables all hooks,
+        # True attaches a new XL30Metrics instance
+        if metrics is True:
+            metrics = XL30Metrics()
+        elif metrics is False:
+            metrics = None
+        self._metrics = metrics
+        # Pending transactions as ( opcode, perf_counter timestamp ) of the
+        # frames transmitted by the last write, oldest first
+        self._metricsTx = None
+
+        # Binary capture of the wire traffic (xl30capture). A path is opened
+        # (and closed again by _close), a passed XL30Capture is only flushed
+        self._captureOwned = isinstance(capture, str)
+        if self._captureOwned:
+            capture = XL30Capture(capture)
+        self._capture = capture
+
+        # Commands and parsers used to assemble state snapshots (get_state)
+        self._stateFields = {
+            'hightension'   : ( ( "get_hightension_status", "get_hightension" ),  self._parse_hightension ),
+            'spotsize'      : ( ( "get_spotsize", ),                            self._parse_spotsize ),
+            'magnification' : ( ( "get_magnification", ),                       self._parse_magnification ),
+            'detector'      : ( ( "get_detector", ),                            self._parse_detector ),
+            'scanmode'      : ( ( "get_scanmode", ),                            self._parse_scanmode ),
+            'contrast'      : ( ( "get_contrast", ),                            self._parse_contrast ),
+            'brightness'    : ( ( "get_brightness", ),                          self._parse_brightness ),
+            'stage'         : ( ( "get_stage_position", ),                      self._parse_stage_position ),
+            'beamshift'     : ( ( "get_beamshift", ),                           self._parse_beamshift ),
+            'imagefilter'   : ( ( "get_imagefilter_mode", ),                    self._parse_imagefilter_mode ),
+            'linetime'      : ( ( "get_linetime", ),                            self._parse_linetime ),
+            'linesperframe' : ( ( "get_linesperframe", ),                       self._parse_linesperframe )
+        }
 
         self._debug = debug
         if logger is not None:
@@ -210,6 +686,19 @@ class XL30Serial(XL30):
         self._machine_type = None
         self._machine_serial = None
 
+        # Either a port name or an already opened port. Any object offering
+        # read, write, in_waiting and timeout like serial.Serial is accepted
+        # (i.e. wrappers or simulated ports)
+        if (port is not None) and not isinstance(port, str):
+            self._port = port
+            self._portObject = port
+            self._portName = None
+            self._initialRequests()
+        else:
+            self._port = None
+            self._portObject = None
+            self._portName = port
+
         atexit.register(self._close)
 
     def __enter__(self):
@@ -219,14 +708,7 @@ class XL30Serial(XL30):
 
         if (self._port is None) and (self._portName is not None):
             self._logger.debug(f"[XL30] Connecting to XL30 on serial port {self._portName}")
-            self._port = serial.Serial(
-                    self._portName,
-                    baudrate = 9600,
-                    bytesize = serial.EIGHTBITS,
-                    parity = serial.PARITY_NONE,
-                    stopbits = serial.STOPBITS_ONE,
-                    timeout = 60
-            )
+            self._open_port()
             self._initialRequests()
         else:
             self._logger.debug("[XL30] Not executing connect - either port already passed or no name present")
@@ -242,28 +724,187 @@ class XL30Serial(XL30):
     def _close(self):
         self._logger.debug("[XL30] Close called")
         atexit.unregister(self._close)
+        self._stop_heartbeat()
         if (self._port is not None) and (self._portName is not None):
             self._logger.debug("[XL30] Closing serial port")
             self._port.close()
             self._port = None
+        self._rxBuffer.clear()
+        if self._profile is not None:
+            self._profile_save()
+        if self._capture is not None:
+            if self._captureOwned:
+                self._capture.close()
+            else:
+                self._capture.flush()
 
     def _connect(self):
         self._logger.debug("[XL30] Connect called")
         if (self._port is None) and (self._portName is not None):
             self._logger.debug(f"[XL30] Connecting to serial port {self._portName}")
-            self._port = serial.Serial(
-                    self._portName,
-                    baudrate = 9600,
-                    bytesize = serial.EIGHTBITS,
-                    parity = serial.PARITY_NONE,
-                    stopbits = serial.STOPBITS_ONE,
-                    timeout = 60
-            )
+            self._open_port()
+            self._initialRequests()
+        elif (self._port is None) and (self._portObject is not None):
+            # Passed ports are not reopened, only resynchronized
+            self._port = self._portObject
             self._initialRequests()
         else:
             self._logger.debug("[XL30] Not opening serial port - either port has been passed or no port name present")
         return True
 
+    def _open_port(self, baudrate = None):
+        # Opens the port at the given baud rate or probes the configured
+        # candidates if none is passed
+        self._port = serial.Serial(
+                self._portName,
+                baudrate = baudrate if baudrate is not None else self._baudrates[0],
+                bytesize = serial.EIGHTBITS,
+                parity = serial.PARITY_NONE,
+                stopbits = serial.STOPBITS_ONE,
+                timeout = 60,
+                inter_byte_timeout = self._interByteTimeout,
+                exclusive = self._exclusive
+        )
+        self._set_low_latency(self._lowLatency, self._latencyTimer)
+        if (baudrate is None) and (len(self._baudrates) > 1):
+            if self._probe_baudrate(self._baudrates) is None:
+                self._port.close()
+                self._port = None
+                raise ScanningElectronMicroscope_CommunicationError(f"XL30 did not respond at any of the baud rates {self._baudrates}")
+
+    def _set_low_latency(self, lowLatency, latencyTimer = None):
+        # Sets the Linux low latency flag of the serial driver and the latency
+        # timer (ms) of USB serial adapters (FTDI and similar buffer received
+        # data for up to 16 ms by default). Both are optional and only log a
+        # warning if not supported by the platform or adapter. Returns False if
+        # one of the requested settings could not be applied
+        applied = True
+        if lowLatency is not None:
+            try:
+                self._port.set_low_latency_mode(bool(lowLatency))
+            except (AttributeError, NotImplementedError, ValueError, OSError) as e:
+                if lowLatency:
+                    self._logger.warning(f"[XL30] Failed to set low latency mode: {e}")
+                    applied = False
+
+        if latencyTimer is not None:
+            fname = None
+            if self._portName is not None:
+                fname = f"/sys/bus/usb-serial/devices/{os.path.basename(os.path.realpath(self._portName))}/latency_timer"
+            try:
+                with open(fname, "w") as f:
+                    f.write(f"{int(latencyTimer)}\n")
+                self._logger.debug(f"[XL30] Set USB latency timer to {latencyTimer} ms")
+            except (TypeError, OSError) as e:
+                self._logger.warning(f"[XL30] Failed to set USB latency timer: {e}")
+                applied = False
+        return applied
+
+    def _get_latency_timer(self):
+        if self._portName is None:
+            return None
+        try:
+            with open(f"/sys/bus/usb-serial/devices/{os.path.basename(os.path.realpath(self._portName))}/latency_timer") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _probe_id(self):
+        # Single ID request with a short timeout and without retries. Returns
+        # the round trip time in seconds or None if the console did not answer
+        try:
+            self._rx_discard(0.05)
+            t0 = perf_counter()
+            resp = self._command("get_id", timeout = self._probeTimeout)
+            rtt = perf_counter() - t0
+        except (ScanningElectronMicroscope_CommunicationError, ValueError, serial.SerialException, OSError) as e:
+            # A lost port (SerialException is an OSError) is a dead link as well
+            self._logger.debug(f"[XL30] Probe failed: {e}")
+            return None
+        if resp['error'] or (resp['data'][0] not in ( 2, 3, 4 )):
+            return None
+        return rtt
+
+    @onlyconnected()
+    def _probe_baudrate(self, baudrates):
+        # Tries the candidate baud rates in order and keeps the first one at
+        # which the console answers an ID request
+        for baud in baudrates:
+            self._port.baudrate = baud
+            self._rxBuffer.clear()
+            if self._probe_id() is not None:
+                self._logger.info(f"[XL30] Console responds at {baud} baud")
+                return baud
+            self._logger.debug(f"[XL30] No response at {baud} baud")
+        return None
+
+    @onlyconnected()
+    def _link_selftest(self, settings = None, count = 10, keepBest = False):
+        # Measures the round trip time of ID requests for each link setting.
+        # A setting is a dictionary with any of baudrate, lowLatency,
+        # latencyTimer and interByteTimeout. Returns a list of reports (the
+        # setting and minimum, median and maximum RTT in seconds as well as the
+        # number of failed requests and if the setting could be applied at
+        # all). Afterwards the original settings are restored or - with
+        # keepBest - the setting with the lowest median RTT is kept
+        if settings is None:
+            settings = [
+                { 'lowLatency' : False },
+                { 'lowLatency' : True },
+                { 'lowLatency' : True, 'latencyTimer' : 1 }
+            ]
+
+        original = {
+            'baudrate' : self._port.baudrate,
+            'lowLatency' : self._lowLatency,
+            'latencyTimer' : self._get_latency_timer(),
+            'interByteTimeout' : self._port.inter_byte_timeout
+        }
+
+        reports = []
+        for setting in settings:
+            applied = self._apply_link_setting(setting)
+            rtts = []
+            errors = 0
+            for i in range(count):
+                rtt = self._probe_id()
+                if rtt is None:
+                    errors = errors + 1
+                else:
+                    rtts.append(rtt)
+            rtts.sort()
+            report = {
+                'setting' : dict(setting),
+                'applied' : applied,
+                'rtt_min' : rtts[0] if len(rtts) > 0 else None,
+                'rtt_median' : rtts[len(rtts) // 2] if len(rtts) > 0 else None,
+                'rtt_max' : rtts[-1] if len(rtts) > 0 else None,
+                'errors' : errors
+            }
+            self._logger.info(f"[XL30] Link test {setting}: median RTT {report['rtt_median']} s, {errors} errors")
+            reports.append(report)
+
+        usable = [ r for r in reports if r['applied'] and (r['errors'] == 0) and (r['rtt_median'] is not None) ]
+        if keepBest and (len(usable) > 0):
+            best = min(usable, key = lambda r: r['rtt_median'])['setting']
+            self._apply_link_setting(dict(original, **best))
+        else:
+            self._apply_link_setting(original)
+        return reports
+
+    def _apply_link_setting(self, setting):
+        applied = True
+        if 'baudrate' in setting:
+            self._port.baudrate = setting['baudrate']
+        if 'interByteTimeout' in setting:
+            self._port.inter_byte_timeout = setting['interByteTimeout']
+            self._interByteTimeout = setting['interByteTimeout']
+        if ('lowLatency' in setting) or ('latencyTimer' in setting):
+            self._lowLatency = setting.get('lowLatency', self._lowLatency)
+            applied = self._set_low_latency(self._lowLatency, setting.get('latencyTimer'))
+        self._rxBuffer.clear()
+        return applied
+
     def _disconnect(self):
         self._logger.debug("[XL30] Disconnect called")
         if (self._port is not None):
@@ -272,23 +913,133 @@ class XL30Serial(XL30):
 
     def _reconnect(self):
         self._logger.debug("[XL30] Trying to reconenct")
-        if (self._port is not None):
+        with self._lock:
+            baudrate = getattr(self._port, 'baudrate', None)
+            if (self._port is not None):
+                if self._portName is not None:
+                    try:
+                        self._port.close()
+                    except:
+                        pass
+                self._port = None
+            self._rxBuffer.clear()
+            self._cache_invalidate()
+
+            if self._fastReconnect and (self._machine_type is not None):
+                if self._reconnect_fast(baudrate):
+                    self._restore_desired_state()
+                    return True
+                self._logger.warning("[XL30] Fast reconnect failed, falling back to full initialization")
+
+            # Short sleep
+            sleep(2)
+
+            # Reconnect
             try:
-                self._port.close()
+                self._connect()
             except:
-                pass
-            self._port = None
+                return False
+            self._restore_desired_state()
+            return True
 
-        # Short sleep
-        sleep(2)
+    def _restore_desired_state(self):
+        # Re-applies the recorded desired state after a reconnect. Like a
+        # batch the current values are read once and only differing settings
+        # are sent in batch order. Failures are logged, the reconnect itself
+        # stays successful
+        if (self._desiredState is None) or self._restoring:
+            return None
+        entries = { p : e for p, e in self._desiredState.items() if p not in self._restoreExcluded }
+        if len(entries) == 0:
+            return None
+        self._restoring = True
+        try:
+            self._logger.info(f"[XL30] Restoring desired state {list(entries)} after reconnect")
+            return self._batch_flush(entries)
+        except Exception as e:
+            self._logger.error(f"[XL30] Failed to restore desired state after reconnect: {e}")
+            return None
+        finally:
+            self._restoring = False
+
+    def _get_desired_state(self):
+        # Recorded desired state as parameter -> ( setter, args, kwargs )
+        if self._desiredState is None:
+            return None
+        return { p : ( name, args, dict(kwargs) ) for p, (order, name, args, kwargs) in self._desiredState.items() }
+
+    def _clear_desired_state(self, params = None):
+        # Forgets the given (or all) parameters so they are not restored
+        if self._desiredState is None:
+            return
+        if params is None:
+            self._desiredState.clear()
+            return
+        for p in params:
+            self._desiredState.pop(p, None)
+
+    def _reconnect_fast(self, baudrate = None):
+        # Reopens the port immediately (backing off only while opening fails),
+        # drops pending bytes and verifies the cached identity with a single
+        # ID request. Leaves the port closed if anything fails
+        t0 = monotonic()
+        delay = 0.05
+        while self._port is None:
+            try:
+                if self._portName is not None:
+                    self._open_port(baudrate)
+                else:
+                    self._port = self._portObject
+            except (serial.SerialException, OSError, ScanningElectronMicroscope_CommunicationError) as e:
+                if monotonic() - t0 + delay > self._reconnectDelay:
+                    self._logger.error(f"[XL30] Failed to reopen port: {e}")
+                    return False
+                sleep(delay)
+                delay = min(delay * 2, self._reconnectDelay)
 
-        # Reconnect
         try:
-            self._connect()
-            return True
-        except:
+            self._rx_discard_pending()
+            mid = self._parse_id(self._command("get_id", timeout = self._probeTimeout))
+        except (ScanningElectronMicroscope_CommunicationError, ValueError, serial.SerialException, OSError) as e:
+            self._logger.error(f"[XL30] No valid ID response after reconnect: {e}")
+            mid = None
+
+        if (mid is None) or (mid['type'] != self._machine_type) or (mid['serial'] != self._machine_serial):
+            if mid is not None:
+                self._logger.error(f"[XL30] Reconnected to {mid['type']} {mid['serial']} instead of {self._machine_type} {self._machine_serial}")
+            if self._portName is not None:
+                try:
+                    self._port.close()
+                except:
+                    pass
+            self._port = None
+            self._rxBuffer.clear()
             return False
 
+        self._logger.info(f"[XL30] Reconnected in {monotonic() - t0:.3f} s")
+        return True
+
+    def _rx_discard_pending(self):
+        # Drops the receive buffer and everything that is already waiting in
+        # the driver without waiting for the line to become silent
+        dropped = len(self._rxBuffer)
+        self._rxBuffer.clear()
+        while True:
+            waiting = self._rx_waiting()
+            if waiting <= 0:
+                break
+            data = self._port.read(waiting)
+            if not data:
+                break
+            if self._capture is not None:
+                self._capture.record(CAPTURE_RX, data)
+            if self._metrics is not None:
+                self._metrics.inc('rx_bytes', len(data))
+            dropped = dropped + len(data)
+        if dropped > 0:
+            self._logger.debug(f"[XL30] Discarded {dropped} pending bytes")
+        return dropped
+
     @onlyconnected()
     def _msg_tx(
         self,
@@ -301,156 +1052,595 @@ class XL30Serial(XL30):
             raise ValueError("Command not transmitable")
 
         if fill is not None:
-            payload = b''
-            for i in range(fill):
-                payload = payload + bytes([0])
-
-        if payload is not None:
-            if len(payload) > 255-5:
-                self._logger.error(f"[XL30] Requested amount of data ({len(payload)} bytes) out of range for single message block")
-                raise ValueError("Payload exceeds single message size")
-            payloadSize = len(payload)
-        else:
-            payloadSize = 0
+            payload = bytes(fill)
 
-        msg = b''
-        msg = bytes([0x05, payloadSize + 5, opCode, 0x00])
-        if payload is not None:
-            msg += bytes(payload)
+        if (payload is not None) and (len(payload) > 255-5):
+            self._logger.error(f"[XL30] Requested amount of data ({len(payload)} bytes) out of range for single message block")
+            raise ValueError("Payload exceeds single message size")
 
-        # Checksum calculation
-        chksum = 0
-        for b in msg:
-            chksum = (chksum + b) % 256
+        with PreventKeyboardInterrupt():
+            self._frame_tx(build_frame(opCode, payload))
 
-        msg += bytes([chksum])
+        return True
 
+    def _frame_tx(self, msg):
         # Transmit message
-        self._logger.debug(f"[XL30] TX: {msg}")
-
-        with PreventKeyboardInterrupt():
-            self._port.write(msg)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"[XL30] TX: {msg}")
+        self._port.write(msg)
+        self._lastActivity = monotonic()
+        if self._capture is not None:
+            self._capture.record(CAPTURE_TX, msg)
+        if self._metrics is not None:
+            self._metrics.inc('tx_bytes', len(msg))
+            # Pipelined windows are written at once, every frame is a
+            # pending transaction of its own
+            t = perf_counter()
+            pending = [ ]
+            i = 0
+            while i + 2 < len(msg):
+                pending.append(( msg[i + 2], t ))
+                i = i + max(5, msg[i + 1])
+            self._metricsTx = pending
+
+    def _rx_fill(self, n, timeout = None):
+        # Make sure at least n bytes are present in the receive buffer. The
+        # missing bytes are requested with a single read (which blocks till
+        # they arrived or the timeout elapsed) - in case more bytes are already
+        # waiting they are fetched too and kept for the next frame
+        missing = n - len(self._rxBuffer)
+        if missing <= 0:
+            return True
 
+        if timeout is not None:
+            oldTimeout = self._port.timeout
+            self._port.timeout = timeout
+        try:
+            while missing > 0:
+                data = self._port.read(max(missing, self._rx_waiting()))
+                if not data:
+                    return False
+                self._rxBuffer += data
+                if self._capture is not None:
+                    self._capture.record(CAPTURE_RX, data)
+                if self._metrics is not None:
+                    self._metrics.inc('rx_bytes', len(data))
+                missing = n - len(self._rxBuffer)
+        finally:
+            if timeout is not None:
+                self._port.timeout = oldTimeout
         return True
 
+    def _rx_waiting(self):
+        try:
+            return self._port.in_waiting
+        except Exception:
+            return 0
+
+    def _rx_drop(self, n):
+        del self._rxBuffer[:n]
+        return n
+
+    def _rx_frame(self):
+        # Reads a single frame from the receive buffer (and the port). Returns
+        # the frame as bytes object or None in case nothing has been received.
+        #
+        # In case of garbage on the line (unexpected ID byte, implausible length
+        # or checksum mismatch) the parser scans forward for the next plausible
+        # frame instead of giving up. The number of discarded bytes is reported
+        # via _rxLastDropped and accumulated in _rxDroppedBytes
+        dropped = 0
+        corrupted = False
+
+        try:
+            while True:
+                if dropped > self._resyncLimit:
+                    self._logger.error(f"[XL30] Failed to resynchronize after dropping {dropped} bytes")
+                    dropped = dropped + self._rx_drop(len(self._rxBuffer))
+                    raise XL30ProtocolError(f"Failed to resynchronize after dropping {dropped} bytes")
+
+                if corrupted and (self._rxBuffer.find(0x05) < 0) and (self._rx_waiting() == 0):
+                    # The response has been corrupted and nothing follows, waiting
+                    # for the timeout would not yield any valid frame
+                    dropped = dropped + self._rx_drop(len(self._rxBuffer))
+                    raise XL30ChecksumError("Invalid checksum, no further frame received")
+
+                if not self._rx_fill(2):
+                    if dropped > 0:
+                        self._logger.error(f"[XL30] Timeout during resynchronization after dropping {dropped} bytes")
+                        dropped = dropped + self._rx_drop(len(self._rxBuffer))
+                        raise XL30ProtocolError("Invalid message response: Timeout during resynchronization")
+                    if len(self._rxBuffer) == 0:
+                        # Timeout indicates no message has been received
+                        self._logger.warning("[XL30] Timeout during RX")
+                        return None
+                    # Communication error, not enough bytes received in one timeout - no valid message received
+                    self._logger.warning("[XL30] Incomplete message during RX")
+                    self._rxBuffer.clear()
+                    return None
+
+                start = self._rxBuffer.find(0x05)
+                if start != 0:
+                    if start < 0:
+                        start = len(self._rxBuffer)
+                    self._logger.debug(f"[XL30] Invalid message response, skipping {start} bytes till next frame ID")
+                    dropped = dropped + self._rx_drop(start)
+                    continue
+
+                msgLen = self._rxBuffer[1]
+                if msgLen < 5:
+                    self._logger.debug(f"[XL30] Invalid message response, frame length {msgLen} below minimum of 5 bytes")
+                    dropped = dropped + self._rx_drop(1)
+                    continue
+
+                if dropped > 0:
+                    # While resynchronizing we do not trust the length field so we
+                    # only wait as long as a frame of that size would take on the wire
+                    bodyTimeout = msgLen * 11 / getattr(self._port, 'baudrate', 9600) + 0.5
+                else:
+                    bodyTimeout = None
+
+                if not self._rx_fill(msgLen, timeout = bodyTimeout):
+                    if self._rxBuffer.find(0x05, 1) > 0:
+                        dropped = dropped + self._rx_drop(1)
+                        continue
+                    # Timeout - no valid message received
+                    self._logger.error(f"[XL30] Invalid message response. Partial message: {bytes(self._rxBuffer)}")
+                    dropped = dropped + self._rx_drop(len(self._rxBuffer))
+                    raise XL30ProtocolError("Invalid message response: Timeout, partial message")
+
+                # Checksum verification
+                if (sum(self._rxBuffer[:msgLen - 1]) & 0xFF) != self._rxBuffer[msgLen - 1]:
+                    self._logger.error(f"[XL30] Communication error: RX invalid checksum: {bytes(self._rxBuffer[:msgLen])}")
+                    corrupted = True
+                    if self._metrics is not None:
+                        self._metrics.inc('checksum_failures')
+                    dropped = dropped + self._rx_drop(1)
+                    continue
+
+                # Take the frame out of the receive buffer, any trailing bytes
+                # are kept for the next frame
+                msg = bytes(self._rxBuffer[:msgLen])
+                del self._rxBuffer[:msgLen]
+                if (self._metrics is not None) and self._metricsTx and (self._metricsTx[0][0] == msg[2]):
+                    # Stale or late frames of other opcodes do not complete
+                    # the pending transaction
+                    opcode, t = self._metricsTx.pop(0)
+                    self._metrics.observe(opcode, perf_counter() - t)
+                return msg
+        finally:
+            self._rxLastDropped = dropped
+            if dropped > 0:
+                self._rxDroppedBytes = self._rxDroppedBytes + dropped
+                if self._metrics is not None:
+                    self._metrics.inc('rx_dropped_bytes', dropped)
+                self._logger.warning(f"[XL30] Resynchronized receive stream, dropped {dropped} bytes")
+
     @onlyconnected()
     def _msg_rx(
         self,
         fmt = None
     ):
         with PreventKeyboardInterrupt():
-            msg = self._port.read(2)
-            if msg == b'':
-                # Timeout indicates no message has been received
-                self._logger.warning("[XL30] Timeout during RX")
-                return None
+            msg = self._rx_frame()
+        if msg is None:
+            if (self._metrics is not None) and self._metricsTx:
+                self._metrics.timeout(self._metricsTx[0][0])
+                self._metricsTx = None
+            return None
+        return self._rx_response(msg, fmt)
 
-            if len(msg) != 2:
-                # Communication error, not enough bytes received in one timeout - no valid message received
-                self._logger.warning("[XL30] Incomplete message during RX")
-                return None
+    def _rx_response(self, msg, fmt = None):
+        msgLen = msg[1]
 
-            if msg[0] != 0x05:
-                self._logger.error(f"[XL30] Invalid message response. Expecting ID 0x05, got {msg[0]}")
-                raise ScanningElectronMicroscope_CommunicationError("Invalid message response")
+        # Verify status bits
+        status = msg[3]
+        if status & 0x3F != 0:
+            if self._metrics is not None:
+                self._metrics.inc('status_errors')
+            self._logger.error(f"[XL30] Invalid status bits set on RX: {status}")
+            raise XL30ProtocolError(f"Invalid status bits set {status}")
+
+        # If requested the payload is parsed according to the specification.
+        # This is either a precompiled struct.Struct (as used by the command
+        # table) or a specification string. Allowed entries are:
+        #   b   Sequence of 4 bytes
+        #   i   Two 16 bit integer values
+        #   f   Single 32 bit float
+        #
+        #   e   Error Code (assumed automatically if error bit is set)
+        #
+        # Only the length is verified here, decoding happens lazily when the
+        # fields of the returned XL30Response are accessed
+
+        if status & 0x80 != 0:
+            if self._metrics is not None:
+                self._metrics.inc('error_responses')
+            if (msgLen - 5) < 4:
+                self._logger.error(f"[XL30] Expected error code - but got {msgLen - 5} bytes instead of 4")
+                raise XL30ProtocolError(f"Expected error code - but got {msgLen - 5} bytes instead of 4")
+        elif fmt is not None:
+            if not isinstance(fmt, struct.Struct):
+                fmt = compile_format(fmt)
+            if (msgLen - 5) < fmt.size:
+                self._logger.error(f"[XL30] Requested parsing according to {fmt.format} ({fmt.size} bytes) but got only {msgLen - 5} payload bytes")
+                raise XL30ProtocolError(f"Requested parsing according to {fmt.format} ({fmt.size} bytes) but got only {msgLen - 5} payload bytes")
+
+        msgp = XL30Response(msg, fmt)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(f"[XL30] RX: {msg} {msgp}")
+        return msgp
 
-            msgLen = msg[1]
-            toRead = msgLen - 2
+    @onlyconnected()
+    def _command(self, name, *args, payload = None, timeout = None):
+        # Executes a single command from the command table (xl30commands). The
+        # request is encoded from the passed arguments (or the raw payload
+        # for variable length commands) and the response decoded with the
+        # precompiled response layout
+        cmd = XL30_COMMANDS[name]
+        if self._profile is not None:
+            if name in self._profile.unsupported:
+                raise XL30UnsupportedCommandError(f"Command {name} is not supported by this microscope (profile {self._profile.path})")
+        if cmd.invalidates is not None:
+            self._cache_invalidate(cmd.invalidates)
 
-            while toRead > 0:
-                b = self._port.read(1)
-                if b == b'':
-                    # Timeout - no valid message received
-                    self._logger.error(f"[XL30] Invalid message response. Partial message: {msg}")
-                    raise ScanningElectronMicroscope_CommunicationError("Invalid message response: Timeout, partial message")
-                toRead = toRead - 1
-                msg += b
+        if payload is not None:
+            frame = build_frame(cmd.opcode, payload)
+        elif cmd.frame is not None:
+            # Constant requests (queries) are assembled only once
+            frame = cmd.frame
+        else:
+            frame = build_frame(cmd.opcode, cmd.encode(*args))
+
+        # Explicit timeout, learned timeout or the static one of the table
+        if timeout is None:
+            timeout = self._timeouts.timeout(cmd) if self._timeouts is not None else cmd.timeout
+        # One interrupt guard for the whole request/response transaction,
+        # the lock keeps transactions of different threads apart (including
+        # the port timeout that is swapped for this command)
+        with self._lock, PreventKeyboardInterrupt():
+            if timeout is not None:
+                tout = self._port.timeout
+                self._port.timeout = timeout
+            try:
+                # Round trip time starts once the port is ours (waiting for
+                # other threads is not latency of the console)
+                if (self._profile is not None) or (self._timeouts is not None):
+                    t0 = perf_counter()
+                self._txState.command = cmd
+                self._txState.sent = False
+                self._frame_tx(frame)
+                self._txState.sent = True
+                msg = self._rx_frame()
+                while (msg is not None) and (msg[2] != cmd.opcode):
+                    # Stale (i.e. duplicated or late) response to an earlier request
+                    self._logger.warning(f"[XL30] Discarding unexpected response with opcode {msg[2]} while waiting for {name}")
+                    msg = self._rx_frame()
+            finally:
+                if timeout is not None:
+                    self._port.timeout = tout
+
+        resp = None
+        if msg is not None:
+            resp = self._rx_response(msg, cmd.response)
+        elif self._metrics is not None:
+            self._metrics.timeout(cmd.opcode)
+
+        if self._timeouts is not None:
+            if resp is None:
+                self._timeouts.expired(cmd)
+            else:
+                self._timeouts.observe(cmd, perf_counter() - t0)
 
-        # Checksum verification
-        chksum = 0
-        for i in range(len(msg) - 1):
-            chksum = (chksum + msg[i]) % 256
+        if self._profile is not None:
+            if resp is None:
+                self._profile.record_timeout(name)
+            else:
+                self._profile.record_timing(name, perf_counter() - t0)
+                marked = self._profile.record_response(name, self._unsupportedThreshold)
+                if len(marked) > 0:
+                    self._logger.warning(f"[XL30] Commands {marked} never answered, marking them as unsupported")
+                    self._profile_save()
+
+        if resp is None:
+            self._logger.error(f"[XL30] Timeout while waiting for response to {name}")
+            raise XL30TimeoutError(f"Timeout while waiting for response to {name}")
+
+        if (self._desiredState is not None) and isinstance(cmd.invalidates, tuple) and not resp['error']:
+            # The microscope changed these parameters on its own (i.e. auto
+            # contrast), previously set values are no longer desired
+            for p in cmd.invalidates:
+                self._desiredState.pop(p, None)
+        return resp
 
-        if chksum != msg[-1]:
-            self._logger.error(f"[XL30] Communication error: RX invalid checksum: {msg}")
-            raise ScanningElectronMicroscope_CommunicationError(f"Invalid checksum on message {msg}")
+    def _rx_discard(self, timeout):
+        # Discards everything that is received till the line has been silent
+        # for the given time (i.e. responses still in flight)
+        with self._lock:
+            return self._rx_discard_locked(timeout)
 
-        # Verify status bits
-        if int(msg[3]) & 0x3F != 0:
-            self._logger.error(f"[XL30] Invalid status bits set on RX: {msg[3]}")
-            raise ScanningElectronMicroscope_CommunicationError(f"Invalid status bits set {msg[3]}")
+    def _rx_discard_locked(self, timeout):
+        tout = self._port.timeout
+        self._port.timeout = timeout
+        try:
+            while True:
+                data = self._port.read(max(1, self._rx_waiting()))
+                if not data:
+                    break
+                self._rxBuffer += data
+                if self._capture is not None:
+                    self._capture.record(CAPTURE_RX, data)
+                if self._metrics is not None:
+                    self._metrics.inc('rx_bytes', len(data))
+        finally:
+            self._port.timeout = tout
+        dropped = len(self._rxBuffer)
+        self._rxBuffer.clear()
+        return dropped
 
-        self._logger.debug(f"RX: {msg}")
+    @onlyconnected()
+    def _pipelined(self, requests, timings = None):
+        # Executes a list of independent read-only commands. Up to _pipelineDepth
+        # requests are transmitted back to back before waiting for the responses
+        # so only a single round trip is paid per window. Responses are matched
+        # to the requests by their opcode in order.
+        #
+        # Requests are given as command names or tuples (name, arg1, ...). The
+        # list of XL30Response records is returned in the order of the requests.
+        # If a timings list is passed the perf_counter value at which each
+        # response has been received is stored at the same index.
+        #
+        # In case the console does not answer all requests of a window (missing
+        # response or unexpected opcode) the depth is reduced to the number of
+        # answered requests (down to sequential operation) and the unanswered
+        # requests are repeated
+        cmds = []
+        for req in requests:
+            if isinstance(req, str):
+                name, args = req, ()
+            else:
+                name, args = req[0], tuple(req[1:])
+            cmd = XL30_COMMANDS[name]
+            if not cmd.readonly:
+                raise ValueError(f"Command {name} is not read-only and cannot be pipelined")
+            cmds.append((cmd, args))
+
+        results = [ None ] * len(cmds)
+        idx = 0
+        while idx < len(cmds):
+            depth = min(self._pipelineDepth, len(cmds) - idx)
+            if depth <= 1:
+                cmd, args = cmds[idx]
+                results[idx] = self._command(cmd.name, *args)
+                if timings is not None:
+                    timings[idx] = perf_counter()
+                idx = idx + 1
+                continue
+
+            received = self._pipeline_window(cmds[idx : idx + depth], results, idx, timings)
+            if received < depth:
+                self._logger.warning(f"[XL30] Console answered only {received} of {depth} pipelined requests, reducing pipeline depth to {max(1, received)}")
+                self._pipelineDepth = max(1, received)
+                self._rx_discard(self._pipelineTimeout)
+            idx = idx + received
+
+        return results
+
+    def _pipeline_window(self, window, results, offset, timings = None):
+        frames = bytearray()
+        for cmd, args in window:
+            if cmd.frame is not None:
+                frames += cmd.frame
+            else:
+                frames += build_frame(cmd.opcode, cmd.encode(*args))
 
-        isError = False
-        if int(msg[3]) & 0x80 != 0:
-            isError = True
+        received = 0
+        self._lock.acquire()
+        tout = self._port.timeout
+        if self._timeouts is not None:
+            self._port.timeout = max([ self._timeouts.timeout(cmd) for cmd, args in window ])
+        try:
+            with PreventKeyboardInterrupt():
+                self._frame_tx(bytes(frames))
+                for i, (cmd, args) in enumerate(window):
+                    if i == 1:
+                        # Subsequent responses have to follow closely
+                        self._port.timeout = self._pipelineTimeout
+                    try:
+                        msg = self._rx_frame()
+                        if (msg is None) or (msg[2] != cmd.opcode):
+                            if (msg is None) and (self._metrics is not None):
+                                self._metrics.timeout(cmd.opcode)
+                            break
+                        results[offset + i] = self._rx_response(msg, cmd.response)
+                        if timings is not None:
+                            timings[offset + i] = perf_counter()
+                    except (ScanningElectronMicroscope_CommunicationError, ValueError) as e:
+                        self._logger.warning(f"[XL30] Failed to receive pipelined response to {cmd.name}: {e}")
+                        break
+                    received = received + 1
+        finally:
+            self._port.timeout = tout
+            self._lock.release()
+        return received
 
-        payload = None
-        if msgLen > 5:
-            payload = msg[4 : -1]
+    def _get_metrics(self):
+        # Snapshot of the wire metrics (see XL30Metrics.stats) or None in
+        # case instrumentation is disabled
+        if self._metrics is None:
+            return None
+        return self._metrics.stats()
 
-        # If requested parse payload according to specification string
-        # Allowed entries are:
-        #   b   Sequence of 4 bytes
-        #   i   Two 16 bit integer values
-        #   f   Single 32 bit float
-        #
-        #   e   Error Code (assumed automatically if error bit is set)
+    def _cache_get(self, param):
+        # Returns the cache entry (value, timestamp) if it is within the
+        # staleness window, else None
+        if self._cacheTimeout is None:
+            if (self._cachePrimed is None) or (self._cachePrimed != threading.get_ident()):
+                return None
+            return self._cache.get(param)
+        entry = self._cache.get(param)
+        if (entry is None) or ((monotonic() - entry[1]) > self._cacheTimeout):
+            return None
+        return entry
 
-        # Valid checksum - parse message
-        msgp = {
-            'id' : int(msg[0]),
-            'lengthTotal' : int(msg[1]),
-            'lengthPayload' : int(msg[1]) - 5,
-            'op' : int(msg[2]),
-            'status' : int(msg[3]),
-            'error' : isError,
-            'errorcode' : None,
-            'payload' : payload
-        }
+    def _cache_store(self, param, value):
+        if (self._cacheTimeout is not None) or (self._cachePrimed == threading.get_ident()):
+            self._cache[param] = ( _detach(value), monotonic() )
 
-        if fmt is not None:
-            data = []
-            if not isError:
-                # Parse as requested
-                if (int(msg[1]) - 5) < (len(fmt)*4):
-                    self._logger.error(f"[XL30] Requested parsing according to {fmt} ({len(fmt) * 4} bytes) but got only {int(msg[1])-5} payload bytes")
-                    raise ValueError(f"Requested parsing according to {fmt} ({len(fmt) * 4} bytes) but got only {int(msg[1])-5} payload bytes")
-                idx = 0
-                for c in fmt:
-                    if c == "b":
-                        data.append(msg[4 + idx*4 : 4 + (idx+1)*4])
-                    if c == "i":
-                        data.append(int(msg[4 + idx*4 + 0]) + int(msg[4 + idx*4 + 1]) * 256)
-                        data.append(int(msg[4 + idx*4 + 2]) + int(msg[4 + idx*4 + 3]) * 256)
-                    if c == "f":
-                        data.append(struct.unpack('f', msg[4 + idx*4 : 4 + (idx+1) * 4])[0])
-                msgp['data'] = data
-        if isError:
-            if (int(msg[1]) - 5) < 4:
-                self._logger.error(f"[XL30] Expected error code - but got {int(msg[1]) - 5} bytes instead of 4")
-                raise ScanningElectronMicroscope_CommunicationError(f"Expected error code - but got {int(msg[1]) - 5} bytes instead of 4")
-            msgp['errorcode'] = int(msg[4]) + int(msg[5]) * 256 + int(msg[6]) * 65536 + int(msg[7]) * 16777216
-
-        self._logger.debug(f"[XL30] RX: {msgp}")
-        return msgp
+    def _cache_matches(self, param, value, compare = None):
+        # Checks if a setter would write the value that is already cached (and
+        # thus can be skipped)
+        entry = self._cache_get(param)
+        if entry is None:
+            return False
+        if compare is not None:
+            return compare(entry[0], value)
+        return entry[0] == value
+
+    def _cache_invalidate(self, params = None):
+        # Drops the given parameters (or all parameters for None or "*")
+        if (params is None) or (params == "*"):
+            self._cache.clear()
+            return
+        for p in params:
+            self._cache.pop(p, None)
+
+    def wait_until(self, predicate, timeout = None, expected = None, interval = 0.5, maxInterval = 5, backoff = 1.5, onDone = None, onTimeout = None):
+        # Polls predicate till it returns a true value (which is returned) or
+        # the timeout in seconds elapsed (returns False). With a hint of the
+        # expected duration the first polls halve the remaining time to the
+        # expected completion, after that (or without hint) the poll interval
+        # starts at interval and grows by backoff up to maxInterval. The port
+        # is not locked while sleeping. onDone(value, elapsed) and
+        # onTimeout(elapsed) are called on completion
+        tStart = monotonic()
+        while True:
+            value = predicate()
+            elapsed = monotonic() - tStart
+            if value:
+                self._logger.debug(f"[XL30] Wait condition met after {elapsed:.2f} s")
+                if onDone is not None:
+                    onDone(value, elapsed)
+                return value
+            if (timeout is not None) and (elapsed >= timeout):
+                self._logger.warning(f"[XL30] Wait condition not met within {timeout} s")
+                if onTimeout is not None:
+                    onTimeout(elapsed)
+                return False
+
+            if (expected is not None) and (elapsed < expected):
+                delay = max(interval, (expected - elapsed) / 2)
+            else:
+                delay = interval
+                interval = min(interval * backoff, maxInterval)
+            if timeout is not None:
+                delay = min(delay, timeout - elapsed)
+            sleep(delay)
+
+    def batch(self):
+        # Collects setter calls and transmits them on exit of the with block,
+        # see deferrable for the list of deferred setters
+        return XL30Batch(self)
+
+    def _batch_flush(self, entries):
+        # Transmits deferred settings. The current values are queried once
+        # (pipelined) so the setters can drop values that did not change, then
+        # settings are applied in an order that avoids expensive side effects:
+        # detector and scan mode first (they reset contrast and brightness),
+        # then scan timing, beam, stage, shifts and finally contrast and
+        # brightness
+        if len(entries) == 0:
+            return { }
+        results = { }
+        primed = self._cachePrimed
+        self._cachePrimed = threading.get_ident()
+        try:
+            fields = [ p for p in entries if p in self._stateFields ]
+            if len(fields) > 0:
+                self._get_state(fields)
+            for param, (order, name, args, kwargs) in sorted(entries.items(), key = lambda e: e[1][0]):
+                results[param] = getattr(self, name)(*args, **kwargs)
+        finally:
+            self._cachePrimed = primed
+            if self._cacheTimeout is None:
+                self._cache_invalidate()
+            else:
+                self._cache_invalidate([ p for p in entries if (p in self._stateFields) and not XL30_COMMANDS[self._stateFields[p][0][0]].cacheable ])
+        self._logger.debug(f"[XL30] Flushed batch of {len(entries)} settings")
+        return results
 
     @onlyconnected()
     def _initialRequests(self):
-        # First clear serial buffer (short timeout)
+        # First clear serial buffer (short timeout). The timeout of passed
+        # ports is kept unless it is blocking or non blocking
+        tout = self._port.timeout
+        self._rxBuffer.clear()
         self._port.timeout = 1
-        while self._port.read() != b'':
-            pass
-        self._port.timeout = 60
+        while True:
+            data = self._port.read()
+            if data == b'':
+                break
+            if self._capture is not None:
+                self._capture.record(CAPTURE_RX, data)
+        self._port.timeout = tout if tout else 60
 
         # Requesting machine type and serial
         mid = self._get_id()
         self._machine_type = mid['type']
         self._machine_serial = mid['serial']
 
+        if self._profileDir is not None:
+            if (self._profile is None) or (self._profile.machineType != mid['type']) or (self._profile.machineSerial != mid['serial']):
+                self._profile = XL30Profile.load(mid['type'], mid['serial'], self._profileDir, self._logger)
+                acb = self._profile.durations.get("auto_contrastbrightness")
+                if acb is not None:
+                    self._acbExpected, self._acbMaximum = acb[1], acb[2]
+                if self._timeouts is not None:
+                    # Start from the slowest round trip seen in earlier sessions
+                    for name, t in self._profile.timings.items():
+                        if (name in XL30_COMMANDS) and (t[0] >= self._timeouts.minSamples):
+                            self._timeouts.seed(XL30_COMMANDS[name], t[2])
+
         # Determine which detectors are supported
         if self._detectorsAuto:
+            if (self._profile is not None) and (self._profile.detectors is not None):
+                for detid in self._detectorIds:
+                    self._detectorIds[detid]['supported'] = self._profile.detectors.get(detid, False)
+                self._logger.info(f"[XL30] Supported detectors from profile: {[ d for d in self._profile.detectors if self._profile.detectors[d] ]}")
+            else:
+                self._autodetect_detectors()
+
+        if (self._heartbeatInterval is not None) and (self._heartbeat is None):
+            self._start_heartbeat(self._heartbeatInterval)
+
+        # Query current state:
+        #   High tension (current)
+        #   High tension status
+        #   XL software version
+        #   Check if TMP or ODP system
+        #   Check if we are in service mode
+        #   Check which type of gun (Tungsten, FEG, LaB6, SFEG)
+
+    def _start_heartbeat(self, interval = 5, timeout = 1, onDead = None, reconnect = True):
+        # Starts the idle link supervision (XL30Heartbeat) and returns its handle
+        self._stop_heartbeat()
+        self._heartbeat = XL30Heartbeat(self, interval, timeout, onDead, reconnect).start()
+        return self._heartbeat
+
+    def _stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+
+    def _autodetect_detectors(self):
+        # Selects every known detector once to see which ones are accepted,
+        # the previously active detector is selected again afterwards. The
+        # probing is not recorded as desired state (and does not drop the
+        # desired contrast and brightness)
+        desired = self._desiredState
+        self._desiredState = None
+        try:
+            current = self._get_detector()
             for detid in self._detectorIds:
                 if (self._detectorIds[detid]['type'] is None) or (self._detectorIds[detid]['type'] == 4):
                     self._detectorIds[detid]['supported'] = False
@@ -460,14 +1650,48 @@ class XL30Serial(XL30):
                     self._detectorIds[detid]['supported'] = True
                 else:
                     self._detectorIds[detid]['supported'] = False
+            if current and (current['raw_id'] in self._detectorIds):
+                self._set_detector(current['raw_id'])
+        finally:
+            self._desiredState = desired
 
-        # Query current state:
-        #   High tension (current)
-        #   High tension status
-        #   XL software version
-        #   Check if TMP or ODP system
-        #   Check if we are in service mode
-        #   Check which type of gun (Tungsten, FEG, LaB6, SFEG)
+        if self._profile is not None:
+            self._profile.detectors = { detid : self._detectorIds[detid]['supported'] for detid in self._detectorIds }
+            self._profile_save()
+
+    def _profile_save(self):
+        try:
+            self._profile.save()
+        except OSError as e:
+            self._logger.warning(f"[XL30] Failed to store profile {self._profile.path}: {e}")
+
+    def _get_profile(self):
+        # Current capability profile as dictionary or None if disabled (or
+        # not yet connected)
+        if self._profile is None:
+            return None
+        return {
+            'type' : self._profile.machineType,
+            'serial' : self._profile.machineSerial,
+            'path' : self._profile.path,
+            'detectors' : dict(self._profile.detectors) if self._profile.detectors is not None else None,
+            'unsupported' : sorted(self._profile.unsupported),
+            'timings' : { k : { 'count' : v[0], 'mean' : v[1], 'max' : v[2] } for k, v in self._profile.timings.items() },
+            'durations' : { k : { 'count' : v[0], 'mean' : v[1], 'max' : v[2] } for k, v in self._profile.durations.items() }
+        }
+
+    def _set_unsupported(self, name, unsupported = True):
+        # Marks a command (name as in xl30commands) as unsupported (or
+        # supported again) in the profile
+        if name not in XL30_COMMANDS:
+            raise ValueError(f"Unknown command {name}")
+        if self._profile is None:
+            raise ScanningElectronMicroscope_NotConnectedException("No capability profile loaded")
+        if unsupported:
+            self._profile.unsupported.add(name)
+        else:
+            self._profile.unsupported.discard(name)
+        self._profile_save()
 
     @tested()
     @onlyconnected()
@@ -475,15 +1699,18 @@ class XL30Serial(XL30):
     def _get_id(self):
         self._logger.debug("[XL30] Requesting ID")
 
-        self._msg_tx(0, fill = 4)
-        resp = self._msg_rx(fmt = "i")
+        return self._parse_id(self._command("get_id"))
 
+    def _parse_id(self, resp):
         knownTypes = {
             2 : "XL20",
             3 : "XL30",
             4 : "XL40"
         }
 
+        if resp['error']:
+            self._logger.error(f"[XL30] Error response to ID request: {resp}")
+            raise XL30DeviceError(f"Error response to ID request: {resp}", resp['errorcode'])
         if resp['data'][0] in knownTypes:
             return {
                 'type' : knownTypes[resp['data'][0]],
@@ -493,6 +1720,49 @@ class XL30Serial(XL30):
             self._logger.error(f"[XL30] Unknown response to ID request: {resp}")
             raise ScanningElectronMicroscope_CommunicationError(f"Unknown response to ID reqeuest: {resp}")
 
+    @onlyconnected()
+    @retrylooped()
+    def _get_state(self, fields = None):
+        # Queries all (or the requested subset of) state fields with a single
+        # pipelined exchange and returns an immutable snapshot
+        if fields is None:
+            fields = ScanningElectronMicroscope_State.FIELDS
+        fields = list(dict.fromkeys(fields))
+
+        values = { }
+        fieldTimings = { }
+
+        # Fields that are present in the parameter cache are not queried
+        requests = []
+        queried = []
+        for f in fields:
+            if f not in self._stateFields:
+                raise ValueError(f"Unknown state field {f}")
+            entry = self._cache_get(f)
+            if entry is not None:
+                values[f] = _detach(entry[0])
+                fieldTimings[f] = 0
+                continue
+            queried.append(f)
+            requests.extend(self._stateFields[f][0])
+
+        timestamp = time()
+        tStart = perf_counter()
+        timings = [ None ] * len(requests)
+        resps = self._pipelined(requests, timings = timings)
+
+        idx = 0
+        for f in queried:
+            cmds, parser = self._stateFields[f]
+            values[f] = parser(*resps[idx : idx + len(cmds)])
+            fieldTimings[f] = max(timings[idx : idx + len(cmds)]) - tStart
+            idx = idx + len(cmds)
+            if (XL30_COMMANDS[cmds[0]].cacheable or (self._cachePrimed == threading.get_ident())) and (values[f] is not None) and (values[f] is not False):
+                self._cache_store(f, values[f])
+
+        values = { f : values[f] for f in fields }
+        return ScanningElectronMicroscope_State(values, fieldTimings, timestamp = timestamp, duration = perf_counter() - tStart)
+
     @tested()
     @retrylooped()
     def _get_hightension(self):
@@ -500,17 +1770,19 @@ class XL30Serial(XL30):
             raise ScanningElectronMicroscope_NotConnectedException()
 
         # First get status
-        self._msg_tx(4, fill = 4)
-        resp = self._msg_rx(fmt = "i")
-
+        resp = self._command("get_hightension_status")
         if resp['data'][0] == 0:
+            return self._parse_hightension(resp, None)
+
+        return self._parse_hightension(resp, self._command("get_hightension"))
+
+    def _parse_hightension(self, status, value):
+        if status['data'][0] == 0:
             self._logger.debug("[XL30] High tension is currently disabled")
             return False
         self._logger.debug("[XL30] High tension enabled")
 
-        self._msg_tx(2, fill = 4)
-        resp = self._msg_rx(fmt = "f")
-        return resp['data'][0]
+        return value['data'][0]
 
     @tested()
     @onlyconnected()
@@ -520,45 +1792,53 @@ class XL30Serial(XL30):
             raise ValueError("High tension voltage has to be in range 200V-30kV")
 
         if voltage != 0:
-            self._logger.info("[XL30] Enabling high tension")
-            self._msg_tx(5, bytes([1,0,0,0]))
-            resp = self._msg_rx()
-            if resp['error']:
-                self._logger.error(f"[XL30] Enabling high tension failed. Error code {resp['errorcode']}")
-                return False
-
-            self._logger.info(f"[XL30] Setting high tension to {voltage}")
-            self._msg_tx(3, struct.pack('<f', float(voltage)))
-            resp = self._msg_rx()
-            if resp['error']:
-                self._logger.error(f"[XL30] Enabling high tension failed. Error code {resp['errorcode']}")
-                self._set_hightension(0)
+            ramp = self._hightension_begin(voltage)
+            if ramp is None:
                 return False
-
-            # Wait till ramp up ...
-            ht = 0
-            for wit in range(90*2):
-                sleep(0.5)
-                ht = self._get_hightension()
-                if abs(ht - voltage) < 100:
-                    break
-                self._logger.info(f"[XL30] Waiting for high tension to reach {voltage}V, currently at {ht}")
-
-            if abs(ht - voltage) > 100:
-                # If we raise an IOError we will trigger our retry loop that will use reconnect ...
+            if not ramp.run():
+                # Classified as timeout so the retry policy repeats the ramp
+                # (an IOError would be taken for a lost port and reconnect)
                 self._logger.error("[XL30] Failed to set high tension in 90 seconds")
-                raise IOError("[XL30] Failed to set high tension in 90 seconds")
-
+                raise XL30TimeoutError("[XL30] Failed to set high tension in 90 seconds")
             return True
         else:
             self._logger.info("[XL30] Disabling high tension")
-            self._msg_tx(5, bytes([0,0,0,0]))
-            resp = self._msg_rx()
+            resp = self._command("set_hightension_status", 0)
             if resp['error']:
                 self._logger.error(f"[XL30] Failed to disable high tension. Error code {resp['errorcode']}")
                 return False
             return True
 
+    @onlyconnected()
+    def _ramp_hightension(self, voltage, tolerance = 100, timeout = 90, onDone = None):
+        # Non blocking variant of _set_hightension. Enables high tension, sets
+        # the target voltage and returns a XL30HighTensionRamp handle that
+        # tracks the ramp on a background thread (None if the microscope
+        # refused the commands). onDone(ramp) is called on completion
+        ramp = self._hightension_begin(voltage, tolerance, timeout, onDone)
+        if ramp is not None:
+            ramp.start()
+        return ramp
+
+    def _hightension_begin(self, voltage, tolerance = 100, timeout = 90, onDone = None):
+        if (voltage < 200) or (voltage > 30000):
+            raise ValueError("High tension voltage has to be in range 200V-30kV")
+
+        self._logger.info("[XL30] Enabling high tension")
+        resp = self._command("set_hightension_status", 1)
+        if resp['error']:
+            self._logger.error(f"[XL30] Enabling high tension failed. Error code {resp['errorcode']}")
+            return None
+
+        self._logger.info(f"[XL30] Setting high tension to {voltage}")
+        resp = self._command("set_hightension", float(voltage))
+        if resp['error']:
+            self._logger.error(f"[XL30] Enabling high tension failed. Error code {resp['errorcode']}")
+            self._set_hightension(0)
+            return None
+
+        return XL30HighTensionRamp(self, float(voltage), tolerance, timeout, onDone)
+
     @tested()
     @onlyconnected()
     @retrylooped()
@@ -566,16 +1846,14 @@ class XL30Serial(XL30):
         self._logger.debug(f"[XL30] Request venting (stop: {stop})")
 
         if not stop:
-            self._msg_tx(113, bytes([1, 0, 0, 0]))
-            resp = self._msg_rx()
+            resp = self._command("set_vacuum", 1)
             if resp['error']:
                 self._logger.error("[XL30] Failed to execute venting command. Error code {resp['errorcode']}")
                 return False
             self._logger.info("[Xl30] Venting")
             return True
         else:
-            self._msg_tx(113, bytes([2, 0, 0, 0]))
-            resp = self._msg_rx()
+            resp = self._command("set_vacuum", 2)
             if resp['error']:
                 self._logger.error("[XL30] Failed to stop venting command. Error code {resp['errorcode']}")
                 return False
@@ -588,8 +1866,7 @@ class XL30Serial(XL30):
     def _pump(self):
         self._logger.debug("[XL30] Request pumping")
 
-        self._msg_tx(113, bytes([0, 0, 0, 0]))
-        resp = self._msg_rx()
+        resp = self._command("set_vacuum", 0)
         if resp['error']:
             self._logger.error("[XL30] Failed to start pumping")
             return False
@@ -598,10 +1875,12 @@ class XL30Serial(XL30):
       
     @tested()
     @onlyconnected()
+    @cachedquery("spotsize")
     @retrylooped()
     def _get_spotsize(self):
-        self._msg_tx(6, fill = 4)
-        resp = self._msg_rx(fmt = "f")
+        return self._parse_spotsize(self._command("get_spotsize"))
+
+    def _parse_spotsize(self, resp):
         if resp['error']:
             self._logger.error("[XL30] Failed to query spotsize")
             return False
@@ -611,24 +1890,31 @@ class XL30Serial(XL30):
     @tested()
     @onlyconnected()
     @retrylooped()
+    @deferrable("spotsize", 50, check = _check_range("Spotsize", 1.0, 10.0))
     def _set_spotsize(self, spotsize):
         if (spotsize < 1.0) or (spotsize > 10.0):
             raise ValueError("Valid spotsizes (probe currents) in the range of 1.0 to 10.0")
-        self._msg_tx(7, struct.pack("<f", float(spotsize)))
-        resp = self._msg_rx(fmt = "f")
+        if self._cache_matches("spotsize", _f32(spotsize)):
+            self._logger.debug(f"[XL30] Spotsize already set to {spotsize}")
+            return True
+
+        resp = self._command("set_spotsize", float(spotsize))
         if resp['error']:
             self._logger.error(f"[XL30] Failed to set spotsize to {spotsize}")
             return False
         else:
+            self._cache_store("spotsize", resp['data'][0])
             self._logger.info(f"[XL30] New spotsize {spotsize}")
             return True
 
     @tested()
     @onlyconnected()
+    @cachedquery("magnification")
     @retrylooped()
     def _get_magnification(self):
-        self._msg_tx(12, fill = 4)
-        resp = self._msg_rx(fmt = "f")
+        return self._parse_magnification(self._command("get_magnification"))
+
+    def _parse_magnification(self, resp):
         if resp['error']:
             self._logger.error("[XL30] Failed to query magnification")
             return False
@@ -638,28 +1924,32 @@ class XL30Serial(XL30):
     @tested()
     @onlyconnected()
     @retrylooped()
+    @deferrable("magnification", 60, check = _check_range("Magnification", 20, 4e5))
     def _set_magnification(self, magnification):
         if (magnification < 20) or (magnification > 4e5):
             raise ValueError("Valid magnification values range from 20 to 400000")
+        if self._cache_matches("magnification", _f32(magnification)):
+            self._logger.debug(f"[XL30] Magnification already set to {magnification}")
+            return True
 
-        self._msg_tx(13, struct.pack("<f", magnification))
-        resp = self._msg_rx(fmt = "f")
+        resp = self._command("set_magnification", magnification)
         if resp['error']:
             self._logger.error("[XL30] Failed to set magnification")
             return False
 
+        self._cache_store("magnification", resp['data'][0])
         self._logger.info(f"[XL30] New magnification {magnification}")
         return True
 
     @untested()
     @onlyconnected()
+    @cachedquery("stigmator")
     @retrylooped()
     def _get_stigmator(self, stigmatorindex = 0):
         if stigmatorindex != 0:
             raise ValueError("This device only offers a signle stigmator")
 
-        self._msg_tx(70, fill = 8)
-        resp = self._msg_rx(fmt = "ff")
+        resp = self._command("get_stigmator")
         if resp['error']:
             self._logger.error("[XL30] Failed to read stigmator setting")
             return None, None
@@ -669,6 +1959,7 @@ class XL30Serial(XL30):
     @untested()
     @onlyconnected()
     @retrylooped()
+    @deferrable("stigmator", 81, merge = True, check = _check_stigmator)
     def _set_stigmator(self, x = None, y = None, stigmatorindex = 0):
         if stigmatorindex != 0:
             raise ValueError("This device only offers a single stigmator")
@@ -686,37 +1977,46 @@ class XL30Serial(XL30):
             if y is None:
                 y = oldy
 
-        self._msg_tx(71, struct.pack("<ff", x, y))
-        resp = self._msg_rx(fmt = "ff")
+        if self._cache_matches("stigmator", (_f32(x), _f32(y))):
+            self._logger.debug(f"[XL30] Stigmator already set to {x}, {y}")
+            return True
+
+        resp = self._command("set_stigmator", x, y)
         if resp['error']:
             self._logger.error(f"[XL30] Failed to set stigmator setting to {x} and {y}")
             return False
 
+        self._cache_store("stigmator", (resp['data'][0], resp['data'][1]))
         self._logger.info(f"[XL30] New stigmator settings: {x}, {y}")
         return True
 
     @tested()
     @onlyconnected()
+    @cachedquery("detector")
     @retrylooped()
     def _get_detector(self):
-        self._msg_tx(14, fill = 4)
-        resp = self._msg_rx(fmt = "i")
+        return self._parse_detector(self._command("get_detector"))
+
+    def _parse_detector(self, resp):
         if resp['error']:
             self._logger.error("[XL30] Failed to query current selected detector")
             return False
 
         # Got detector ID and type ... translate
+        return self._detector_info(resp['data'][0], resp['data'][1])
+
+    def _detector_info(self, rawId, rawType):
         r = {
-                'raw_id' : resp['data'][0],
-                'raw_type' : resp['data'][1]
+                'raw_id' : rawId,
+                'raw_type' : rawType
         }
 
-        if resp['data'][0] in self._detectorIds:
-            r['name'] = self._detectorIds[resp['data'][0]]['name']
-            r['shortname'] = self._detectorIds[resp['data'][0]]['shortname']
-        if resp['data'][1] in self._detectorTypes:
-            r['shorttype'] = self._detectorTypes[resp['data'][1]]['short']
-            r['type'] = self._detectorTypes[resp['data'][1]]['long']
+        if rawId in self._detectorIds:
+            r['name'] = self._detectorIds[rawId]['name']
+            r['shortname'] = self._detectorIds[rawId]['shortname']
+        if rawType in self._detectorTypes:
+            r['shorttype'] = self._detectorTypes[rawType]['short']
+            r['type'] = self._detectorTypes[rawType]['long']
 
         return r
 
@@ -725,38 +2025,30 @@ class XL30Serial(XL30):
     @buggy(bugs="Currently not able to set SE detector")
     @onlyconnected()
     @retrylooped()
+    @deferrable("detector", 10, check = _check_detector)
     def _set_detector(self, detectorId):
         if detectorId not in self._detectorIds:
             raise ValueError(f"Unknown detector {detectorId}")
+        if self._cache_matches("detector", detectorId, lambda cached, v: cached['raw_id'] == v):
+            self._logger.debug(f"[XL30] Detector {detectorId} already selected")
+            return True
 
         self._logger.info(f"[XL30] Requesting change to detector {detectorId} ({self._detectorIds[detectorId]['shortname']}: {self._detectorIds[detectorId]['name']})")
 
-        self._msg_tx(15, bytes([ detectorId, self._detectorIds[detectorId]['type'], 0, 0]))
-        resp = self._msg_rx()
+        resp = self._command("set_detector", detectorId, self._detectorIds[detectorId]['type'])
         if resp['error']:
             self._logger.error(f"[XL30] Failed to set detector to {detectorId}")
             return False
 
+        self._cache_store("detector", self._detector_info(detectorId, self._detectorIds[detectorId]['type']))
         self._logger.info(f"[XL30] New detector: {detectorId} ({self._detectorIds[detectorId]['shortname']}: {self._detectorIds[detectorId]['name']})")
         return True
 
     @onlyconnected()
     @retrylooped()
+    @deferrable("linetime", 30, check = _check_linetime)
     def _set_linetime(self, lt):
-        supportedLts = {
-            0 : 1.25,
-            1 : 1.87,
-            2 : 3.43,
-            3 : 6.86,
-            4 : 20.0,
-            5 : 40.0,
-            6 : 60.0,
-            7 : 120.0,
-            8 : 240.0,
-            9 : 360.0,
-            10 : 1020.0,
-            100 : "TV"
-        }
+        supportedLts = XL30_LINETIMES
 
         setval = None
         for l in supportedLts:
@@ -765,36 +2057,28 @@ class XL30Serial(XL30):
                 break
         if setval is None:
             raise ValueError("Unsupported line time {lt} ms, only supporting {supportedLts}")
+        if self._cache_matches("linetime", supportedLts[setval]):
+            self._logger.debug(f"[XL30] Line time already set to {lt} ms")
+            return True
 
-        self._msg_tx(21, bytes([ setval, 0, 0, 0 ]))
-        resp = self._msg_rx(fmt = "i")
+        resp = self._command("set_linetime", setval)
         if resp['error']:
             self._logger.error("[XL30] Failed to set line time {lt} ms")
             return False
+        self._cache_store("linetime", supportedLts[setval])
         self._logger.info("[XL30] Set line time {lt} ms")
         return True
 
     @tested()
     @onlyconnected()
+    @cachedquery("linetime")
     @retrylooped()
     def _get_linetime(self):
-        supportedLts = {
-            0 : 1.25,
-            1 : 1.87,
-            2 : 3.43,
-            3 : 6.86,
-            4 : 20.0,
-            5 : 40.0,
-            6 : 60.0,
-            7 : 120.0,
-            8 : 240.0,
-            9 : 360.0,
-            10 : 1020.0,
-            100 : "TV"
-        }
+        return self._parse_linetime(self._command("get_linetime"))
+
+    def _parse_linetime(self, resp):
+        supportedLts = XL30_LINETIMES
 
-        self._msg_tx(21, fill = 4)
-        resp = self._msg_rx(fmt = "i")
         if resp['error']:
             self._logger.error("[XL30] Failed to query line time from XL30")
             return None
@@ -814,23 +2098,9 @@ class XL30Serial(XL30):
 
     @onlyconnected()
     @retrylooped()
+    @deferrable("linesperframe", 31, check = _check_linesperframe)
     def _set_linesperframe(self, lines):
-        supportedLines = {
-            0 : 121,
-            1 : 242,
-            2 : 484,
-            3 : 968,
-            4 : 1452,
-            5 : 1936,
-            6 : 2420,
-            7 : 2904,
-            8 : 3388,
-            9 : 3872,
-            10 : 180,
-            11 : 360,
-            12 : 720,
-            100 : "TV"
-        }
+        supportedLines = XL30_LINESPERFRAME
 
         setValue = None
         for l in supportedLines:
@@ -839,39 +2109,29 @@ class XL30Serial(XL30):
                 break
         if setValue is None:
             raise ValueError(f"Unspported number of lines {lines}, supporting only {supportedLines}")
+        if self._cache_matches("linesperframe", supportedLines[setValue]):
+            self._logger.debug(f"[XL30] Number of lines already set to {lines}")
+            return True
 
-        self._msg_tx(19, bytes([ setValue, 0, 0, 0 ]))
-        resp = self._msg_rx(fmt = "i")
+        resp = self._command("set_linesperframe", setValue)
         if resp['error']:
             self._logger.error(f"[XL30] Failed to set number of lines to {lines} (value {setValue})")
             return False
         else:
+            self._cache_store("linesperframe", supportedLines[setValue])
             self._logger.info(f"[XL30] Set number of lines to {lines}")
             return True
 
     @tested()
     @onlyconnected()
+    @cachedquery("linesperframe")
     @retrylooped()
     def _get_linesperframe(self):
-        supportedLines = {
-            0 : 121,
-            1 : 242,
-            2 : 484,
-            3 : 968,
-            4 : 1452,
-            5 : 1936,
-            6 : 2420,
-            7 : 2904,
-            8 : 3388,
-            9 : 3872,
-            10 : 180,
-            11 : 360,
-            12 : 720,
-            100 : "TV"
-        }
+        return self._parse_linesperframe(self._command("get_linesperframe"))
+
+    def _parse_linesperframe(self, resp):
+        supportedLines = XL30_LINESPERFRAME
 
-        self._msg_tx(18, fill = 4)
-        resp = self._msg_rx(fmt = "i")
         if resp['error']:
             self._logger.error("[XL30] Failed to query number of lines per frame")
             return None
@@ -888,24 +2148,31 @@ class XL30Serial(XL30):
     @tested()
     @onlyconnected()
     @retrylooped()
+    @deferrable("scanmode", 20, check = _check_scanmode)
     def _set_scanmode(self, mode):
         if not isinstance(mode, ScanningElectronMicroscope_ScanMode):
             raise ValueError("Scan mode has to be a ScanningElectronMicroscope_ScanMode")
+        if self._cache_matches("scanmode", mode, lambda cached, v: cached['mode'] == v):
+            self._logger.debug(f"[XL30] Scan mode already set to {mode}")
+            return True
 
-        self._msg_tx(17, bytes([ mode.value, 0, 0, 0 ]))
-        resp = self._msg_rx(fmt = "i")
+        resp = self._command("set_scanmode", mode.value)
         if resp['error']:
             self._logger.error(f"[XL30] Failed to set scan mode to {mode}")
+        else:
+            self._cache_store("scanmode", { 'mode' : mode, 'name' : mode.name })
 
         self._logger.info(f"[XL30] Scan mode set to {mode}")
         return True
 
     @tested()
     @onlyconnected()
+    @cachedquery("scanmode")
     @retrylooped()
     def _get_scanmode(self):
-        self._msg_tx(16, fill = 4)
-        resp = self._msg_rx(fmt = "i")
+        return self._parse_scanmode(self._command("get_scanmode"))
+
+    def _parse_scanmode(self, resp):
         if resp['error']:
             self._logger.error("[XL30] Failed to query scan mode")
             return None
@@ -932,8 +2199,7 @@ class XL30Serial(XL30):
     @untested()
     @retrylooped()
     def _make_photo(self):
-        self._msg_tx(37)
-        resp = self._msg_rx()
+        resp = self._command("make_photo")
         if resp['error']:
             self._logger.error("[XL30] Failed to make photo")
             return False
@@ -969,16 +2235,17 @@ class XL30Serial(XL30):
 
         flagbytes = bytes([flagbyteL, flagbyteH, 0, 0])
 
-        self._msg_tx(84, flagbytes + fnamebin)
-        resp = self._msg_rx()
+        resp = self._command("write_tiff_image", payload = flagbytes + fnamebin)
         return resp
 
     @tested()
     @onlyconnected()
+    @cachedquery("contrast")
     @retrylooped()
     def _get_contrast(self):
-        self._msg_tx(48, fill = 4)
-        res = self._msg_rx(fmt = "f")
+        return self._parse_contrast(self._command("get_contrast"))
+
+    def _parse_contrast(self, res):
         if res['error']:
             self._logger.error("[XL30] Failed to query contrast")
             return None
@@ -988,25 +2255,32 @@ class XL30Serial(XL30):
     @tested()
     @onlyconnected()
     @retrylooped()
+    @deferrable("contrast", 90, check = _check_range("Contrast", 0, 100))
     def _set_contrast(self, contrast):
         if (contrast < 0) or (contrast > 100):
             raise ValueError("Contrast has to be in range 0 to 100")
+        if self._cache_matches("contrast", _f32(contrast)):
+            self._logger.debug(f"[XL30] Contrast already set to {contrast}")
+            return True
 
-        self._msg_tx(49, struct.pack("<f", contrast))
-        res = self._msg_rx(fmt = "f")
+        res = self._command("set_contrast", contrast)
         if res['error']:
             self._logger.error("[XL30] Failed to set contrast")
             return False
 
+        self._cache_store("contrast", res['data'][0])
+
         self._logger.info(f"[XL30] New contrast: {contrast}")
         return True
 
     @tested()
     @onlyconnected()
+    @cachedquery("brightness")
     @retrylooped()
     def _get_brightness(self):
-        self._msg_tx(50, fill = 4)
-        res = self._msg_rx(fmt = "f")
+        return self._parse_brightness(self._command("get_brightness"))
+
+    def _parse_brightness(self, res):
         if res['error']:
             self._logger.error("[XL30] Failed to query brightness")
             return None
@@ -1016,16 +2290,21 @@ class XL30Serial(XL30):
     @tested()
     @onlyconnected()
     @retrylooped()
+    @deferrable("brightness", 91, check = _check_range("Brightness", 0, 100))
     def _set_brightness(self, brightness):
         if (brightness < 0) or (brightness > 100):
             raise ValueError("Brightness has to be in range 0 to 100")
+        if self._cache_matches("brightness", _f32(brightness)):
+            self._logger.debug(f"[XL30] Brightness already set to {brightness}")
+            return True
 
-        self._msg_tx(51, struct.pack("<f", brightness))
-        res = self._msg_rx(fmt = "f")
+        res = self._command("set_brightness", brightness)
         if res['error']:
             self._logger.error("[XL30] Failed to set brightness")
             return False
 
+        self._cache_store("brightness", res['data'][0])
+
         self._logger.info(f"[XL30] New brightness: {brightness}")
         return True
 
@@ -1033,32 +2312,43 @@ class XL30Serial(XL30):
     @onlyconnected()
     @retrylooped()
     def _auto_contrastbrightness(self):
-        self._msg_tx(53, fill = 4)
-        res = self._msg_rx()
+        res = self._command("auto_contrastbrightness")
         if res['error']:
             self._logger.error("[XL30] Auto contrast and brightness did not execute")
             return False
 
         self._logger.info("[XL30] Auto contrast an brightness did execute")
-        # ACB takes some time
-        sleep(30)
+
+        # ACB runs on the console after the acknowledge, completion is
+        # detected by XL30AcbMonitor. 30 seconds are the worst case
+        monitor = XL30AcbMonitor(self._acbSettle, self._acbMaximum)
+        def acbSettled():
+            resps = self._pipelined([ "get_contrast", "get_brightness" ])
+            return monitor.update(( self._parse_contrast(resps[0]), self._parse_brightness(resps[1]) ))
+        def acbDone(value, elapsed):
+            if monitor.changed:
+                # Only confirmed runs are used as hint
+                self._acb_observed(monitor.duration)
+            self._cache_store("contrast", monitor.current[0])
+            self._cache_store("brightness", monitor.current[1])
+
+        self.wait_until(acbSettled, timeout = 30, expected = self._acbExpected, interval = 0.5, maxInterval = 2, onDone = acbDone)
         return True
 
+    def _acb_observed(self, seconds):
+        self._acbExpected = seconds
+        self._acbMaximum = max(seconds, self._acbMaximum or 0)
+        if self._profile is not None:
+            self._profile.record_duration("auto_contrastbrightness", seconds)
+
     @tested()
     @onlyconnected()
     @retrylooped()
     def _auto_focus(self):
         #self._msg_tx(55, bytes([1,0,0,0]))
 
-        # Set timeout to wait for autofocus to complete
-        tout = self._port.timeout
-        self._port.timeout = 240
-
-        self._msg_tx(111, fill = 4)
-        res = self._msg_rx()
-
-        # Restore timeout
-        self._port.timeout = tout
+        # The command table extends the timeout to wait for autofocus to complete
+        res = self._command("auto_focus")
 
         if res['error']:
             self._logger.error("[XL30] Auto focus did not execute")
@@ -1080,8 +2370,7 @@ class XL30Serial(XL30):
         while len(txtbin) % 4 != 0:
             txtbin += bytes([0])
 
-        self._msg_tx(101, txtbin)
-        resp = self._msg_rx()
+        resp = self._command("set_databar_text", payload = txtbin)
         if resp['error']:
             self._logger.error("[XL30] Failed to set databar text")
             return False
@@ -1093,8 +2382,7 @@ class XL30Serial(XL30):
     @tested()
     @retrylooped()
     def _get_databar_text(self):
-        self._msg_tx(100, fill = 44)
-        resp = self._msg_rx()
+        resp = self._command("get_databar_text")
 
         txt = (resp['payload'][4:]).decode('ascii')
         return txt
@@ -1111,15 +2399,8 @@ class XL30Serial(XL30):
     def _stage_home(self):
         self._logger.info("[XL30] Started homing")
 
-        # Increase timeout to 2 min 30 secs + 15 secs grace timeout
-        tout = self._port.timeout
-        self._port.timeout = 2*60 + 30 + 15
-
-        self._msg_tx(175, fill = 4)
-        resp = self._msg_rx()
-
-        # Restore old timeout
-        self._port.timeout = tout
+        # Timeout is increased to 2 min 30 secs + 15 secs grace timeout by the command table
+        resp = self._command("stage_home")
 
         if resp['error']:
             self._logger.error("[XL30] Homing failed")
@@ -1131,8 +2412,9 @@ class XL30Serial(XL30):
     @retrylooped()
     def _get_stage_position(self):
         # Queries the stage position ...
-        self._msg_tx(190, fill = 20)
-        resp = self._msg_rx(fmt = "fffff")
+        return self._parse_stage_position(self._command("get_stage_position"))
+
+    def _parse_stage_position(self, resp):
         if resp['error']:
             self._logger.error("[XL30] Failed to query stage position")
             return None
@@ -1150,26 +2432,41 @@ class XL30Serial(XL30):
     @onlyconnected()
     @buggy(bugs = "Does not check boundaries! Ignores error when setting z position. Sets tilt before z position ...? Maybe implement here moving down before changing tilt ...")
     @retrylooped()
+    @deferrable("stage", 70, merge = True)
     def _set_stage_position(self, x = None, y = None, z = None, tilt = None, rot = None):
         self._logger.debug(f"[XL30] Starting move to x:{x}, y:{y}, z:{z}, tilt:{tilt}, rot:{rot}")
         ox,oy,oz,otilt,orot = x,y,z,tilt,rot
 
         # Get current position (required for some of the methods)
-        currentPosition = self._get_stage_position()
+        entry = self._cache_get("stage")
+        if entry is not None:
+            currentPosition = entry[0]
+        else:
+            currentPosition = self._get_stage_position()
+
+        # Skip axes that are already at their target
+        if currentPosition is not None:
+            if (x is None or _f32(x) == currentPosition['x']) and (y is None or _f32(y) == currentPosition['y']):
+                x, y = None, None
+            if (rot is not None) and (_f32(rot) == currentPosition['rot']):
+                rot = None
+            if (z is not None) and (_f32(z) == currentPosition['z']):
+                z = None
+            if (tilt is not None) and (_f32(tilt) == currentPosition['tilt']):
+                tilt = None
 
         if (x is not None) or (y is not None):
+            if ((x is None) or (y is None)) and (currentPosition is None):
+                self._logger.error("[XL30] Failed to query current position, cannot move along a single axis")
+                return False
             if x is None:
                 x = currentPosition['x']
             if y is None:
                 y = currentPosition['y']
 
             # Execute Command 177 SetPosition (synchronous)
-            tout = self._port.timeout
-            self._port.timeout = 60
             self._logger.debug(f"[XL30] Moving to position x:{x} mm, y:{y} mm")
-            self._msg_tx(177, struct.pack("<ff", x, y))
-            rep = self._msg_rx(fmt = "ff")
-            self._port.timeout = tout
+            rep = self._command("set_stage_xy", x, y)
             if rep['error']:
                 self._logger.error(f"[XL30] Failed moving to x:{x}mm, y:{y}mm")
                 return False
@@ -1177,12 +2474,8 @@ class XL30Serial(XL30):
 
         if rot is not None:
             # Execute Command 179 SetRotation (synchronous)
-            tout = self._port.timeout
-            self._port.timeout = 60
             self._logger.debug(f"[XL30] Moving to position rot:{rot} deg")
-            self._msg_tx(179, struct.pack("<f", rot))
-            rep = self._msg_rx(fmt = "f")
-            self._port.timeout = tout
+            rep = self._command("set_stage_rotation", rot)
             if rep['error']:
                 self._logger.error(f"[XL30] Failed to rotate to {rot} deg")
                 return False
@@ -1190,12 +2483,8 @@ class XL30Serial(XL30):
 
         if z is not None:
             # Set z position ...
-            tout = self._port.timeout
-            self._port.timeout = 60
             self._logger.debug(f"[XL30] Moving to position z:{z} mm")
-            self._msg_tx(187, struct.pack("<f", z))
-            rep = self._msg_rx(fmt = "f")
-            self._port.timeout = tout
+            rep = self._command("set_stage_z", z)
             if rep['error']:
                 self._logger.error(f"[XL30] Failed to set z position to {z} mm")
                 #return False
@@ -1203,25 +2492,25 @@ class XL30Serial(XL30):
 
         if tilt is not None:
             # Set tilt
-            tout = self._port.timeout
-            self._port.timeout = 60
             self._logger.debug(f"[XL30] Moving to tilt {tilt} deg")
-            self._msg_tx(189, struct.pack("<f", tilt))
-            rep = self._msg_rx(fmt = "f")
+            rep = self._command("set_stage_tilt", tilt)
             if rep['error']:
                 self._logger.error(f"[XL30] Failed to set tilt position to {tilt} mm")
                 return False
             self._logger.info(f"[XL30] New tilt position: {tilt} deg")
 
+        self._cache_invalidate(( "stage", ))
         self._logger.info(f"[XL30] New position set: x:{ox}, y:{oy}, z:{oz}, rot:{orot}, tilt: {otilt}")
         return True
 
     @onlyconnected()
     @tested()
+    @cachedquery("beamshift")
     @retrylooped()
     def _get_beamshift(self):
-        self._msg_tx(80, fill = 2*4)
-        resp = self._msg_rx(fmt = "ff")
+        return self._parse_beamshift(self._command("get_beamshift"))
+
+    def _parse_beamshift(self, resp):
         if resp['error']:
             self._logger.error("[XL30] Failed to query beam shift")
             return None
@@ -1235,6 +2524,7 @@ class XL30Serial(XL30):
     @buggy(bugs = "Currently not checking x and y bounds")
     @tested()
     @retrylooped()
+    @deferrable("beamshift", 80, merge = True)
     def _set_beamshift(self, x = None, y = None):
         if (x is None) and (y is None):
             self._logger.debug("[XL30] Not setting beam shift, no data supplied")
@@ -1250,22 +2540,26 @@ class XL30Serial(XL30):
             if y is None:
                 y = currentPos['y']
 
-        print(struct.pack('<ff', x, y))
-        self._msg_tx(81, struct.pack('<ff', x, y,))
-        resp = self._msg_rx(fmt = "ff")
+        if self._cache_matches("beamshift", { 'x' : _f32(x), 'y' : _f32(y) }):
+            self._logger.debug(f"[XL30] Beamshift already set to x={x}mm, y={y}mm")
+            return True
+
+        resp = self._command("set_beamshift", x, y)
         if resp['error']:
             self._logger.error("[XL30] Failed to set beamshift")
             return False
 
+        self._cache_store("beamshift", { 'x' : resp['data'][0], 'y' : resp['data'][1] })
+
         self._logger.info(f"[XL30] New beamshift x={x}mm, y={y}mm")
         return True
 
     @onlyconnected()
     @untested()
+    @cachedquery("scanrotation")
     @retrylooped()
     def _get_scanrotation(self):
-        self._msg_tx(98, fill = 1*4)
-        resp = self._msg_rx(fmt = "f")
+        resp = self._command("get_scanrotation")
         if resp['error']:
             self._logger.error("[XL30] Failed to query scan rotation")
             return None
@@ -1275,17 +2569,23 @@ class XL30Serial(XL30):
     @onlyconnected()
     @untested()
     @retrylooped()
+    @deferrable("scanrotation", 85)
     def _set_scanrotation(self, rot = None):
         rot = float(rot)
-        if (rot < 90) or (rot > 90):
+        if (rot < -90) or (rot > 90):
             self._logger.error("[XL30] Scan rotation has to be in range +- 90 deg")
             return False
-        self._msg_tx(99, struct.pack('<f', rot))
-        resp = self._msg_rx(fmt = "f")
+        if self._cache_matches("scanrotation", _f32(rot)):
+            self._logger.debug(f"[XL30] Scan rotation already set to {rot} deg")
+            return True
+
+        resp = self._command("set_scanrotation", rot)
         if resp['error']:
             self._logger.error("[XL30] Failed to set scan rotation")
             return False
 
+        self._cache_store("scanrotation", resp['data'][0])
+
         self._logger.info(f"[XL30] New scan rotation rot={rot}deg")
         return True
 
@@ -1293,15 +2593,13 @@ class XL30Serial(XL30):
     @onlyconnected()
     @retrylooped()
     def _get_area_or_dot_shift(self):
-        self._msg_tx(26, fill = 4)
-        res = self._msg_rx(fmt = 'f')
+        res = self._command("get_area_or_dot_shift_x")
         if res['error']:
             self._logger.error("[XL30] Failed to query SA/dot shift along X axis")
             return None
         xshift = res['data'][0]
 
-        self._msg_tx(28, fill = 4)
-        res = self._msg_rx(fmt = 'f')
+        res = self._command("get_area_or_dot_shift_y")
         if res['error']:
             self._logger.error("[XL30] Failed to query SA/dot shift along Y axis")
             return None
@@ -1331,15 +2629,13 @@ class XL30Serial(XL30):
                 raise ValueError("Y shift has to be in range [-100...100%]")
 
         if xshift is not None:
-            self._msg_tx(27, struct.pack("<f", xshift))
-            res = self._msg_rx(fmt = 'i')
+            res = self._command("set_area_or_dot_shift_x", xshift)
             if res['error']:
                 self._logger.error("[XL30] Failed to set X shift")
                 return False
 
         if yshift is not None:
-            self._msg_tx(29, struct.pack("<f", yshift))
-            res = self._msg_rx(fmt = 'i')
+            res = self._command("set_area_or_dot_shift_y", yshift)
             if res['error']:
                 self._logger.error("[XL30] Failed to set Y shift")
                 return False
@@ -1351,14 +2647,13 @@ class XL30Serial(XL30):
     @untested()
     @retrylooped()
     def _get_selected_area_size(self):
-        self._msg_tx(22, fill = 4)
-        res = self._msg_rx(fmt = 'f')
+        res = self._command("get_selected_area_size_x")
         if res['error']:
             self._logger.error("[XL30] Failed to query X area size")
             return None
         xsize = res['data'][0]
 
-        self._msg_tx(24, fill = 4)
+        res = self._command("get_selected_area_size_y")
         if res['error']:
             self._logger.error("[XL30] Failed to query Y area size")
             return None
@@ -1388,14 +2683,12 @@ class XL30Serial(XL30):
             if (sizey < 0) or (sizey > 100):
                 raise ValueError("SizeY is out of range from [0...100%] (requested {sizey})")
 
-        self._msg_tx(23, struct.pack("<f", sizex))
-        r = self._msg_rx(fmt = 'i')
+        r = self._command("set_selected_area_size_x", sizex)
         if r['error']:
             self._logger.error("[XL30] Failed to set selected area X")
             return False
 
-        self._msg_tx(25, struct.pack("<f", sizey))
-        r = self._msg_rx(fmt = 'i')
+        r = self._command("set_selected_area_size_y", sizey)
         if r['error']:
             self._logger.error("[XL30] Failed to set selected area Y")
             return False
@@ -1409,8 +2702,9 @@ class XL30Serial(XL30):
     @tested()
     @retrylooped()
     def _get_imagefilter_mode(self):
-        self._msg_tx(74, fill = 4)
-        res = self._msg_rx(fmt = 'i')
+        return self._parse_imagefilter_mode(self._command("get_imagefilter_mode"))
+
+    def _parse_imagefilter_mode(self, res):
         if res['error']:
             self._logger.error("[XL30] Failed to query filter mode")
             return None
@@ -1444,20 +2738,38 @@ class XL30Serial(XL30):
         if not isinstance(filtermode, ScanningElectronMicroscope_ImageFilterMode):
             raise ValueError("Filter mode has to be a ScanningElectronMicroscope_ImageFilterMode instance")
 
-        self._msg_tx(75, bytes([filtermode.value, int(math.log10(frames) / math.log10(2)), 0, 0]))
-        rep = self._msg_rx(fmt = "i")
+        rep = self._command("set_imagefilter_mode", filtermode.value, int(math.log10(frames) / math.log10(2)))
         if rep['error']:
             self._logger.error(f"[XL30] Failed to set filter mode {filtermode} with {frames} frames")
             return False
         self._logger.info(f"[XL30] New filtermode {filtermode} with {frames} frames")
         return True
 
+    @onlyconnected()
+    def _wait_imagefilter_mode(self, filtermode = ScanningElectronMicroscope_ImageFilterMode.FREEZE, timeout = None):
+        # Waits till the filter reached the given mode (i.e. integration or
+        # averaging finished and the image is frozen). The expected duration
+        # is estimated from the number of frames, lines per frame and line time
+        expected = None
+        current = self._get_imagefilter_mode()
+        if (current is not None) and (current['mode'] != filtermode):
+            lines = self._get_linesperframe()
+            lt = self._get_linetime()
+            if isinstance(lines, int) and isinstance(lt, float):
+                expected = current['frames'] * lines * lt / 1000.0
+                self._logger.debug(f"[XL30] Expecting filter to finish within {expected:.1f} s")
+
+        def filterReached():
+            mode = self._get_imagefilter_mode()
+            return (mode is not None) and (mode['mode'] == filtermode)
+
+        return self.wait_until(filterReached, timeout = timeout, expected = expected, interval = 0.25, maxInterval = 2)
+
     @untested()
     @onlyconnected()
     @retrylooped()
     def _get_specimen_current_detector_mode(self):
-        self._msg_tx(58, fill = 4)
-        rep = self._msg_rx(fmt = "i")
+        rep = self._command("get_specimen_current_detector_mode")
         if rep['error']:
             self._logger.error("[XL30] Failed to query speciment current detector mode")
             return None
@@ -1494,8 +2806,7 @@ class XL30Serial(XL30):
 
         md = knownModes[mode]
 
-        self._msg_tx(59, bytes([md, 0, 0, 0]))
-        resp = self._msg_rx(fmt = "i")
+        resp = self._command("set_specimen_current_detector_mode", md)
         if resp["error"]:
             self._logger.error("[XL30] Failed to blank beam")
             return False
@@ -1506,8 +2817,7 @@ class XL30Serial(XL30):
     @retrylooped()
     def _get_specimen_current(self):
         # Note this only works in measure mode ...
-        self._msg_tx(60, fill = 4)
-        resp = self._msg_rx(fmt = "f")
+        resp = self._command("get_specimen_current")
         if resp["error"]:
             self._logger.error(f"[XL30] Failed to query speciment current (errorcode: {resp['errorcode']})")
             return None
@@ -1518,8 +2828,7 @@ class XL30Serial(XL30):
     @onlyconnected()
     @retrylooped()
     def _is_beam_blanked(self):
-        self._msg_tx(62, fill = 4)
-        resp = self._msg_rx(fmt = "i")
+        resp = self._command("is_beam_blanked")
         if resp["error"]:
             self._logger.error("[XL30] Failed to query beam blanking error code")
             return None
@@ -1533,8 +2842,7 @@ class XL30Serial(XL30):
     @onlyconnected()
     @retrylooped()
     def _blank(self):
-        self._msg_tx(63, bytes([1, 0, 0, 0]))
-        resp = self._msg_rx(fmt = "i")
+        resp = self._command("set_beam_blanked", 1)
         if resp["error"]:
             self._logger.error("[XL30] Failed to blank beam")
             return False
@@ -1544,8 +2852,7 @@ class XL30Serial(XL30):
     @onlyconnected()
     @retrylooped()
     def _unblank(self):
-        self._msg_tx(63, bytes([0, 0, 0, 0]))
-        resp = self._msg_rx(fmt = "i")
+        resp = self._command("set_beam_blanked", 0)
         if resp["error"]:
             self._logger.error("[XL30] Failed to unblank beam")
             return False
@@ -1556,10 +2863,9 @@ class XL30Serial(XL30):
     @retrylooped()
     def _oplock(self, lock = True):
         if lock:
-            self._msg_tx(39, bytes([1, 0, 0, 0]))
+            resp = self._command("set_oplock", 1)
         else:
-            self._msg_tx(39, bytes([0, 0, 0, 0]))
-        resp = self._msg_rx(fmt = 'i')
+            resp = self._command("set_oplock", 0)
         if resp["error"]:
             self._logger.error("[XL30] Failed to lock/unlock the system")
             return False
@@ -1569,8 +2875,7 @@ class XL30Serial(XL30):
     @onlyconnected()
     @retrylooped()
     def _isOplocked(self):
-        self._msg_tx(38, fill = 4)
-        resp = self._msg_rx(fmt = 'i')
+        resp = self._command("is_oplocked")
         if resp["error"]:
             self._logger.error("[XL30] Failed to query lock state")
             return None
@@ -0,0 +1,489 @@
+from xl30serial.xl30commands import XL30_COMMANDS, build_frame
+
+import argparse
+import logging
+import math
+import os
+import random
+import struct
+import threading
+import tty
+
+from time import sleep, monotonic
+
+# Simulator for the XL30 serial console
+#
+# Speaks the serial protocol (0x05, length, opcode, status, payload, checksum)
+# on the master side of a pseudo terminal so XL30Serial (or AsyncXL30Serial)
+# can be pointed at the slave device without any modification:
+#
+#   sim = XL30Simulator()
+#   with XL30Serial(sim.start()) as xl:
+#       ...
+#
+# Requests are decoded with the command table (xl30commands). Setters store
+# their value and echo the request payload, getters return the stored value.
+# Durations are modelled for high tension ramps (the voltage follows the
+# target with rampRate V/s), stage moves, stage homing, autofocus, auto
+# contrast/brightness (see below) and frame
+# integration (the image filter switches to FREEZE after frames * lines per
+# frame * line time). All durations are multiplied by timeScale.
+#
+# Error responses (status bit 0x80 and error code) are generated for opcodes
+# registered with fail() and randomly for errorRate of all requests (seeded).
+#
+# Auto contrast / brightness is acknowledged immediately and runs on the
+# console afterwards: nothing changes for acbDelay seconds, then contrast and
+# brightness are adjusted in acbSteps equal steps till acbDuration elapsed.
+# Readings between two steps are identical and with acbKeep probability the
+# run ends at the values it started with (image already fine).
+#
+# Opcode 21 is used for getting and setting the line time. A request without
+# payload value (all zero) is treated as query.
+#
+# Run as python -m xl30serial.xl30simulator to get a simulator on a pty.
+
+_lineTimes = { 0 : 1.25, 1 : 1.87, 2 : 3.43, 3 : 6.86, 4 : 20.0, 5 : 40.0, 6 : 60.0, 7 : 120.0, 8 : 240.0, 9 : 360.0, 10 : 1020.0, 100 : 20.0 }
+_linesPerFrame = { 0 : 121, 1 : 242, 2 : 484, 3 : 968, 4 : 1452, 5 : 1936, 6 : 2420, 7 : 2904, 8 : 3388, 9 : 3872, 10 : 180, 11 : 360, 12 : 720, 100 : 484 }
+
+class XL30Simulator:
+    def __init__(
+        self,
+        machineType = 3,
+        serialNumber = 1234,
+        timeScale = 1.0,
+        errorRate = 0.0,
+        errorCode = 1,
+        seed = None,
+        rampRate = 500.0,
+        stageSpeed = 5.0,
+        stageRotationSpeed = 10.0,
+        autofocusDuration = 15.0,
+        acbDuration = 8.0,
+        acbDelay = 1.0,
+        acbSteps = 8,
+        acbKeep = 0.0,
+        homingDuration = 60.0,
+        tiffDuration = 2.0,
+        logger = None
+    ):
+        self._logger = logger if logger is not None else logging.getLogger()
+        self._timeScale = timeScale
+        self._errorRate = errorRate
+        self._errorCode = errorCode
+        self._random = random.Random(seed)
+
+        self._rampRate = rampRate
+        self._stageSpeed = stageSpeed
+        self._stageRotationSpeed = stageRotationSpeed
+        self._autofocusDuration = autofocusDuration
+        self._acbDuration = acbDuration
+        self._acbDelay = acbDelay
+        self._acbSteps = acbSteps
+        self._acbKeep = acbKeep
+        self._homingDuration = homingDuration
+        self._tiffDuration = tiffDuration
+
+        self._failures = { }
+        self.requests = 0
+        self.tiffs = [ ]
+
+        self._machine = ( machineType, serialNumber )
+
+        # High tension: enabled, voltage at the start of the ramp, target and
+        # time at which the ramp started
+        self._htEnabled = False
+        self._htStart = 0.0
+        self._htTarget = 0.0
+        self._htTime = monotonic()
+
+        self._stage = [ 0.0, 0.0, 10.0, 0.0, 0.0 ]
+        # Running auto contrast / brightness as ( start, initial values,
+        # final values ) or None
+        self._acb = None
+        self._filterDone = None
+        self._databar = ""
+
+        # Values of the simple parameters in the layout of their getter
+        self._values = {
+            'spotsize'      : ( 3.0, ),
+            'magnification' : ( 1000.0, ),
+            'stigmator'     : ( 0.0, 0.0 ),
+            'detector'      : ( 3, 2 ),
+            'linetime'      : ( 3, 0 ),
+            'linesperframe' : ( 2, 0 ),
+            'scanmode'      : ( 7, 0 ),
+            'scanrotation'  : ( 0.0, ),
+            'areashift_x'   : ( 0.0, ),
+            'areashift_y'   : ( 0.0, ),
+            'areasize_x'    : ( 50.0, ),
+            'areasize_y'    : ( 50.0, ),
+            'imagefilter'   : ( 0, 0 ),
+            'contrast'      : ( 50.0, ),
+            'brightness'    : ( 50.0, ),
+            'beamshift'     : ( 0.0, 0.0 ),
+            'scdmode'       : ( 1, 0 ),
+            'blanked'       : ( 0, 0 ),
+            'oplock'        : ( 0, 0 )
+        }
+
+        self._byOpcode = { }
+        for cmd in XL30_COMMANDS.values():
+            self._byOpcode.setdefault(cmd.opcode, []).append(cmd)
+
+        self._rxBuffer = bytearray()
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+
+    # Error injection
+
+    def fail(self, opcode, errorCode = 1, count = None):
+        # Answers the next count (or all if None) requests with the given
+        # opcode with an error response
+        self._failures[opcode] = [ errorCode, count ]
+
+    def clear_failures(self):
+        self._failures = { }
+
+    # pty handling
+
+    def start(self):
+        # Opens a pseudo terminal, starts serving on its master side and
+        # returns the device name of the slave side
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target = self._serve, name = "XL30Simulator", daemon = True)
+        self._thread.start()
+        name = os.ttyname(self._slave)
+        self._logger.info(f"[XL30SIM] Serving on {name}")
+        return name
+
+    def stop(self):
+        self._running = False
+        if self._slave is not None:
+            os.close(self._slave)
+            self._slave = None
+        if self._master is not None:
+            os.close(self._master)
+            self._master = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def port(self):
+        return os.ttyname(self._slave) if self._slave is not None else None
+
+    def _serve(self):
+        while self._running:
+            try:
+                data = os.read(self._master, 256)
+            except OSError:
+                break
+            if not data:
+                break
+            resp = self.feed(data)
+            if len(resp) > 0:
+                try:
+                    os.write(self._master, resp)
+                except OSError:
+                    return
+
+    def feed(self, data):
+        # Processes received bytes (partial requests are kept till the rest
+        # arrives) and returns the response bytes
+        buf = self._rxBuffer
+        buf += data
+        resp = bytearray()
+        while True:
+            idx = buf.find(0x05)
+            if idx < 0:
+                buf.clear()
+                break
+            del buf[:idx]
+            if (len(buf) < 2) or (len(buf) < buf[1]):
+                break
+            msgLen = buf[1]
+            frame = bytes(buf[:msgLen])
+            if (msgLen < 5) or ((sum(frame[:-1]) & 0xFF) != frame[-1]):
+                self._logger.warning(f"[XL30SIM] Dropping invalid frame {frame}")
+                del buf[:1]
+                continue
+            del buf[:msgLen]
+            resp += self.handle_frame(frame)
+        return bytes(resp)
+
+    # Protocol
+
+    def _sleep(self, duration):
+        if duration > 0:
+            sleep(duration * self._timeScale)
+
+    def _error(self, opcode, errorCode):
+        msg = bytearray((0x05, 9, opcode, 0x80))
+        msg += struct.pack("<I", errorCode)
+        msg.append(sum(msg) & 0xFF)
+        return bytes(msg)
+
+    def handle_frame(self, frame):
+        # Processes a single (valid) request frame and returns the response
+        # frame. Blocks for the modelled duration of synchronous commands
+        self.requests = self.requests + 1
+        opcode = frame[2]
+        payload = frame[4:-1]
+
+        cmds = self._byOpcode.get(opcode)
+        if cmds is None:
+            self._logger.warning(f"[XL30SIM] Unknown opcode {opcode}")
+            return self._error(opcode, 0xFFFF)
+
+        failure = self._failures.get(opcode)
+        if failure is not None:
+            if failure[1] is not None:
+                failure[1] = failure[1] - 1
+                if failure[1] <= 0:
+                    del self._failures[opcode]
+            return self._error(opcode, failure[0])
+        if (self._errorRate > 0) and (self._random.random() < self._errorRate):
+            return self._error(opcode, self._errorCode)
+
+        cmd = cmds[0]
+        if len(cmds) > 1:
+            # Opcode shared by query and setter (line time)
+            query = [ c for c in cmds if c.readonly ][0]
+            setter = [ c for c in cmds if not c.readonly ][0]
+            cmd = query if payload.strip(b'\x00') == b'' else setter
+
+        handler = getattr(self, "_op_" + cmd.name, None)
+        if handler is not None:
+            resp = handler(cmd, payload)
+        elif cmd.readonly:
+            resp = cmd.response.pack(*self._values[cmd.param])
+        else:
+            values = cmd.request.unpack_from(payload)
+            n = len(self._values[cmd.param])
+            self._values[cmd.param] = (tuple(values) + ( 0, ) * n)[:n]
+            resp = payload
+        return build_frame(opcode, resp)
+
+    # Identification and high tension
+
+    def _op_get_id(self, cmd, payload):
+        return cmd.response.pack(*self._machine)
+
+    def _ht_current(self):
+        if not self._htEnabled:
+            return 0.0
+        if self._timeScale <= 0:
+            return self._htTarget
+        elapsed = (monotonic() - self._htTime) / self._timeScale
+        delta = self._htTarget - self._htStart
+        step = self._rampRate * elapsed
+        if step >= abs(delta):
+            return self._htTarget
+        return self._htStart + math.copysign(step, delta)
+
+    def _op_get_hightension_status(self, cmd, payload):
+        return cmd.response.pack(1 if self._htEnabled else 0, 0)
+
+    def _op_get_hightension(self, cmd, payload):
+        return cmd.response.pack(self._ht_current())
+
+    def _op_set_hightension_status(self, cmd, payload):
+        enable = cmd.request.unpack_from(payload)[0] != 0
+        if enable and not self._htEnabled:
+            self._htStart = 0.0
+            self._htTime = monotonic()
+        self._htEnabled = enable
+        return payload
+
+    def _op_set_hightension(self, cmd, payload):
+        self._htStart = self._ht_current()
+        self._htTarget = cmd.request.unpack_from(payload)[0]
+        self._htTime = monotonic()
+        return payload
+
+    def _op_set_vacuum(self, cmd, payload):
+        return payload
+
+    # Imaging
+
+    def _op_get_linetime(self, cmd, payload):
+        return cmd.response.pack(*self._values['linetime'])
+
+    def _frame_time(self):
+        return _lineTimes.get(self._values['linetime'][0], 20.0) * _linesPerFrame.get(self._values['linesperframe'][0], 484) / 1000.0
+
+    def _op_set_imagefilter_mode(self, cmd, payload):
+        mode, frames = cmd.request.unpack_from(payload)
+        self._values['imagefilter'] = ( mode, frames )
+        self._filterDone = None
+        if mode == 2:
+            # Integration freezes the image after the requested frames
+            self._filterDone = monotonic() + (2 ** frames) * self._frame_time() * self._timeScale
+        return payload
+
+    def _op_get_imagefilter_mode(self, cmd, payload):
+        if (self._filterDone is not None) and (monotonic() >= self._filterDone):
+            self._values['imagefilter'] = ( 3, self._values['imagefilter'][1] )
+            self._filterDone = None
+        return cmd.response.pack(*self._values['imagefilter'])
+
+    def _op_make_photo(self, cmd, payload):
+        self._sleep(self._frame_time())
+        return payload
+
+    def _op_write_tiff_image(self, cmd, payload):
+        fname = payload[4:].split(b'\x00')[0].decode('ascii', errors = 'replace')
+        self.tiffs.append(fname)
+        self._sleep(self._tiffDuration)
+        return payload[:4]
+
+    def _acb_update(self):
+        # Moves contrast and brightness to the step of the running ACB
+        if self._acb is None:
+            return
+        t0, initial, final = self._acb
+        if self._timeScale > 0:
+            elapsed = (monotonic() - t0) / self._timeScale
+        else:
+            elapsed = self._acbDuration
+        if elapsed >= self._acbDuration:
+            step = self._acbSteps
+            self._acb = None
+        elif elapsed < self._acbDelay:
+            step = 0
+        else:
+            step = int((elapsed - self._acbDelay) / (self._acbDuration - self._acbDelay) * self._acbSteps)
+        for i, param in enumerate(( 'contrast', 'brightness' )):
+            self._values[param] = ( initial[i] + (final[i] - initial[i]) * step / self._acbSteps, )
+
+    def _op_get_contrast(self, cmd, payload):
+        self._acb_update()
+        return cmd.response.pack(*self._values['contrast'])
+
+    def _op_get_brightness(self, cmd, payload):
+        self._acb_update()
+        return cmd.response.pack(*self._values['brightness'])
+
+    def _op_auto_contrastbrightness(self, cmd, payload):
+        self._acb_update()
+        initial = ( self._values['contrast'][0], self._values['brightness'][0] )
+        if self._random.random() < self._acbKeep:
+            final = initial
+        else:
+            final = ( float(self._random.randint(30, 70)), float(self._random.randint(30, 70)) )
+        self._acb = ( monotonic(), initial, final )
+        if self._timeScale <= 0:
+            self._acb_update()
+        return payload
+
+    def _op_auto_focus(self, cmd, payload):
+        self._sleep(self._autofocusDuration)
+        return payload
+
+    def _op_get_databar_text(self, cmd, payload):
+        txt = bytes(4) + self._databar.encode('ascii') + bytes(1)
+        return (txt + bytes(44))[:44]
+
+    def _op_set_databar_text(self, cmd, payload):
+        self._databar = payload[4:].split(b'\x00')[0].decode('ascii', errors = 'replace')
+        return payload[:4]
+
+    # Stage
+
+    def _op_stage_home(self, cmd, payload):
+        self._sleep(self._homingDuration)
+        self._stage = [ 0.0, 0.0, 10.0, 0.0, 0.0 ]
+        return payload
+
+    def _op_get_stage_position(self, cmd, payload):
+        return cmd.response.pack(*self._stage)
+
+    def _op_set_stage_xy(self, cmd, payload):
+        x, y = cmd.request.unpack_from(payload)
+        self._sleep(math.hypot(x - self._stage[0], y - self._stage[1]) / self._stageSpeed)
+        self._stage[0], self._stage[1] = x, y
+        return payload
+
+    def _op_set_stage_z(self, cmd, payload):
+        z = cmd.request.unpack_from(payload)[0]
+        self._sleep(abs(z - self._stage[2]) / self._stageSpeed)
+        self._stage[2] = z
+        return payload
+
+    def _op_set_stage_tilt(self, cmd, payload):
+        tilt = cmd.request.unpack_from(payload)[0]
+        self._sleep(abs(tilt - self._stage[3]) / self._stageRotationSpeed)
+        self._stage[3] = tilt
+        return payload
+
+    def _op_set_stage_rotation(self, cmd, payload):
+        rot = cmd.request.unpack_from(payload)[0]
+        self._sleep(abs(rot - self._stage[4]) / self._stageRotationSpeed)
+        self._stage[4] = rot
+        return payload
+
+    def _op_get_specimen_current(self, cmd, payload):
+        return cmd.response.pack(1e-9 * self._values['spotsize'][0] if self._htEnabled else 0.0)
+
+class XL30SimulatorPort:
+    # In process port that passes requests directly to a simulator without
+    # a pty. Offers the subset of the serial.Serial interface used by
+    # XL30Serial. Responses are available as soon as write returns, a read
+    # that cannot be satisfied waits for the timeout like a silent line
+    def __init__(self, simulator, timeout = 60):
+        self.timeout = timeout
+        self.baudrate = 9600
+        self.inter_byte_timeout = None
+        self._sim = simulator
+        self._rx = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def write(self, data):
+        self._rx += self._sim.feed(data)
+        return len(data)
+
+    def read(self, size = 1):
+        if (len(self._rx) < size) and self.timeout:
+            sleep(self.timeout)
+        r = bytes(self._rx[:size])
+        del self._rx[:size]
+        return r
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def close(self):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description = "XL30 serial console simulator on a pseudo terminal")
+    parser.add_argument("--time-scale", type = float, default = 1.0, help = "Factor applied to all modelled durations")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "Fraction of requests answered with an error")
+    parser.add_argument("--seed", type = int, default = None, help = "Seed for error injection")
+    parser.add_argument("--loglevel", default = "INFO")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = args.loglevel)
+    sim = XL30Simulator(timeScale = args.time_scale, errorRate = args.error_rate, seed = args.seed)
+    print(sim.start(), flush = True)
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+
+if __name__ == "__main__":
+    main()
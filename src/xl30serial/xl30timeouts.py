@@ -0,0 +1,67 @@
+import collections
+
+# Adaptive response timeouts per opcode
+#
+# Every opcode starts with its expected duration - the timeout of the command
+# table (xl30commands) for long running commands (detector changes, photos,
+# TIFF export, automatic functions and stage moves) or initial seconds for
+# all others. Once minSamples round trip times have been observed the timeout is
+# the given percentile of the last window samples times factor plus margin,
+# never below minimum and never above the static limit (the table timeout or
+# maximum). A timeout doubles the current value of the opcode (up to the
+# limit) till the next response has been observed so commands that are
+# slower than learned get a chance to complete on the retry.
+
+class XL30AdaptiveTimeouts:
+    def __init__(self, initial = 5, maximum = 60, minimum = 0.5, percentile = 0.99, factor = 2, margin = 0.5, window = 64, minSamples = 8):
+        self.initial = initial
+        self.maximum = maximum
+        self.minimum = minimum
+        self.percentile = percentile
+        self.factor = factor
+        self.margin = margin
+        self.window = window
+        self.minSamples = minSamples
+
+        self._samples = { }
+        self._penalty = { }
+
+    def limit(self, cmd):
+        return cmd.timeout if cmd.timeout is not None else self.maximum
+
+    def timeout(self, cmd):
+        limit = self.limit(cmd)
+        samples = self._samples.get(cmd.opcode)
+        if (samples is None) or (len(samples) < self.minSamples):
+            t = cmd.timeout if cmd.timeout is not None else self.initial
+        else:
+            ordered = sorted(samples)
+            p = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+            t = p * self.factor + self.margin
+        t = t * self._penalty.get(cmd.opcode, 1)
+        return min(limit, max(self.minimum, t))
+
+    def observe(self, cmd, seconds):
+        samples = self._samples.get(cmd.opcode)
+        if samples is None:
+            samples = collections.deque(maxlen = self.window)
+            self._samples[cmd.opcode] = samples
+        samples.append(seconds)
+        self._penalty.pop(cmd.opcode, None)
+
+    def expired(self, cmd):
+        self._penalty[cmd.opcode] = self._penalty.get(cmd.opcode, 1) * 2
+
+    def seed(self, cmd, seconds):
+        # Pre-fills the window (i.e. from a stored capability profile)
+        for i in range(self.minSamples):
+            self.observe(cmd, seconds)
+
+    def stats(self):
+        return {
+            opcode : {
+                'samples' : len(samples),
+                'max' : max(samples),
+                'penalty' : self._penalty.get(opcode, 1)
+            } for opcode, samples in self._samples.items()
+        }
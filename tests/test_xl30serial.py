@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from xl30serial.xl30serial import XL30Serial
+from xl30serial.xl30async import AsyncXL30Serial
+from xl30serial.xl30broker import XL30Broker, XL30BrokerClient
+from xl30serial.xl30commands import XL30_COMMANDS, build_frame
+from xl30serial.xl30errors import XL30TimeoutError, XL30ChecksumError, XL30ProtocolError, XL30PortError, XL30DeviceError, XL30UnsupportedCommandError
+from xl30serial.xl30errors import XL30RetryPolicy, RETRY_RAISE, RETRY_RETRY, RETRY_RECONNECT, classify
+from xl30serial.xl30faults import XL30FaultyPort
+from xl30serial.xl30simulator import XL30Simulator, XL30SimulatorPort
+from xl30serial.scanningelectronmicroscope import ScanningElectronMicroscope_ScanMode
+
+# Drives XL30Serial, AsyncXL30Serial and the broker against the simulator.
+# All modelled durations are scaled to zero and port timeouts are short so
+# the whole module runs in a few seconds. The asyncio driver needs a real
+# file descriptor and is pointed at the pty of the simulator
+
+logger = logging.getLogger("test_xl30serial")
+logger.setLevel(logging.CRITICAL)
+
+SERIAL = 1234
+
+class GarbagePort(XL30SimulatorPort):
+    # Puts the given bytes in front of the next response
+    def __init__(self, simulator, timeout = 0.2):
+        super().__init__(simulator, timeout = timeout)
+        self.garbage = b''
+
+    def write(self, data):
+        self._rx += self.garbage
+        self.garbage = b''
+        return super().write(data)
+
+@pytest.fixture
+def sim():
+    return XL30Simulator(serialNumber = SERIAL, timeScale = 0, seed = 1)
+
+@pytest.fixture
+def ptysim():
+    sim = XL30Simulator(serialNumber = SERIAL, timeScale = 0, seed = 1)
+    sim.start()
+    yield sim
+    sim.stop()
+
+def connect(port, **kwargs):
+    kwargs.setdefault("retryDelay", 0)
+    return XL30Serial(port, logger, **kwargs)
+
+def record_opcodes(xl):
+    sent = [ ]
+    tx = xl._frame_tx
+    def wrapper(msg):
+        sent.append(msg[2])
+        return tx(msg)
+    xl._frame_tx = wrapper
+    return sent
+
+# Framing
+
+def test_resync_skips_garbage(sim):
+    port = GarbagePort(sim)
+    xl = connect(port)
+    xl._set_magnification(5000)
+
+    # Noise, a frame ID with an invalid length and a corrupted frame
+    corrupted = bytearray(build_frame(12, bytes(4)))
+    corrupted[-1] = corrupted[-1] ^ 0xFF
+    port.garbage = b'\x00\xff\x05\x02' + bytes(corrupted)
+    assert xl._get_magnification() == 5000
+    assert xl._rxLastDropped == 4 + len(corrupted)
+
+def test_resync_limit(sim):
+    port = GarbagePort(sim)
+    xl = connect(port, resyncLimit = 16, retryCount = 0, reconnectCount = 0)
+    port.garbage = bytes(64)
+    with pytest.raises(XL30ProtocolError):
+        xl._command("get_magnification")
+
+# Write-through cache
+
+def test_cache_elides_redundant_writes(sim):
+    xl = connect(XL30SimulatorPort(sim, timeout = 0.2), cacheTimeout = 10)
+    assert xl._set_magnification(5000)
+    requests = sim.requests
+    assert xl._set_magnification(5000)
+    assert xl._get_magnification() == 5000
+    assert sim.requests == requests
+
+    assert xl._set_magnification(6000)
+    assert sim.requests == requests + 1
+    assert xl._get_magnification() == 6000
+
+def test_cache_disabled_queries_console(sim):
+    xl = connect(XL30SimulatorPort(sim, timeout = 0.2))
+    xl._set_magnification(5000)
+    requests = sim.requests
+    xl._get_magnification()
+    xl._get_magnification()
+    assert sim.requests == requests + 2
+
+# Deferred write batches
+
+def test_batch_order_and_deduplication(sim):
+    xl = connect(XL30SimulatorPort(sim, timeout = 0.2))
+    sent = record_opcodes(xl)
+    with xl.batch() as b:
+        xl._set_contrast(40)
+        xl._set_magnification(1000)
+        xl._set_linetime(20.0)
+        xl._set_scanmode(ScanningElectronMicroscope_ScanMode.SPOT)
+        xl._set_magnification(5000)
+        assert sent == [ ]
+
+    setters = [ XL30_COMMANDS[name].opcode for name in ( "set_scanmode", "set_linetime", "set_magnification", "set_contrast" ) ]
+    assert [ op for op in sent if op in setters ] == setters
+    assert all(b.results.values())
+    assert xl._get_magnification() == 5000
+    assert xl._get_contrast() == 40
+
+def test_batch_validates_before_sending(sim):
+    xl = connect(XL30SimulatorPort(sim, timeout = 0.2))
+    sent = record_opcodes(xl)
+    with pytest.raises(ValueError):
+        with xl.batch():
+            xl._set_magnification(5000)
+            xl._set_linetime(7)
+    assert sent == [ ]
+
+# Retry taxonomy
+
+@pytest.mark.parametrize("exc, kind", [
+    ( XL30UnsupportedCommandError("x"), "unsupported" ),
+    ( XL30DeviceError("x"), "device" ),
+    ( XL30ChecksumError("x"), "checksum" ),
+    ( XL30TimeoutError("x"), "timeout" ),
+    ( XL30PortError("x"), "port" ),
+    ( OSError("x"), "port" ),
+    ( XL30ProtocolError("x"), "protocol" ),
+    ( ValueError("x"), "argument" ),
+    ( KeyError("x"), "unknown" )
+])
+def test_classify(exc, kind):
+    assert classify(exc) == kind
+
+def test_retry_policy_decisions():
+    policy = XL30RetryPolicy(retryCount = 2, reconnectCount = 1, retryDelay = 1, jitter = 0)
+    assert policy.decide(ValueError("x"), 0, 0) == ( RETRY_RAISE, 0 )
+    assert policy.decide(XL30DeviceError("x"), 0, 0) == ( RETRY_RAISE, 0 )
+    assert policy.decide(XL30ChecksumError("x"), 1, 0) == ( RETRY_RETRY, 0 )
+    assert policy.decide(XL30TimeoutError("x"), 1, 0) == ( RETRY_RETRY, 2 )
+    assert policy.decide(XL30TimeoutError("x"), 0, 0, idempotent = False) == ( RETRY_RAISE, 0 )
+    assert policy.decide(XL30TimeoutError("x"), 2, 0) == ( RETRY_RECONNECT, 0 )
+    assert policy.decide(XL30PortError("x"), 0, 0) == ( RETRY_RECONNECT, 0 )
+    assert policy.decide(XL30TimeoutError("x"), 2, 1) == ( RETRY_RAISE, 0 )
+
+def test_retry_recovers_from_faults(sim):
+    port = XL30FaultyPort(XL30SimulatorPort(sim, timeout = 0.2), seed = 1, delay = 0.1)
+    xl = connect(port)
+    xl._set_magnification(5000)
+    for fault in ( "bitflip", "silence", "status" ):
+        retries = xl._retryTotal
+        port.arm(fault)
+        assert xl._get_magnification() == 5000
+        assert xl._retryTotal > retries
+
+def test_argument_errors_are_not_retried(sim):
+    xl = connect(XL30SimulatorPort(sim, timeout = 0.2))
+    sent = record_opcodes(xl)
+    with pytest.raises(ValueError):
+        xl._set_spotsize(99)
+    assert sent == [ ]
+    assert xl._retryTotal == 0
+
+# Fast reconnect
+
+def test_fast_reconnect(ptysim):
+    xl = connect(ptysim.port, fastReconnect = True)
+    xl._connect()
+    try:
+        xl._set_magnification(5000)
+        requests = ptysim.requests
+        assert xl._reconnect()
+        # Only the identity is probed again
+        assert ptysim.requests == requests + 1
+        assert xl._get_magnification() == 5000
+
+        # A different identity falls back to the full initialization
+        xl._machine_serial = SERIAL + 1
+        assert xl._reconnect()
+        assert xl._machine_serial == SERIAL
+    finally:
+        xl._close()
+
+# Broker
+
+def test_broker_coalesces_identical_reads(sim, tmp_path):
+    xl = connect(XL30SimulatorPort(sim, timeout = 0.2))
+    xl._set_magnification(5000)
+
+    # Keeps the worker busy till the other clients have queued their requests
+    release = threading.Event()
+    spotsize = xl.get_spotsize
+    def blocked():
+        release.wait(5)
+        return spotsize()
+    xl.get_spotsize = blocked
+
+    path = str(tmp_path / "broker.sock")
+    with XL30Broker(xl, path, cacheTimeout = None) as broker:
+        results = [ ]
+        def call(method):
+            with XL30BrokerClient(path, timeout = 5) as c:
+                results.append(c.call(method))
+        threads = [ threading.Thread(target = call, args = ( "get_spotsize", )) ]
+        threads[0].start()
+        while broker.executed < 1:
+            threading.Event().wait(0.01)
+        for i in range(3):
+            threads.append(threading.Thread(target = call, args = ( "get_magnification", )))
+            threads[-1].start()
+        while broker.requests < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        for t in threads:
+            t.join(5)
+
+        assert sorted(results) == sorted([ spotsize(), 5000, 5000, 5000 ])
+        assert broker.executed == 2
+
+def test_broker_cache_and_invalidation(sim, tmp_path):
+    xl = connect(XL30SimulatorPort(sim, timeout = 0.2))
+    path = str(tmp_path / "broker.sock")
+    with XL30Broker(xl, path, cacheTimeout = 10) as broker:
+        with XL30BrokerClient(path, timeout = 5) as c:
+            assert c.set_magnification(5000)
+            assert c.get_magnification() == 5000
+            assert c.get_magnification() == 5000
+            assert broker.executed == 2
+            assert c.set_magnification(6000)
+            assert c.get_magnification() == 6000
+            assert broker.executed == 4
+
+# asyncio driver
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro) if sys.version_info < ( 3, 7 ) else asyncio.run(coro)
+
+def test_async_commands(ptysim):
+    async def main():
+        async with AsyncXL30Serial(ptysim.port, logger, timeout = 2, retryDelay = 0, metrics = True) as xl:
+            assert xl._machine_serial == SERIAL
+            assert await xl.set_magnification(5000)
+            results = await asyncio.gather(xl.get_magnification(), xl.set_spotsize(3.0), xl.get_spotsize())
+            assert results[0] == 5000
+            assert results[1]
+            st = await xl.get_state()
+            assert st.magnification == 5000
+            assert 12 in xl.get_metrics()["latency"]
+    run(main())
+
+def test_async_hightension_ramp(ptysim):
+    async def main():
+        async with AsyncXL30Serial(ptysim.port, logger, timeout = 2, retryDelay = 0) as xl:
+            assert await xl.set_hightension(10000)
+            assert abs(await xl.get_hightension() - 10000) < 100
+    run(main())
+
+def test_async_resync():
+    xl = AsyncXL30Serial(None, logger, resyncLimit = 10)
+    frame = build_frame(12, bytes(4))
+    xl._rxBuffer += bytes(100) + frame
+    assert xl._rx_parse() == frame
+    assert xl._rxDroppedBytes == 100
+
+    xl._rxBuffer += bytes(100)
+    with pytest.raises(XL30ProtocolError):
+        xl._rx_parse()